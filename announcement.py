@@ -5,11 +5,12 @@ import json
 import logging
 
 import db
+import feed
 import util
 
 log = logging.getLogger("mahjong")
 
-class CurrentAnnouncementHandler(tornado.web.RequestHandler):
+class CurrentAnnouncementHandler(feed.VersionedHandler):
     def get(self):
         result = { 'status': "error",
                     'message': "Unknown error occurred"}
@@ -30,9 +31,10 @@ class CurrentAnnouncementHandler(tornado.web.RequestHandler):
             cur.execute("INSERT INTO Messages VALUES(?, datetime('now', 'localtime'))", (announcement,))
             result = { 'status': "success",
                         'message': "Announcement updated"}
+        feed.publish('announcement')
         self.write(json.dumps(result))
 
-class TeachingSessionsHandler(tornado.web.RequestHandler):
+class TeachingSessionsHandler(feed.VersionedHandler):
     def get(self):
         result = { 'status': "error",
                     'message': "Unknown error occurred"}
@@ -49,6 +51,7 @@ class TeachingSessionsHandler(tornado.web.RequestHandler):
             cur.execute("INSERT INTO TeachingSessions(Time) VALUES(?)", (time,))
             result = { 'status': "success",
                         'message': "Teaching sessions updated"}
+        feed.publish('teachingsessions')
         self.write(json.dumps(result))
 
 class DeleteTeachingSessionHandler(tornado.web.RequestHandler):
@@ -60,4 +63,38 @@ class DeleteTeachingSessionHandler(tornado.web.RequestHandler):
             cur.execute("DELETE FROM TeachingSessions WHERE Time = ?", (time,))
             result = { 'status': "success",
                         'message': "Teaching sessions updated"}
+        feed.publish('teachingsessions')
         self.write(json.dumps(result))
+
+def describeSession(session, now):
+    return "{0} on {1} at {2}".format(
+            util.timeString((session - now).total_seconds()),
+            session.strftime("%A"), session.strftime("%H:%M:%S"))
+
+def sessionTimes():
+    """The times of the teaching sessions, earliest first"""
+    with db.getCur() as cur:
+        cur.execute("SELECT Time FROM TeachingSessions ORDER BY Time ASC")
+        sessions = []
+        for row in cur.fetchall():
+            try:
+                sessions.append(util.parseTime(row[0]))
+            except (TypeError, ValueError):
+                pass
+    return sessions
+
+def nextSession(now):
+    """What the projectors say about teaching sessions, as of now"""
+    sessions = sessionTimes()
+    for i, session in enumerate(sessions):
+        delta = (session - now).total_seconds()
+        if -60 * 60 < delta < 0:
+            text = "Teaching session in progress."
+            if i + 1 < len(sessions):
+                text += " Next teaching session in " + describeSession(sessions[i + 1], now)
+            else:
+                text += " This is the last session"
+            return text
+        elif delta > 0:
+            return "Next teaching session in " + describeSession(session, now)
+    return "No more teaching presentations" if len(sessions) > 0 else ""
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+import collections
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import posixpath
+import re
+
+import tornado.web
+
+import settings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+log = logging.getLogger("mahjong")
+
+# Files served from static/, by the bundle the pages ask for.  Each bundle
+# is built into static/build/ under a name with a hash of its content.
+# The mustache templates are inlined into base.js.
+bundles = collections.OrderedDict([
+    ('base.css', [
+        'css/libraries/jquery-ui.min.css',
+        'css/libraries/jquery-ui.theme.min.css',
+        'css/libraries/jquery.datetimepicker.min.css',
+        'css/font-awesome.min.css',
+        'css/style.css']),
+    ('base.js', [
+        'js/libraries/jquery.min.js',
+        'js/libraries/jquery-ui.min.js',
+        'js/libraries/jquery.datetimepicker.full.min.js',
+        'js/libraries/jquery.ui.touch-punch.min.js',
+        'js/libraries/mustache.min.js',
+        'js/libraries/notify.min.js',
+        'js/script.js',
+        'mustache/*.mst']),
+    ('admin.css', ['css/admin.css']),
+    ('admin.js', ['js/admin.js']),
+    ('announcement.js', ['js/announcement.js']),
+    ('manage.css', ['css/manage.css']),
+    ('manage.js', ['js/manage.js']),
+    ('projector.css', ['css/projector.css']),
+    ('projector.js', ['js/projector.js']),
+    ('projectorlite.css', ['css/style.css', 'css/projector.css']),
+    ('projectorlite.js', ['js/projectorlite.js']),
+])
+
+BUILD = "build"
+
+# Fingerprinted name of each bundle, relative to static/, once built
+manifest = {}
+
+def minifyJS(text):
+    """Drop indentation, blank lines and whole line comments.  Line breaks
+    are kept so semicolon insertion is unaffected.  The libraries are
+    minified already."""
+    lines = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line != "" and not line.startswith("//"):
+            lines.append(line)
+    return "\n".join(lines)
+
+def minifyCSS(text):
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.DOTALL)
+    text = re.sub(r'\s+', ' ', text)
+    return re.sub(r'\s*([{};,])\s*|(:)\s+', r'\1\2', text).strip()
+
+url_pattern = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+def rebase(css, path):
+    """Make the relative URLs in a stylesheet at path relative to the build
+    directory instead"""
+    def replace(match):
+        url = match.group(2)
+        if re.match(r'^([a-z]+:|/|#)', url):
+            return match.group(0)
+        url = posixpath.relpath(
+                posixpath.normpath(posixpath.join(posixpath.dirname(path), url)), BUILD)
+        return "url({0}{1}{0})".format(match.group(1), url)
+    return url_pattern.sub(replace, css)
+
+def content(static, name):
+    """The contents of a bundle, as bytes"""
+    parts = []
+    templates = collections.OrderedDict()
+    for pattern in bundles[name]:
+        for path in sorted(glob.glob(os.path.join(static, pattern))):
+            path = os.path.relpath(path, static).replace(os.sep, "/")
+            with open(os.path.join(static, path), encoding="utf-8") as f:
+                text = f.read()
+            if path.endswith(".mst"):
+                templates[posixpath.splitext(posixpath.basename(path))[0]] = text
+            elif path.endswith(".css"):
+                parts.append(rebase(text if ".min." in path else minifyCSS(text), path))
+            else:
+                parts.append(text if ".min." in path else minifyJS(text))
+    if len(templates) > 0:
+        parts.append("window.mustacheTemplates = {0};".format(json.dumps(templates)))
+    separator = "\n" if name.endswith(".css") else ";\n"
+    return separator.join(parts).encode("utf-8")
+
+def write(path, make):
+    """Write the bytes make() returns to path, unless it exists already"""
+    if not os.path.exists(path):
+        with open(path + ".tmp", "wb") as f:
+            f.write(make())
+        os.replace(path + ".tmp", path)
+
+def build(static):
+    """Build every bundle into static/build/, with gzip and, if the brotli
+    module is installed, brotli compressed copies, and fill in the
+    manifest.  Bundles already built with the same content are kept, so
+    this is cheap when nothing changed and works on a read only install
+    that was built beforehand, as setup.py does.  Returns whether all the
+    bundles are available."""
+    manifest.clear()
+    if not settings.BUNDLE_ASSETS:
+        return False
+    directory = os.path.join(static, BUILD)
+    built = {}
+    try:
+        os.makedirs(directory, exist_ok=True)
+        for name in bundles:
+            data = content(static, name)
+            base, extension = os.path.splitext(name)
+            filename = "{0}.{1}{2}".format(base,
+                    hashlib.sha1(data).hexdigest()[:12], extension)
+            path = os.path.join(directory, filename)
+            write(path, lambda: data)
+            write(path + ".gz", lambda: gzip.compress(data, 9, mtime=0))
+            if brotli is not None:
+                write(path + ".br", lambda: brotli.compress(data))
+            built[name] = BUILD + "/" + filename
+    except OSError:
+        log.exception("Could not build static bundles, serving unbundled files")
+        return False
+    manifest.update(built)
+    current = set(os.path.basename(path) for path in built.values())
+    for filename in os.listdir(directory):
+        if re.sub(r'\.(gz|br|tmp)$', '', filename) not in current:
+            try:
+                os.remove(os.path.join(directory, filename))
+            except OSError:
+                pass
+    return True
+
+def bundle(handler, name):
+    """Template helper giving the URLs to load a bundle from: its built
+    file when built, or else its separate files"""
+    if name in manifest:
+        return [handler.static_url(manifest[name], include_version=False)]
+    urls = []
+    for pattern in bundles[name]:
+        if not pattern.endswith(".mst"):
+            urls.append(handler.static_url(pattern))
+    return urls
+
+class StaticHandler(tornado.web.StaticFileHandler):
+    """Serves static files, with the precompressed copy of a built bundle
+    when the client accepts it.  Built bundles and versioned URLs are
+    cached for good, as their URL changes with their content."""
+    encodings = [('br', ".br"), ('gzip', ".gz")]
+
+    def validate_absolute_path(self, root, absolute_path):
+        absolute_path = tornado.web.StaticFileHandler.validate_absolute_path(
+                self, root, absolute_path)
+        self.encoding = None
+        if absolute_path is not None:
+            self.original_path = absolute_path
+            accepted = self.request.headers.get("Accept-Encoding", "")
+            for encoding, suffix in self.encodings:
+                if encoding in accepted and os.path.isfile(absolute_path + suffix):
+                    self.encoding = encoding
+                    # Sizes and times are those of the file actually sent
+                    self._stat_result = os.stat(absolute_path + suffix)
+                    return absolute_path + suffix
+        return absolute_path
+
+    def get_content_type(self):
+        if self.encoding is None:
+            return tornado.web.StaticFileHandler.get_content_type(self)
+        mime_type, encoding = mimetypes.guess_type(self.original_path)
+        return mime_type or "application/octet-stream"
+
+    def set_extra_headers(self, path):
+        if self.encoding is not None:
+            self.set_header("Content-Encoding", self.encoding)
+        if path.startswith(BUILD + "/"):
+            self.set_header("Vary", "Accept-Encoding")
+        if self.get_cache_time(path, None, None) == self.CACHE_MAX_AGE:
+            self.set_header("Cache-Control",
+                    "public, max-age={0}, immutable".format(self.CACHE_MAX_AGE))
+
+    def get_cache_time(self, path, modified, mime_type):
+        if path.startswith(BUILD + "/") or "v" in self.request.arguments:
+            return self.CACHE_MAX_AGE
+        return 0
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import json
+import sqlite3
+
+import tornado.web
+
+import events
+import settings
+import state
+
+class BatchError(Exception):
+    pass
+
+def tableArgument(room, op):
+    table = int(op['table'])
+    if table not in room.tables:
+        raise BatchError("Unknown table {0}".format(table))
+    if room.tables[table]['Type'] not in room.types:
+        raise BatchError("Table {0} has no table type".format(table))
+    return table
+
+def playerArgument(room, op):
+    player = int(op['player'])
+    if player not in room.people:
+        raise BatchError("Unknown player {0}".format(player))
+    return player
+
+# Each operation changes the room and returns a message and the event to
+# log once the batch commits, as (message, event type, event data)
+
+def tablePlayer(room, op):
+    player = playerArgument(room, op)
+    table = tableArgument(room, op)
+    room.seatPerson(player, table)
+    return "Moved player", "playermovetotable", (player, table)
+
+def queuePlayer(room, op):
+    player = playerArgument(room, op)
+    tableType = op['type']
+    if tableType not in room.types:
+        raise BatchError("Unknown table type {0}".format(tableType))
+    room.queuePerson(player, tableType)
+    return "Moved player", "playerqueuemove", (player, tableType)
+
+def deletePlayer(room, op):
+    player = playerArgument(room, op)
+    room.deletePeople([player])
+    return "Deleted player", "playerdelete", player
+
+def fillTable(room, op):
+    table = tableArgument(room, op)
+    playercount = room.fillTable(table)
+    return "Filled table", "tablefill", (table, playercount)
+
+def startTable(room, op):
+    table = tableArgument(room, op)
+    room.startTable(table)
+    return "Started table", "tablestart", table
+
+def clearTable(room, op):
+    table = tableArgument(room, op)
+    room.clearTable(table)
+    return "Cleared table", "tableclear", table
+
+operations = {
+    'tableplayer': tablePlayer,
+    'queueplayer': queuePlayer,
+    'deleteplayer': deletePlayer,
+    'filltable': fillTable,
+    'starttable': startTable,
+    'cleartable': clearTable
+}
+
+def run(room, ops):
+    """Run a list of operations, each a dict naming the operation in 'op'
+    along with the arguments of its API, in one transaction.  Either all
+    of them are applied or, if one fails, none are and BatchError is
+    raised.  Returns the operations' messages."""
+    done = []
+    with room.mutate():
+        for index, op in enumerate(ops):
+            name = op.get('op') if isinstance(op, dict) else None
+            try:
+                if name not in operations:
+                    raise BatchError("Unknown operation")
+                done.append(operations[name](room, op))
+            except KeyError as e:
+                error = "Missing {0}".format(e.args[0])
+            except (BatchError, ValueError, TypeError, sqlite3.Error) as e:
+                error = str(e)
+            else:
+                continue
+            raise BatchError("Operation {0} ({1}) failed: {2}".format(
+                index + 1, name, error))
+    for message, eventType, data in done:
+        events.logEvent(eventType, data)
+    return [message for message, eventType, data in done]
+
+class BatchHandler(tornado.web.RequestHandler):
+    def post(self):
+        result = { 'status': "error",
+                    'message': "Unknown error occurred"}
+        try:
+            ops = json.loads(self.get_argument("ops", "[]"))
+        except ValueError:
+            ops = None
+        if not isinstance(ops, list) or len(ops) == 0:
+            result["message"] = "Please give a list of operations"
+        elif len(ops) > settings.BATCH_MAX_OPERATIONS:
+            result["message"] = "At most {0} operations can be run at once".format(
+                    settings.BATCH_MAX_OPERATIONS)
+        else:
+            try:
+                result["results"] = run(state.get(), ops)
+                result["status"] = "success"
+                result["message"] = "; ".join(sorted(set(result["results"]),
+                    key=result["results"].index))
+            except BatchError as e:
+                result["message"] = str(e)
+        self.write(json.dumps(result))
@@ -0,0 +1,977 @@
+#!/usr/bin/env python3
+"""Benchmarks for the seater.  Every benchmark runs against a freshly
+created temporary database, never settings.DBFILE.
+
+    python benchmark.py <benchmark> [options]
+"""
+
+import argparse
+import atexit
+import datetime
+import glob
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+import tornado.gen
+import tornado.httpclient
+import tornado.httpserver
+import tornado.ioloop
+import tornado.tcpclient
+import tornado.testing
+import tornado.websocket
+
+import settings
+import db
+import util
+import events
+import metrics
+import rooms
+
+def tempdb():
+    """Point settings.DBFILE at a new, empty, initialized database"""
+    events.flush()
+    db.close()
+    fd, settings.DBFILE = tempfile.mkstemp(suffix=".db", prefix="seaterbench-")
+    os.close(fd)
+    os.remove(settings.DBFILE)
+    atexit.register(removedb, settings.DBFILE)
+    db.init(force=True)
+    return settings.DBFILE
+
+def removedb(dbfile):
+    events.flush()
+    db.close()
+    for path in glob.glob(dbfile + "*"):
+        os.remove(path)
+    shutil.rmtree(events.archiveDirectory(dbfile), ignore_errors=True)
+
+def seed(types=1, tables=10, queued=0, playing=0, players=4, duration=90):
+    """Fill the current database with table types, tables and queued
+    people.  The first `playing` tables of each type are full and
+    started."""
+    with db.getCur() as cur:
+        for t in range(types):
+            tabletype = "Type {0}".format(t)
+            cur.execute("INSERT INTO TableTypes(Type, Duration, Players) VALUES(?, ?, ?)",
+                    (tabletype, duration, players))
+            for i in range(tables):
+                started = i < playing
+                cur.execute(
+                        "INSERT INTO Tables(Playing, Started, Name, Type, x, y) VALUES"
+                        "(?, CASE WHEN ? THEN datetime('now', 'localtime', ?) END, ?, ?, 0, 0)",
+                        (started, started, "-{0} minutes".format(i % duration),
+                            "Table {0}".format(i), tabletype))
+                if started:
+                    table = cur.lastrowid
+                    for p in range(players):
+                        cur.execute("INSERT INTO People(Name, Phone, Added) VALUES(?, NULL, datetime('now', 'localtime'))",
+                                ("Seated {0}-{1}".format(table, p),))
+                        cur.execute("INSERT INTO Players(TableId, PersonId) VALUES(?, ?)",
+                                (table, cur.lastrowid))
+            for p in range(queued):
+                cur.execute("INSERT INTO People(Name, Phone, Added) VALUES"
+                        "(?, ?, datetime('now', 'localtime', ?))",
+                        ("Queued {0}".format(p), "555-0100" if p % 3 == 0 else None,
+                            "-{0} seconds".format(queued - p)))
+                cur.execute("INSERT INTO Queue(Person, Type) VALUES(?, ?)",
+                        (cur.lastrowid, tabletype))
+
+class Server():
+    """Run an Application on an unused local port for the duration of a
+    with block"""
+    def __init__(self, app):
+        self.app = app
+        # (route, seconds, status code) of each request made through fetch
+        self.timings = []
+        self.routes = [(rule.matcher.regex, rule.matcher.regex.pattern.rstrip("$"))
+                for rule in app.wildcard_router.rules]
+    def route(self, path):
+        path = urllib.parse.urlsplit(path).path
+        for regex, route in self.routes:
+            if regex.match(path):
+                return route
+        return path
+    def __enter__(self):
+        sock, port = tornado.testing.bind_unused_port()
+        self.server = tornado.httpserver.HTTPServer(self.app)
+        self.server.add_sockets([sock])
+        self.url = "http://127.0.0.1:{0}".format(port)
+        self.client = tornado.httpclient.AsyncHTTPClient()
+        return self
+    def __exit__(self, type, value, traceback):
+        self.server.stop()
+        return False
+    async def fetch(self, path, body=None, **kwargs):
+        if body is not None:
+            kwargs['method'] = 'POST'
+            kwargs['body'] = urllib.parse.urlencode(body)
+        start = time.perf_counter()
+        response = await self.client.fetch(self.url + path, raise_error=False, **kwargs)
+        self.timings.append((self.route(path), time.perf_counter() - start, response.code))
+        return response
+    async def firstMessage(self, path):
+        """Open a feed connection, wait for its first message and close
+        it.  Recorded like fetch, with a status of 101 for WebSockets and
+        200 for event streams."""
+        start = time.perf_counter()
+        if path == '/api/feed':
+            connection = await tornado.websocket.websocket_connect(
+                    "ws" + self.url[4:] + path)
+            await connection.read_message()
+            connection.close()
+            code = 101
+        else:
+            stream = await tornado.tcpclient.TCPClient().connect("127.0.0.1",
+                    int(self.url.rsplit(":", 1)[1]))
+            await stream.write("GET {0} HTTP/1.1\r\nHost: bench\r\n\r\n".format(path).encode())
+            headers = await stream.read_until(b"\r\n\r\n")
+            await stream.read_until(b"\n\n")
+            stream.close()
+            code = int(headers.split()[1])
+        self.timings.append((self.route(path), time.perf_counter() - start, code))
+
+class countStatements():
+    """Count the SQL statements run on this thread's pooled connection
+    for the duration of a with block"""
+    count = 0
+    def __enter__(self):
+        self.con = db.pooled_connection()['con']
+        self.con.set_trace_callback(self.trace)
+        return self
+    def __exit__(self, type, value, traceback):
+        self.con.set_trace_callback(metrics.statement if settings.METRICS else None)
+        return False
+    def trace(self, statement):
+        self.count += 1
+        if settings.METRICS:
+            metrics.statement(statement)
+
+def timeit(func, repeat):
+    """Return the mean wall clock seconds of calling func"""
+    start = time.perf_counter()
+    for i in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+def report(name, value, unit=""):
+    print("{0:<48} {1:>12.4f} {2}".format(name, value, unit))
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def connections(args):
+    """Connections opened per request with and without DBPOOL"""
+    import sakuraconseater
+
+    requests = [
+            ('/api/tables', None),
+            ('/api/queue', None),
+            ('/api/queue', {'name': "Bench", 'phone': "", 'type': "Type 0", 'numplayers': 4}),
+            ('/api/filltable', {'table': 1}),
+            ('/api/starttable', {'table': 1}),
+            ('/api/cleartable', {'table': 1}),
+    ]
+    for pool in (False, True):
+        settings.DBPOOL = pool
+        tempdb()
+        seed(tables=args.tables, queued=args.queued, playing=args.tables // 2)
+        with Server(sakuraconseater.Application()) as server:
+            async def run():
+                for i in range(args.repeat):
+                    for path, body in requests:
+                        await server.fetch(path, body)
+            before = db.connections_opened
+            start = time.perf_counter()
+            tornado.ioloop.IOLoop.current().run_sync(run)
+            elapsed = time.perf_counter() - start
+            count = args.repeat * len(requests)
+            label = "pooled" if pool else "unpooled"
+            report("{0}: connections per request".format(label),
+                    (db.connections_opened - before) / count)
+            report("{0}: mean request time".format(label), elapsed / count * 1000, "ms")
+
+def gettables(args):
+    """GET /api/tables latency and statements per request by table count"""
+    import sakuraconseater
+
+    settings.DBPOOL = True
+    for count in (50, 200, 1000):
+        tempdb()
+        seed(tables=count, playing=count // 2)
+        with Server(sakuraconseater.Application()) as server:
+            async def run():
+                for i in range(args.repeat):
+                    response = await server.fetch('/api/tables')
+                    assert response.code == 200
+            with countStatements() as statements:
+                start = time.perf_counter()
+                tornado.ioloop.IOLoop.current().run_sync(run)
+                elapsed = time.perf_counter() - start
+            report("{0} tables: GET /api/tables".format(count),
+                    elapsed / args.repeat * 1000, "ms")
+            report("{0} tables: statements per request".format(count),
+                    statements.count / args.repeat)
+
+def roundRobinQueue(tableType, duration, playercount, people, tables,
+        scheduledtables, now):
+    """The round-robin estimate queuehandlers used before eta.py, kept to
+    benchmark against"""
+    queue = []
+    position = 0
+    for person in people:
+        id, name, phone, added = person
+        added = util.parseTime(added)
+
+        eta = now
+        table = int(position / playercount)
+        if len(tables) > 0:
+            if tables[table % len(tables)]['Started'] is not None:
+                eta = util.parseTime(tables[table % len(tables)]['Started'])
+                eta += datetime.timedelta(minutes = duration)
+            eta += datetime.timedelta(minutes = int(table / len(tables)) * duration)
+        elif len(scheduledtables) > 0:
+            scheduledtable = scheduledtables[table % len(scheduledtables)]
+            #TODO: Figure out what to set ETA to in this case
+            if scheduledtable['ScheduledStart'] is None or (
+                    "Taken" in scheduledtable and scheduledtable["Taken"] == playercount):
+                eta = None
+            else:
+                if not "Taken" in scheduledtable:
+                    scheduledtable["Taken"] = 0
+                scheduledtable["Taken"] += 1
+                eta = util.parseTime(scheduledtable['ScheduledStart'])
+        else:
+            eta = None
+        if eta is not None:
+            remaining = (eta - now).total_seconds()
+            if remaining > 0:
+                remaining = util.timeString(remaining)
+            else:
+                remaining = "NOW"
+        else:
+            remaining = "NEVER"
+
+        elapsed = (now - added).total_seconds()
+        elapsed = util.timeString(elapsed)
+
+        queue += [{'Id': id,
+                    'Name': name,
+                    'HasPhone': phone is not None,
+                    'Elapsed': elapsed,
+                    'Added': str(added),
+                    'ETA': str(eta),
+                    'Remaining': remaining}]
+        position += 1
+    table = int(position / playercount)
+    neweta = None
+    if len(tables) > 0:
+        if tables[table % len(tables)]['Playing']:
+            neweta = util.parseTime(tables[table % len(tables)]['Started'])
+            neweta += datetime.timedelta(minutes = duration)
+        else:
+            neweta = now
+        neweta += datetime.timedelta(minutes = int(table / len(tables)) * duration)
+    elif len(scheduledtables) > 0 and scheduledtables[0]['ScheduledStart'] is not None and table > 1:
+        neweta = util.parseTime(scheduledtables[0]['ScheduledStart'])
+    if neweta is not None:
+        newRemaining = (neweta - now).total_seconds()
+        if newRemaining > 0:
+            newRemaining = util.timeString(newRemaining)
+        else:
+            newRemaining = "NOW"
+    else:
+        newRemaining = "NEVER"
+    return {
+        'Type': tableType,
+        'Queue': queue,
+        'ETA': str(neweta),
+        'Remaining': newRemaining
+    }
+
+def queue(args):
+    """ETAs for one table type with a growing queue: the old round-robin
+    estimate against the eta engine computing from scratch, after a change
+    to another type and for an unchanged type.  Then the rows of every
+    type's queue as the queue API sends them: the round-robin for every
+    type against getQueues after every type changed, after one changed and
+    with none changed."""
+    import queuehandlers
+    import state
+    import eta
+
+    settings.DBPOOL = True
+    for count in (40, 500, 2000):
+        tempdb()
+        seed(types=2, tables=args.tables, playing=args.tables // 2, queued=count)
+        room = state.load()
+        tableType = "Type 0"
+        now = datetime.datetime.now()
+
+        def legacyQueue(tableType):
+            info = room.types[tableType]
+            people = [(person['Id'], person['Name'], person['Phone'], person['Added'])
+                    for person in room.queued(tableType)]
+            cols = ['Started','Playing','ScheduledStart']
+            tables = [dict((col, table[col]) for col in cols)
+                    for table in sorted(room.tables.values(),
+                        key=lambda table: (table['Playing'], table['Started'] or ""))
+                    if table['Type'] == tableType]
+            return lambda: roundRobinQueue(tableType, info['Duration'], info['Players'],
+                    people, [dict(table) for table in tables], [], now)
+        legacy = legacyQueue(tableType)
+        legacies = [legacyQueue(tabletype) for tabletype in sorted(room.types)]
+
+        def scratch():
+            estimates = eta.Estimates()
+            return estimates.get(room, tableType, now)
+        estimates = eta.Estimates()
+        estimates.get(room, tableType, now)
+        def other():
+            room.touch("Type 1")
+            return estimates.get(room, tableType, now)
+        report("{0} queued: round-robin".format(count),
+                timeit(legacy, args.repeat) * 1000, "ms")
+        report("{0} queued: eta from scratch".format(count),
+                timeit(scratch, args.repeat) * 1000, "ms")
+        report("{0} queued: eta after another type changed".format(count),
+                timeit(other, args.repeat) * 1000, "ms")
+
+        def changed(*types):
+            def getQueues():
+                room.touch(*types)
+                return queuehandlers.getQueues(now)
+            return getQueues
+        report("{0} queued: round-robin, all types".format(count),
+                timeit(lambda: [legacy() for legacy in legacies], args.repeat) * 1000, "ms")
+        report("{0} queued: getQueues after every type changed".format(count),
+                timeit(changed(*room.types), args.repeat) * 1000, "ms")
+        report("{0} queued: getQueues after one type changed".format(count),
+                timeit(changed("Type 1"), args.repeat) * 1000, "ms")
+        report("{0} queued: getQueues, unchanged".format(count),
+                timeit(changed(), args.repeat) * 1000, "ms")
+
+def fillall(args):
+    """Filling every free table at the top of the hour: one fillTable per
+    table, as clicking Fill on each, against a single fillTables"""
+    import state
+
+    settings.DBPOOL = True
+    for tables in (10, 30, 100):
+        results = {}
+        for name in ('sequential', 'fillTables'):
+            times = []
+            for i in range(min(args.repeat, 5)):
+                tempdb()
+                seed(types=args.types, tables=tables, playing=tables // 3,
+                        queued=tables * 4)
+                room = state.load()
+                with countStatements() as statements:
+                    start = time.perf_counter()
+                    if name == 'sequential':
+                        for table in list(room.tables):
+                            if not room.tables[table]['Playing']:
+                                room.fillTable(table)
+                    else:
+                        room.fillTables()
+                    times.append(time.perf_counter() - start)
+                assert room.diff() == []
+            results[name] = dict(room.players)
+            label = "{0} tables x {1} types: {2}".format(tables, args.types, name)
+            report(label, percentile(times, 50) * 1000, "ms")
+            report("{0} statements".format(label), statements.count)
+        assert results['sequential'] == results['fillTables']
+    print("fillTables seats the same people as sequential fills")
+
+def legacySignup(room, names, phone, tabletype):
+    """Signup as QueueHandler.post used to do it: two inserts and an event
+    per person"""
+    people = []
+    with room.mutate() as cur:
+        for name in names:
+            cur.execute("INSERT INTO People(Name, Phone, Added) VALUES(?, ?, datetime('now', 'localtime'))", (name, phone))
+            cur.execute("INSERT INTO Queue(Person, Type) VALUES(?, ?)", (cur.lastrowid, tabletype))
+            people += [cur.lastrowid]
+            phone = None
+        room.refreshPeople(cur, people)
+    for person, name in zip(people, names):
+        events.logEvent('playerqueueadd', (person, name, tabletype, len(names)))
+
+def signup(args):
+    """Group signups through /api/queue as the group grows, against the
+    old per person inserts, and many groups in one request"""
+    import sakuraconseater
+    import state
+
+    settings.DBPOOL = True
+    tempdb()
+    seed(types=2, tables=args.tables)
+    with Server(sakuraconseater.Application()) as server:
+        async def run():
+            room = state.get()
+            for size in (1, 4, 16, 64, 256):
+                with countStatements() as statements:
+                    start = time.perf_counter()
+                    for i in range(args.repeat):
+                        response = await server.fetch('/api/queue', {'name': "Group",
+                            'phone': "555-0100", 'type': "Type 0", 'numplayers': size})
+                        assert json.loads(response.body)['status'] == "success"
+                    elapsed = time.perf_counter() - start
+                report("group of {0}: request".format(size),
+                        elapsed / args.repeat * 1000, "ms")
+                report("group of {0}: statements".format(size),
+                        statements.count / args.repeat)
+                names = ["Group ({0})".format(i) for i in range(size)]
+                report("group of {0}: addGroups".format(size), timeit(
+                    lambda: room.addGroups([(names, "555-0100", "Type 0")]),
+                    args.repeat) * 1000, "ms")
+                report("group of {0}: old per person inserts".format(size), timeit(
+                    lambda: legacySignup(room, names, "555-0100", "Type 0"),
+                    args.repeat) * 1000, "ms")
+                events.flush()
+            groups = [{'names': ["Guest {0}-{1}".format(g, i) for i in range(4)],
+                    'type': "Type {0}".format(g % 2)} for g in range(args.signups)]
+            with countStatements() as statements:
+                start = time.perf_counter()
+                response = await server.fetch('/api/queue', {'groups': json.dumps(groups)})
+                elapsed = time.perf_counter() - start
+            assert json.loads(response.body)['status'] == "success"
+            report("{0} groups of 4 in one request".format(len(groups)),
+                    elapsed * 1000, "ms")
+            report("{0} groups of 4 in one request: statements".format(len(groups)),
+                    statements.count)
+            assert room.diff() == []
+        tornado.ioloop.IOLoop.current().run_sync(run)
+
+def projector(args):
+    """What each room change costs with every projector fetching the queue
+    JSON to render itself, against fetching the shared server-rendered
+    snapshot"""
+    import sakuraconseater
+
+    settings.DBPOOL = True
+    tempdb()
+    seed(types=args.types, tables=args.tables, playing=args.tables // 2,
+            queued=args.queued)
+    with Server(sakuraconseater.Application()) as server:
+        async def run():
+            for path, headers in (('/api/queue', {}),
+                    ('/api/projector', {}),
+                    ('/api/projector', {'Accept-Encoding': "gzip"})):
+                elapsed = 0
+                size = 0
+                for i in range(args.repeat):
+                    await server.fetch('/api/queue', {'name': "Guest {0}".format(i),
+                        'type': "Type 0"})
+                    start = time.perf_counter()
+                    responses = await tornado.gen.multi([server.fetch(path,
+                        headers = headers, decompress_response = False)
+                        for client in range(args.clients)])
+                    elapsed += time.perf_counter() - start
+                    size += sum(len(response.body) for response in responses)
+                label = "{0}{1}, {2} projectors".format(path,
+                        " gzip" if headers else "", args.clients)
+                report("{0}: per change".format(label),
+                        elapsed / args.repeat * 1000, "ms")
+                report("{0}: bytes per change".format(label), size / args.repeat)
+        tornado.ioloop.IOLoop.current().run_sync(run)
+
+def wire(args):
+    """Bytes and serialization time of GET /api/tables and /api/queue in
+    the full and the compact format, as sent and gzipped"""
+    import gzip
+    import state
+    import tables
+    import queuehandlers
+    import feed
+
+    tempdb()
+    seed(types=args.types, tables=args.tables, playing=args.tables // 2,
+            queued=args.queued)
+    room = state.get()
+    formats = [
+        ('/api/tables', lambda: json.dumps({'tables':
+            tables.getTables(room, datetime.datetime.now())})),
+        ('/api/tables?compact={0}'.format(feed.COMPACT_VERSION), lambda: json.dumps(
+            tables.compactTables(room), separators=(',', ':'))),
+        ('/api/queue', lambda: json.dumps({'Queues': queuehandlers.getQueues()})),
+        ('/api/queue?compact={0}'.format(feed.COMPACT_VERSION), lambda: json.dumps(
+            queuehandlers.compactQueues(), separators=(',', ':'))),
+    ]
+    for path, serialize in formats:
+        body = serialize().encode()
+        report("{0}: bytes".format(path), len(body))
+        report("{0}: bytes gzipped".format(path), len(gzip.compress(body, 6)))
+        report("{0}: serialization".format(path), timeit(serialize, args.repeat) * 1000, "ms")
+
+def startup(args):
+    """Server start up time: importing the server in a fresh interpreter,
+    checking an up to date database's schema with and without the
+    fingerprint in user_version, and building the Application"""
+    script = ("import time; start = time.perf_counter(); import sakuraconseater; "
+            "print(time.perf_counter() - start)")
+    times = [float(subprocess.check_output([sys.executable, "-c", script],
+            cwd = os.path.dirname(os.path.abspath(__file__))))
+        for i in range(max(1, args.repeat // 4))]
+    report("import sakuraconseater: median", percentile(times, 50) * 1000, "ms")
+
+    import sakuraconseater
+
+    settings.DBPOOL = True
+    tempdb()
+    seed(types=args.types, tables=args.tables, queued=args.queued)
+    for label, fingerprint in (("schema checked", 0),
+            ("fingerprint matched", db.schema_fingerprint())):
+        with countStatements() as statements:
+            elapsed = 0
+            for i in range(args.repeat):
+                with db.getCur() as cur:
+                    cur.execute("PRAGMA user_version = {0}".format(fingerprint))
+                start = time.perf_counter()
+                db.init()
+                elapsed += time.perf_counter() - start
+        report("db.init, {0}".format(label), elapsed / args.repeat * 1000, "ms")
+        report("db.init, {0}: statements".format(label),
+                statements.count / args.repeat - 1)
+    report("Application()", timeit(sakuraconseater.Application, args.repeat) * 1000, "ms")
+
+def etag(args):
+    """Statements run and latency of conditional GETs of the read APIs
+    answered with 304 Not Modified, which test_etag.py checks run no SQL"""
+    import sakuraconseater
+
+    settings.DBPOOL = True
+    tempdb()
+    seed(tables=args.tables, playing=args.tables // 2, queued=args.queued)
+    paths = ['/api/tables', '/api/queue', '/api/announcement', '/api/tabletype',
+            '/api/teachingsessions']
+    with Server(sakuraconseater.Application()) as server:
+        async def run():
+            tags = {}
+            for path in paths:
+                response = await server.fetch(path)
+                assert response.code == 200, (path, response.code)
+                tags[path] = response.headers['Etag']
+            for path in paths:
+                with countStatements() as statements:
+                    start = time.perf_counter()
+                    for i in range(args.repeat):
+                        response = await server.fetch(path,
+                                headers = {'If-None-Match': tags[path]})
+                        assert response.code == 304, (path, response.code)
+                    elapsed = time.perf_counter() - start
+                report("{0}: statements per 304".format(path),
+                        statements.count / args.repeat)
+                report("{0}: 304 latency".format(path),
+                        elapsed / args.repeat * 1000, "ms")
+            await server.fetch('/api/announcement', {'announcement': "Changed"})
+            for path in paths:
+                response = await server.fetch(path,
+                        headers = {'If-None-Match': tags[path]})
+                assert response.code == 200, (path, response.code)
+        tornado.ioloop.IOLoop.current().run_sync(run)
+
+def texts(args):
+    """Text throughput and latency through the SMS dispatcher against the
+    fake gateway"""
+    import sms
+
+    for workers, failrate in ((1, 0), (4, 0), (16, 0), (4, 0.2)):
+        transport = sms.FakeTransport(latency=args.latency / 1000, failrate=failrate)
+        done = []
+        texter = sms.Dispatcher(transport, workers=workers, maxqueue=args.texts,
+                retries=5, backoff=0.01, rate=None,
+                onstatus=lambda status, message: done.append((status, message)))
+        async def run():
+            for i in range(args.texts):
+                texter.send("555-0100", "Bench {0}".format(i), person=i)
+            await texter.join()
+        start = time.perf_counter()
+        tornado.ioloop.IOLoop.current().run_sync(run)
+        elapsed = time.perf_counter() - start
+        latencies = [(message['sent'] - message['queued']) * 1000
+                for status, message in done if status == 'sent']
+        label = "{0} workers, {1:.0%} failures".format(workers, failrate)
+        report("{0}: throughput".format(label), args.texts / elapsed, "texts/s")
+        report("{0}: p50 latency".format(label), percentile(latencies, 50), "ms")
+        report("{0}: p95 latency".format(label), percentile(latencies, 95), "ms")
+        report("{0}: retries".format(label), texter.stats['retried'])
+        report("{0}: failed".format(label), texter.stats['failed'])
+
+def eventlog(args):
+    """Cost of logging events, written in one transaction per flush"""
+    tempdb()
+    count = args.repeat * 100
+    elapsed = timeit(lambda: events.logEvent('bench', (1, "Bench")), count)
+    report("logEvent", elapsed * 1000000, "us")
+    start = time.perf_counter()
+    events.flush()
+    report("flush of {0} events".format(count),
+            (time.perf_counter() - start) * 1000, "ms")
+    report("events dropped", events.stats['dropped'])
+
+def admin(args):
+    """/admin latency as the event log grows, and a check that the rollups
+    kept by events.flush match a rebuild from the Events table"""
+    import sakuraconseater
+
+    settings.DBPOOL = True
+    tempdb()
+    types = ['playerqueueadd', 'textsent', 'tablestart', 'tableclear', 'tablenotify']
+    with Server(sakuraconseater.Application()) as server:
+        async def run():
+            logged = 0
+            for size in (args.events // 100, args.events // 10, args.events):
+                with db.getCur() as cur:
+                    cur.execute(
+                            "WITH RECURSIVE n(i) AS (SELECT ? UNION ALL SELECT i + 1 FROM n WHERE i + 1 < ?)"
+                            " INSERT INTO Events(Type, Time, Data)"
+                            " SELECT ?, datetime('now', 'localtime', '-' || (i % 4320) || ' minutes'), ''"
+                            " FROM n",
+                            (logged, size, types[logged % len(types)]))
+                    cur.execute("UPDATE Events SET Type = ? WHERE rowid % ? = 0",
+                            (types[0], len(types)))
+                events.rebuildRollups()
+                logged = size
+                for i in range(args.repeat):
+                    events.logEvent(types[i % len(types)])
+                start = time.perf_counter()
+                for i in range(args.repeat):
+                    response = await server.fetch('/admin')
+                    assert response.code == 200, response.code
+                report("/admin with {0} events".format(size),
+                        (time.perf_counter() - start) / args.repeat * 1000, "ms")
+        tornado.ioloop.IOLoop.current().run_sync(run)
+    with db.getCur() as cur:
+        cur.execute("SELECT Type, Day, Hour, Count FROM EventRollups ORDER BY 1, 2, 3")
+        incremental = cur.fetchall()
+    events.rebuildRollups()
+    with db.getCur() as cur:
+        cur.execute("SELECT Type, Day, Hour, Count FROM EventRollups ORDER BY 1, 2, 3")
+        assert cur.fetchall() == incremental
+    print("Incremental rollups match a rebuild")
+
+def seedEvents(count, types, days=30):
+    """Log count events of the given types, evenly spread over the last
+    days, oldest first"""
+    with db.getCur() as cur:
+        cur.execute(
+                "WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i + 1 < ?)"
+                " INSERT INTO Events(Type, Time, Data)"
+                " SELECT ?, datetime('now', 'localtime', '-' || ((? - i) * ? / ?) || ' minutes'),"
+                " '[' || i || ', \"Bench\"]' FROM n",
+                (count, types[0], count, days * 1440, count))
+        for i, eventType in enumerate(types):
+            cur.execute("UPDATE Events SET Type = ? WHERE rowid % ? = ?",
+                    (eventType, len(types), i))
+    events.rebuildRollups()
+
+def archive(args):
+    """Archiving a month of events: time taken, database and archive sizes,
+    and query times over live and archived events, checking that queries
+    and the rollups see the same events before and after"""
+    tempdb()
+    seedEvents(args.events, ['playerqueueadd', 'textsent', 'tablestart', 'tableclear',
+        'tablenotify'])
+    def rollups():
+        with db.getCur() as cur:
+            cur.execute("SELECT Type, Day, Hour, Count FROM EventRollups ORDER BY 1, 2, 3")
+            return cur.fetchall()
+    def size():
+        """Bytes of the database once vacuumed, with nothing left in the
+        WAL file"""
+        with db.getCur() as cur:
+            cur.execute("VACUUM")
+            cur.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        wal = settings.DBFILE + "-wal"
+        return os.path.getsize(settings.DBFILE) + (
+                os.path.getsize(wal) if os.path.exists(wal) else 0)
+    before = rollups()
+    start = time.perf_counter()
+    logged = list(events.query())
+    report("query all, live", (time.perf_counter() - start) * 1000, "ms")
+    report("database bytes", size())
+
+    start = time.perf_counter()
+    days = events.archive()
+    report("archive {0} days".format(len(days)), (time.perf_counter() - start) * 1000, "ms")
+    report("database bytes after archiving", size())
+    report("archive bytes", sum(os.path.getsize(path) for day, path in events.archiveFiles()))
+
+    start = time.perf_counter()
+    archived = list(events.query())
+    report("query all, archived and live", (time.perf_counter() - start) * 1000, "ms")
+    assert archived == logged
+    day = datetime.date.today() - datetime.timedelta(days=15)
+    start = time.perf_counter()
+    count = len(list(events.query(day.strftime('%Y-%m-%d'),
+        (day + datetime.timedelta(days=1)).strftime('%Y-%m-%d'), ['tablestart'])))
+    report("query one archived day of one type", (time.perf_counter() - start) * 1000, "ms")
+    events.rebuildRollups()
+    assert rollups() == before
+    print("Queries and rollups match before and after archiving")
+
+def export(args):
+    """Streaming a month of events, partly archived, from /api/export:
+    time, bytes, peak memory allocated while streaming and the longest
+    the IOLoop went without running a timer"""
+    import tracemalloc
+    import sakuraconseater
+
+    settings.DBPOOL = True
+    tempdb()
+    seedEvents(args.events, ['playermovetotable', 'textsent', 'tablestart', 'tableclear'])
+    events.archive()
+    with Server(sakuraconseater.Application()) as server:
+        async def run():
+            for path in ('/api/export/events', '/api/export/events?format=csv',
+                    '/api/export/events?gzip=1', '/api/export/seating'):
+                lines = [0]
+                size = [0]
+                def received(chunk):
+                    lines[0] += chunk.count(b"\n")
+                    size[0] += len(chunk)
+                done = [False]
+                lag = [0]
+                async def tick():
+                    while not done[0]:
+                        start = time.perf_counter()
+                        await tornado.gen.sleep(0.001)
+                        lag[0] = max(lag[0], time.perf_counter() - start)
+                tornado.ioloop.IOLoop.current().spawn_callback(tick)
+                start = time.perf_counter()
+                response = await server.fetch(path, streaming_callback = received,
+                        request_timeout = 600)
+                elapsed = time.perf_counter() - start
+                done[0] = True
+                assert response.code == 200, (path, response.code)
+                tracemalloc.start()
+                await server.fetch(path, streaming_callback = lambda chunk: None,
+                        request_timeout = 600)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                if path == '/api/export/events':
+                    assert lines[0] == len(list(events.query())), lines[0]
+                report("{0}: time".format(path), elapsed * 1000, "ms")
+                report("{0}: bytes".format(path), size[0])
+                report("{0}: peak memory".format(path), peak / 1024, "KiB")
+                report("{0}: longest IOLoop stall".format(path), lag[0] * 1000, "ms")
+        tornado.ioloop.IOLoop.current().run_sync(run)
+
+def convention(args):
+    """Synthetic convention load: bursts of signups, managers filling,
+    starting and clearing tables and using every other API, and projector
+    clients, half of them the lite projector, polling throughout.  Reports
+    latency percentiles and throughput for each route in the Application,
+    warns of any the load did not reach, and with --json writes them to a
+    file for comparing runs."""
+    import json
+    import random
+    import notifications
+    import sakuraconseater
+    import state
+
+    settings.DBPOOL = True
+    settings.SMS_TRANSPORT = "fake"
+    settings.SMS_RATE = None
+    rooms.default.data.pop("dispatcher", None)
+    tornado.httpclient.AsyncHTTPClient.configure(None,
+            max_clients = args.signups + args.clients + 1)
+    rng = random.Random(args.seed)
+    tempdb()
+    seed(types=args.types, tables=args.tables, playing=args.tables // 2,
+            queued=args.queued)
+    types = ["Type {0}".format(t) for t in range(args.types)]
+
+    with Server(sakuraconseater.Application()) as server:
+        room = state.get()
+
+        def choose(items):
+            items = list(items)
+            return rng.choice(items) if len(items) > 0 else None
+
+        async def signup(i):
+            numplayers = rng.randint(1, 4)
+            await server.fetch('/api/queue', {'name': "Guest {0}".format(i),
+                'phone': "555-0100" if rng.random() < 0.3 else "",
+                'type': rng.choice(types), 'numplayers': numplayers})
+
+        async def projector(done, paths):
+            tags = {}
+            while not done[0]:
+                for path in paths:
+                    headers = {}
+                    if path in tags:
+                        headers['If-None-Match'] = tags[path]
+                    response = await server.fetch(path, headers = headers)
+                    if 'Etag' in response.headers:
+                        tags[path] = response.headers['Etag']
+                await tornado.gen.sleep(args.poll / 1000)
+
+        async def manage(round):
+            for table in list(room.tables.values()):
+                if not table['Playing']:
+                    await server.fetch('/api/filltable', {'table': table['Id']})
+                    await server.fetch('/api/starttable', {'table': table['Id']})
+                elif rng.random() < args.turnover:
+                    await server.fetch('/api/cleartable', {'table': table['Id']})
+            table = choose(room.tables)
+            person = choose(room.queue)
+            seated = choose(room.players)
+            extra = "Extra {0}".format(round)
+            requests = [
+                ('/api/edittable', {'table': table, 'newname': "Table {0}".format(round)}),
+                ('/api/tableposition', {'table': table, 'x': round, 'y': round}),
+                ('/api/tableschedule', {'table': table, 'time': "2030-01-01 10:00:00"}),
+                ('/api/tableschedule', {'table': table, 'time': ""}),
+                ('/api/tabletype', {'table': table, 'type': rng.choice(types)}),
+                ('/api/notifytable', {'table': table}),
+                ('/api/announcement', {'announcement': "Round {0}".format(round)}),
+                ('/api/teachingsessions', {'time': "2030-01-01 10:00:00"}),
+                ('/api/deleteteachingsession', {'time': "2030-01-01 10:00:00"}),
+                ('/api/addgametype', {'type': extra, 'gameduration': 60, 'numplayers': 4}),
+                ('/api/deletetabletype', {'type': extra}),
+                ('/api/preferences', {'preferences': json.dumps({'bench': round})}),
+                ('/api/tables', {}),
+                ('/api/filltables', {}),
+                ('/api/batch', {'ops': json.dumps([
+                    {'op': 'cleartable', 'table': table},
+                    {'op': 'filltable', 'table': table},
+                    {'op': 'starttable', 'table': table}])}),
+            ]
+            if person is not None:
+                requests += [
+                    ('/api/editplayer', {'player': person, 'newname': "Renamed"}),
+                    ('/api/notifyplayer', {'player': person}),
+                    ('/api/queueplayer', {'player': person, 'type': rng.choice(types)}),
+                    ('/api/tableplayer', {'player': person, 'table': table}),
+                    ('/api/batch', {'ops': json.dumps([
+                        {'op': 'queueplayer', 'player': person, 'type': rng.choice(types)}])}),
+                ]
+            if seated is not None:
+                requests += [('/api/deleteplayer', {'player': seated})]
+            for path, body in requests:
+                await server.fetch(path, body)
+            await server.fetch('/api/deletetable', {'table': max(room.tables)})
+            for path in ('/', '/projector', '/manage', '/announcement', '/admin',
+                    '/api/tabletype', '/api/preferences', '/api/preference/bench',
+                    '/api/metrics', '/api/metrics?format=json', '/api/rooms',
+                    '/api/export/events', '/api/export/seating?format=csv',
+                    '/api/export/people?gzip=1', '/static/js/script.js', '/robots.txt',
+                    '/favicon.ico'):
+                await server.fetch(path)
+            await server.firstMessage('/api/feed')
+            await server.firstMessage('/api/feedstream')
+
+        async def run():
+            signups = 0
+            for round in range(args.rounds):
+                done = [False]
+                pollers = [projector(done, ('/api/projector',) if i % 2 else
+                    ('/api/tables', '/api/queue', '/api/announcement',
+                        '/api/teachingsessions')) for i in range(args.clients)]
+                async def work():
+                    await tornado.gen.multi([signup(signups + i)
+                        for i in range(args.signups)])
+                    await manage(round)
+                    done[0] = True
+                await tornado.gen.multi([work()] + pollers)
+                signups += args.signups
+
+        start = time.perf_counter()
+        tornado.ioloop.IOLoop.current().run_sync(run)
+        elapsed = time.perf_counter() - start
+
+    byroute = dict((route, []) for regex, route in server.routes)
+    for route, seconds, code in server.timings:
+        byroute.setdefault(route, []).append((seconds, code))
+    results = {}
+    for route, timings in byroute.items():
+        latencies = [seconds * 1000 for seconds, code in timings]
+        results[route] = {
+                'requests': len(timings),
+                'errors': sum(1 for seconds, code in timings if code >= 500),
+                'throughput': len(timings) / elapsed,
+                'p50': percentile(latencies, 50) if latencies else None,
+                'p95': percentile(latencies, 95) if latencies else None,
+                'p99': percentile(latencies, 99) if latencies else None,
+        }
+    print("{0:<32} {1:>8} {2:>6} {3:>9} {4:>9} {5:>9} {6:>9}".format(
+        "route", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms"))
+    for route, result in results.items():
+        print("{0:<32} {1:>8} {2:>6} {3:>9.1f} {4:>9} {5:>9} {6:>9}".format(
+            route, result['requests'], result['errors'], result['throughput'],
+            *("{0:.2f}".format(result[p]) if result[p] is not None else "-"
+                for p in ('p50', 'p95', 'p99'))))
+    report("total requests", len(server.timings))
+    report("throughput", len(server.timings) / elapsed, "req/s")
+    missed = [route for route, result in results.items() if result['requests'] == 0]
+    if len(missed) > 0:
+        print("No requests made to {0}".format(", ".join(missed)))
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump({'benchmark': 'convention',
+                'options': vars(args),
+                'time': datetime.datetime.now().isoformat(),
+                'seconds': elapsed,
+                'requests': len(server.timings),
+                'routes': results}, f, indent=2)
+
+benchmarks = {
+        'connections': connections,
+        'tables': gettables,
+        'queue': queue,
+        'fillall': fillall,
+        'signup': signup,
+        'projector': projector,
+        'wire': wire,
+        'etag': etag,
+        'startup': startup,
+        'texts': texts,
+        'events': eventlog,
+        'archive': archive,
+        'export': export,
+        'admin': admin,
+        'convention': convention,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmark", choices=sorted(benchmarks))
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--types", type=int, default=4)
+    parser.add_argument("--tables", type=int, default=20)
+    parser.add_argument("--queued", type=int, default=40)
+    parser.add_argument("--texts", type=int, default=200)
+    parser.add_argument("--events", type=int, default=1000000)
+    parser.add_argument("--latency", type=float, default=20,
+            help="Fake SMS gateway latency in milliseconds")
+    parser.add_argument("--rounds", type=int, default=10,
+            help="Rounds of signups and table turnover in the convention benchmark")
+    parser.add_argument("--signups", type=int, default=20,
+            help="Signups in each round's burst")
+    parser.add_argument("--clients", type=int, default=20,
+            help="Projector clients polling throughout")
+    parser.add_argument("--poll", type=float, default=100,
+            help="Milliseconds between each projector client's polls")
+    parser.add_argument("--turnover", type=float, default=0.3,
+            help="Chance of clearing each playing table each round")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="Write results to this file")
+    parser.add_argument("--verbose", action="store_true",
+            help="Show the event log while benchmarking")
+    args = parser.parse_args()
+    if not args.verbose:
+        logging.disable(logging.INFO)
+    benchmarks[args.benchmark](args)
+
+if __name__ == "__main__":
+    main()
@@ -2,29 +2,124 @@
 
 import warnings
 import sqlite3
+import hashlib
+import json
 import random
 import datetime
 import re
 import collections
-import shutil
 import os
+import threading
+import time
 
 import util
 import settings
+import metrics
+import rooms
+
+# Number of sqlite3 connections opened by this process, for benchmarking
+connections_opened = 0
+
+# Pooled connections, one per database file per thread
+_pool = threading.local()
+
+# Without DBPOOL, the connections of this thread's open getCur blocks, one
+# per database file, closed when the outermost block exits
+_open = threading.local()
+
+def current_dbfile(dbfile=None):
+    """The given database file, or else the current room's"""
+    return dbfile or rooms.get().dbfile
+
+def connect(dbfile=None):
+    global connections_opened
+    con = sqlite3.connect(current_dbfile(dbfile),
+                          cached_statements=settings.DBSTATEMENTCACHE)
+    connections_opened += 1
+    if settings.METRICS:
+        con.set_trace_callback(metrics.statement)
+    con.execute("PRAGMA foreign_keys = ON;")
+    if settings.DBPOOL:
+        con.execute("PRAGMA journal_mode = WAL;")
+        con.execute("PRAGMA synchronous = {0};".format(settings.DBSYNCHRONOUS))
+    return con
+
+def pooled_connection(dbfile=None):
+    """Return this thread's long-lived connection to dbfile along with
+    its bookkeeping record, opening it on first use."""
+    dbfile = current_dbfile(dbfile)
+    if not hasattr(_pool, 'connections'):
+        _pool.connections = {}
+    if dbfile not in _pool.connections:
+        _pool.connections[dbfile] = {'con': connect(dbfile), 'depth': 0}
+    return _pool.connections[dbfile]
+
+def close():
+    """Close all of this thread's pooled connections, first moving
+    everything in their WAL files into the database files"""
+    for entry in getattr(_pool, 'connections', {}).values():
+        try:
+            entry['con'].execute("PRAGMA wal_checkpoint(TRUNCATE);")
+        except sqlite3.Error:
+            pass
+        entry['con'].close()
+    _pool.connections = {}
+
+def open_connection(dbfile=None):
+    """Return the connection of this thread's open getCur block on dbfile
+    along with its bookkeeping record, opening one if there is none"""
+    dbfile = current_dbfile(dbfile)
+    if not hasattr(_open, 'connections'):
+        _open.connections = {}
+    if dbfile not in _open.connections:
+        _open.connections[dbfile] = {'con': connect(dbfile), 'depth': 0}
+    return _open.connections[dbfile]
+
+def inTransaction():
+    """Whether this thread is inside a getCur block on the current room's
+    database"""
+    dbfile = current_dbfile()
+    connections = _pool if settings.DBPOOL else _open
+    entry = getattr(connections, 'connections', {}).get(dbfile)
+    return entry is not None and entry['depth'] > 0
 
 class getCur():
+    """Context manager yielding a cursor.  Changes are committed when the
+    outermost getCur for a connection exits cleanly and rolled back if it
+    exits with an exception.  Nested getCur blocks share the enclosing
+    block's connection and transaction; with settings.DBPOOL, the
+    connection is kept open for the thread's next block.  Uses the current
+    room's database unless given another database file."""
     con = None
     cur = None
+    entry = None
+    start = None
+    def __init__(self, dbfile=None):
+        self.dbfile = dbfile
     def __enter__(self):
-        self.con = sqlite3.connect(settings.DBFILE)
+        self.start = time.perf_counter()
+        if settings.DBPOOL:
+            self.entry = pooled_connection(self.dbfile)
+        else:
+            self.entry = open_connection(self.dbfile)
+        self.entry['depth'] += 1
+        self.con = self.entry['con']
         self.cur = self.con.cursor()
-        self.cur.execute("PRAGMA foreign_keys = ON;")
         return self.cur
     def __exit__(self, type, value, traceback):
-        if self.cur and self.con and not value:
-            self.cur.close()
+        self.cur.close()
+        self.entry['depth'] -= 1
+        if self.entry['depth'] > 0:
+            return False
+        if value is None:
             self.con.commit()
+        else:
+            self.con.rollback()
+        if not settings.DBPOOL:
+            del _open.connections[current_dbfile(self.dbfile)]
             self.con.close()
+        if settings.METRICS:
+            metrics.transaction(time.perf_counter() - self.start)
 
         return False
 
@@ -75,13 +170,74 @@ schema = collections.OrderedDict({
     'Events': [
         'Type INTEGER NOT NULL',
         'Time TEXT',
-        'Data TEXT'
+        'Data TEXT',
+        'Count INTEGER NOT NULL DEFAULT 1'
+    ],
+    'EventRollups': [
+        'Type TEXT NOT NULL',
+        'Day DATE NOT NULL',
+        'Hour TEXT NOT NULL',
+        'Count INTEGER NOT NULL DEFAULT 0',
+        'UNIQUE (Type, Day, Hour)'
     ]
 })
 
+# Secondary indexes for tables in schema, as index name: column list with
+# an optional WHERE clause for partial indexes
+indexes = collections.OrderedDict({
+    'Tables': collections.OrderedDict({
+        'Tables_Type': '(Type, Playing, Started)',
+        'Tables_Scheduled': '(Type, ScheduledStart) WHERE ScheduledStart IS NOT NULL'
+    }),
+    'People': collections.OrderedDict({
+        'People_Added': '(Added)'
+    }),
+    'Players': collections.OrderedDict({
+        'Players_TableId': '(TableId)',
+        'Players_PersonId': '(PersonId)'
+    }),
+    'Queue': collections.OrderedDict({
+        'Queue_Type': '(Type)'
+    }),
+    'Events': collections.OrderedDict({
+        'Events_Type_Time': '(Type, Time)'
+    })
+})
+
+def schema_fingerprint():
+    """A number identifying the schema and indexes above, kept in the
+    database's user_version once it has been brought up to date"""
+    spec = json.dumps([schema, indexes]).encode()
+    return int(hashlib.sha1(spec).hexdigest()[:7], 16) or 1
+
+def schema_current(dbfile=None):
+    """Whether a database, the current room's by default, is recorded as
+    up to date with the schema"""
+    with getCur(dbfile) as cur:
+        cur.execute("PRAGMA user_version")
+        return cur.fetchone()[0] == schema_fingerprint()
+
+def needs_migration(dbfile):
+    """Whether bringing an existing database up to date with the schema
+    might ask about the changes: it has tables but isn't recorded as up to
+    date.  New and empty databases are only ever created."""
+    if not os.path.exists(dbfile):
+        return False
+    with getCur(dbfile) as cur:
+        cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table'")
+        if cur.fetchone()[0] == 0:
+            return False
+    return not schema_current(dbfile)
+
 def init(force=False):
+    """Bring the current database up to date with the schema, unless it is
+    recorded as up to date already"""
     warnings.filterwarnings('ignore', r'Table \'[^\']*\' already exists')
 
+    if schema_current():
+        return
+    fingerprint = schema_fingerprint()
+
     global schema
     independent_tables = []
     dependent_tables = []
@@ -93,6 +249,7 @@ def init(force=False):
 
     to_check = collections.deque(independent_tables + dependent_tables)
     checked = set()
+    current = True
     max_count = len(independent_tables) + len(dependent_tables) ** 2 / 2
     count = 0
     while count < max_count and len(to_check) > 0:
@@ -101,17 +258,31 @@ def init(force=False):
         if set(parent_tables(table)) - checked:
             to_check.append(table)
         else:
-            check_table_schema(table, force=force)
+            current = check_table_schema(table, force=force) and current
             checked.add(table)
         count += 1
 
+    # Only skip checking next time if no change was declined
+    if current and len(to_check) == 0:
+        with getCur() as cur:
+            cur.execute("PRAGMA user_version = {0}".format(fingerprint))
+
 def make_backup():
-    backupdb = datetime.datetime.now().strftime(settings.DBDATEFORMAT) + "-" + os.path.split(settings.DBFILE)[1]
+    dbfile = current_dbfile()
+    backupdb = datetime.datetime.now().strftime(settings.DBDATEFORMAT) + "-" + os.path.split(dbfile)[1]
     backupdb = os.path.join(settings.DBBACKUPS, backupdb)
-    print("Making backup of database {0} to {1}".format(settings.DBFILE, backupdb))
+    print("Making backup of database {0} to {1}".format(dbfile, backupdb))
     if not os.path.isdir(settings.DBBACKUPS):
         os.mkdir(settings.DBBACKUPS)
-    shutil.copyfile(settings.DBFILE, backupdb)
+    # Copy through sqlite, which includes changes still in the WAL file and
+    # gives a consistent copy while other connections are open
+    source = sqlite3.connect(dbfile)
+    backup = sqlite3.connect(backupdb)
+    try:
+        source.backup(backup)
+    finally:
+        backup.close()
+        source.close()
 
 fkey_pattern = re.compile(
     r'.*FOREIGN\s+KEY\s*\((\w+)\)\s*REFERENCES\s+(\w+)\s*\((\w+)\).*',
@@ -135,6 +306,7 @@ def check_table_schema(tablename, force=False, backupname="_backup"):
     new version of the table.
     For really complex schema changs, move the old database aside and
     either build from scratch or manually alter it.
+    Returns whether the table matches the schema afterwards.
     """
     table_fields = schema[tablename]
     with getCur() as cur:
@@ -145,11 +317,13 @@ def check_table_schema(tablename, force=False, backupname="_backup"):
         if len(actual_fields) == 0:
             cur.execute("CREATE TABLE IF NOT EXISTS {0} ({1});".format(
                 tablename, ", ".join(table_fields)))
+            return check_table_indexes(tablename, cur, force=True)
         else:
             fields_to_add = missing_fields(table_fields, actual_fields)
             fkeys_to_add = missing_constraints(table_fields, actual_fkeys)
             altered = altered_fields(table_fields, actual_fields)
             deleted = deleted_fields(table_fields, actual_fields)
+            current = True
             if (len(fields_to_add) > 0 and len(fkeys_to_add) == 0 and
                 len(altered) == 0):
                 # Only new fields to add
@@ -159,6 +333,8 @@ def check_table_schema(tablename, force=False, backupname="_backup"):
                     for field_spec in fields_to_add:
                         cur.execute("ALTER TABLE {0} ADD COLUMN {1};".format(
                             tablename, field_spec))
+                else:
+                    current = False
             elif len(fkeys_to_add) > 0 or len(altered) > 0:
                 # Fields have changed significantly; try copying old into new
                 if force or util.prompt(
@@ -184,6 +360,52 @@ def check_table_schema(tablename, force=False, backupname="_backup"):
                     cur.execute(sql)
                     sql = "DROP TABLE {0};".format(backup)
                     cur.execute(sql)
+                else:
+                    current = False
+        return check_table_indexes(tablename, cur, force=force) and current
+
+def index_sql(tablename, indexname):
+    return "CREATE INDEX {0} ON {1} {2}".format(
+        indexname, tablename, indexes[tablename][indexname])
+
+def normalize_sql(sql):
+    return re.sub(r'\s+', '', sql).upper()
+
+def check_table_indexes(tablename, cur, force=False):
+    """Compare a table's existing indexes with those specified in indexes
+    above, dropping ones no longer specified and (re)creating missing or
+    altered ones.  Indexes sqlite makes for constraints are left alone.
+    Returns whether the indexes match afterwards."""
+    table_indexes = indexes.get(tablename, {})
+    cur.execute("SELECT name, sql FROM sqlite_master "
+                "WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+                (tablename,))
+    actual_indexes = dict(cur.fetchall())
+    altered = [
+        name for name in table_indexes if name in actual_indexes and
+        normalize_sql(actual_indexes[name]) !=
+        normalize_sql(index_sql(tablename, name))]
+    to_drop = [
+        name for name in actual_indexes if name not in table_indexes] + altered
+    to_create = [
+        name for name in table_indexes if name not in actual_indexes] + altered
+    current = True
+    if len(to_drop) > 0 and (force or util.prompt(
+            "SCHEMA CHANGE: Drop index {0} from table {1}".format(
+                ", ".join(to_drop), tablename))):
+        for name in to_drop:
+            cur.execute("DROP INDEX {0};".format(name))
+    elif len(to_drop) > 0:
+        to_create = [name for name in to_create if name not in altered]
+        current = False
+    if len(to_create) > 0 and (force or util.prompt(
+            "SCHEMA CHANGE: Add index {0} to table {1}".format(
+                ", ".join(to_create), tablename))):
+        for name in to_create:
+            cur.execute(index_sql(tablename, name) + ";")
+    elif len(to_create) > 0:
+        current = False
+    return current
 
 def words(spec):
     return re.findall(r'\w+', spec)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+import collections
+import datetime
+import heapq
+
+import util
+
+def tableSlots(tables, seated, duration, playercount, now):
+    """When each table will next have room and how many seats it will
+    have then, as (time, seats).  Playing tables free up when their game
+    ends, empty and partly filled tables when they start, which is now or
+    at their scheduled start.  A full table that hasn't started will have
+    room after one game."""
+    game = datetime.timedelta(minutes = duration or 0)
+    slots = []
+    for table in tables:
+        if table['Playing']:
+            free = now
+            if table['Started'] is not None:
+                free = max(now, util.parseTime(table['Started']) + game)
+            slots.append((free, playercount))
+            continue
+        start = now
+        if table['ScheduledStart'] is not None:
+            start = max(now, util.parseTime(table['ScheduledStart']))
+        taken = seated.get(table['Id'], 0)
+        if taken < playercount:
+            slots.append((start, playercount - taken))
+        else:
+            slots.append((start + game, playercount))
+    return slots
+
+def estimate(slots, count, duration, playercount):
+    """Simulate seating a queue of `count` people at tables with the given
+    slots, always taking whichever table has room soonest.  Every table
+    that is used opens up again one game later.  Returns count + 1 ETAs,
+    the last being for the next person to join; an ETA is None if they
+    will never be seated."""
+    etas = []
+    heap = [(free, order, seats) for order, (free, seats) in enumerate(slots)
+            if seats > 0]
+    heapq.heapify(heap)
+    initial = len(heap)
+    order = len(slots)
+    game = datetime.timedelta(minutes = duration or 0)
+    recycle = bool(duration and playercount)
+    while len(heap) > 0 and len(etas) <= count and initial > 0:
+        free, position, seats = heapq.heappop(heap)
+        if position < len(slots):
+            initial -= 1
+        etas.extend([free] * min(seats, count + 1 - len(etas)))
+        if recycle:
+            heapq.heappush(heap, (free + game, order, playercount))
+            order += 1
+    # Once every slot has been used, the tables come round in the same
+    # order each game, so the rest of the queue is seated a round at a time
+    if len(heap) > 0 and len(etas) <= count:
+        nextRound = []
+        for free, position, seats in sorted(heap):
+            nextRound.extend([free] * playercount)
+        while len(etas) <= count:
+            etas.extend(nextRound)
+            nextRound = [free + game for free in nextRound]
+        del etas[count + 1:]
+    etas.extend([None] * (count + 1 - len(etas)))
+    return etas
+
+def tickSeconds(times):
+    """The seconds past the minute of the given timestamps, ignoring any
+    that are None"""
+    return set(util.parseTime(time).second for time in times if time is not None)
+
+class Estimates():
+    """Queue order and ETAs per table type for a RoomState, and anything
+    worked out from them, such as the rows the queue APIs send.  A type is
+    only recomputed when its entry in the room's typeVersions changes, or
+    as time passes when a count of minutes to or from one of its times
+    ticks over: those of its tables and of when its people were queued."""
+    def __init__(self):
+        self.room = None
+        self.cache = {}
+
+    def entry(self, room, tabletype):
+        """The cache entry for a type, starting a new one when its version
+        changes"""
+        if room is not self.room:
+            self.room = room
+            self.cache.clear()
+        version = room.typeVersions[tabletype]
+        cached = self.cache.get(tabletype)
+        if cached is None or cached['version'] != version:
+            people = room.queued(tabletype)
+            tables = [table for table in room.tables.values()
+                    if table['Type'] == tabletype]
+            cached = self.cache[tabletype] = {'version': version, 'tick': None,
+                'people': people,
+                'seconds': tickSeconds([person['Added'] for person in people] +
+                    [table['Started'] for table in tables] +
+                    [table['ScheduledStart'] for table in tables])}
+        return cached
+
+    def seconds(self, room, tabletype):
+        """The seconds past the minute at which the times shown for a
+        type's queue tick over"""
+        return self.entry(room, tabletype)['seconds']
+
+    def get(self, room, tabletype, now):
+        """Return the people queued for a type, oldest first, and their
+        ETAs as from estimate()"""
+        cached = self.entry(room, tabletype)
+        tick = util.lastTick(cached['seconds'], now)
+        if cached['tick'] == tick:
+            return cached['people'], cached['etas']
+        people = cached['people']
+
+        info = room.types[tabletype]
+        tables = [table for table in room.tables.values()
+                if table['Type'] == tabletype]
+        ids = set(table['Id'] for table in tables)
+        seated = collections.Counter(table for table in room.players.values()
+                if table in ids)
+        slots = tableSlots(tables, seated, info['Duration'], info['Players'], now)
+        etas = estimate(slots, len(people), info['Duration'], info['Players'])
+        cached.update(tick = tick, etas = etas, derived = {})
+        return people, etas
+
+    def derived(self, room, tabletype, now, name, compute):
+        """Return compute(people, etas, now) for a type, kept under name
+        for as long as its ETAs are"""
+        people, etas = self.get(room, tabletype, now)
+        derived = self.cache[tabletype]['derived']
+        if name not in derived:
+            derived[name] = compute(people, etas, now)
+        return derived[name]
@@ -1,22 +1,252 @@
 #!/usr/bin/env python3
 
+import atexit
+import collections
+import glob
+import gzip
+import hashlib
 import json
 import logging
+import logging.handlers
+import os
+import queue
+import threading
 import datetime
 
 import db
+import settings
 
 log = logging.getLogger("mahjong")
-logging.basicConfig(filename = "mahjong.log", level=logging.INFO)
-logging.getLogger().addHandler(logging.StreamHandler())
 
-def logEvent(eventType, data = None):
+# Log records are handed to a background thread that writes mahjong.log and
+# the console, so request handlers never wait on file IO
+logQueue = queue.Queue()
+fileHandler = logging.FileHandler("mahjong.log")
+fileHandler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+logListener = logging.handlers.QueueListener(
+        logQueue, fileHandler, logging.StreamHandler())
+logging.getLogger().addHandler(logging.handlers.QueueHandler(logQueue))
+logging.getLogger().setLevel(logging.INFO)
+logListener.start()
+
+# Seconds between checks for events old enough to archive
+ARCHIVE_CHECK_SECONDS = 3600
+
+# Events read from the Events table at a time by query()
+QUERY_CHUNK = 1000
+
+# Events waiting to be written, as (database file, type, time, data, count)
+buffer = collections.deque()
+bufferLock = threading.Lock()
+stats = {'queued': 0, 'flushed': 0, 'dropped': 0}
+
+def logEvent(eventType, data = None, count = 1):
+    """Record an event.  An event can stand for several things happening
+    at once, such as a group of people signing up, and count says how
+    many for the hourly statistics."""
     if data is not None:
         data = json.dumps(data)
     else:
         data = ""
+    now = datetime.datetime.now()
+    with bufferLock:
+        if len(buffer) >= settings.EVENT_BUFFER:
+            stats['dropped'] += 1
+        else:
+            buffer.append((db.current_dbfile(), eventType,
+                now.strftime('%Y-%m-%d %H:%M:%S'), data, count))
+            stats['queued'] += 1
+    log.info(str(now) + "|" + eventType + "|" + data)
+
+def flush():
+    """Write all buffered events, one transaction per database"""
+    with bufferLock:
+        pending = list(buffer)
+        buffer.clear()
+    flushed = True
+    batches = collections.OrderedDict()
+    for dbfile, eventType, time, data, count in pending:
+        batches.setdefault(dbfile, []).append((eventType, time, data, count))
+    for dbfile, batch in batches.items():
+        rollups = collections.Counter()
+        for eventType, time, data, count in batch:
+            rollups[eventType, time[:10], time[11:13]] += count
+        try:
+            with db.getCur(dbfile) as cur:
+                cur.executemany(
+                        "INSERT INTO Events(Type, Time, Data, Count) VALUES (?, ?, ?, ?)",
+                        batch)
+                cur.executemany(
+                        "INSERT INTO EventRollups(Type, Day, Hour, Count) VALUES (?, ?, ?, ?)"
+                        " ON CONFLICT(Type, Day, Hour) DO UPDATE SET Count = Count + excluded.Count",
+                        [key + (count,) for key, count in rollups.items()])
+            stats['flushed'] += len(batch)
+        except:
+            log.exception("Failed to write {0} events to {1}".format(len(batch), dbfile))
+            with bufferLock:
+                requeue = [(dbfile,) + event for event in batch]
+                requeue = requeue[:max(0, settings.EVENT_BUFFER - len(buffer))]
+                stats['dropped'] += len(batch) - len(requeue)
+                buffer.extendleft(reversed(requeue))
+            flushed = False
+    return flushed
+
+def rebuildRollups():
+    """Recount EventRollups, the per type, day and hour event counts, from
+    the Events table and the archive"""
+    flush()
+    archived = collections.Counter()
+    for day, path in archiveFiles():
+        for eventType, time, data, count in readArchive(path):
+            archived[eventType, time[:10], time[11:13]] += count
     with db.getCur() as cur:
+        cur.execute("DELETE FROM EventRollups")
         cur.execute(
-                "INSERT INTO Events(Type, Time, Data) VALUES (?, datetime('now', 'localtime'), ?)",
-                (eventType, data))
-    log.info(str(datetime.datetime.now()) + "|" + eventType + "|" + data)
+                "INSERT INTO EventRollups(Type, Day, Hour, Count)"
+                " SELECT Type, date(Time), strftime('%H', Time), SUM(Count) FROM Events"
+                " WHERE Time IS NOT NULL GROUP BY 1, 2, 3")
+        cur.executemany(
+                "INSERT INTO EventRollups(Type, Day, Hour, Count) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT(Type, Day, Hour) DO UPDATE SET Count = Count + excluded.Count",
+                [key + (count,) for key, count in archived.items()])
+
+def checkRollups():
+    """Build the rollups for a database that has events but none yet"""
+    with db.getCur() as cur:
+        cur.execute("SELECT EXISTS(SELECT 1 FROM Events),"
+                " EXISTS(SELECT 1 FROM EventRollups)")
+        hasEvents, hasRollups = cur.fetchone()
+    if hasEvents and not hasRollups:
+        rebuildRollups()
+
+# Events older than settings.EVENT_RETENTION_DAYS are moved from the Events
+# table into the archive, one gzipped file of JSON lines per day holding
+# [type, time, data, count] for each event of the day, oldest first.  A
+# day's file is named after a hash of its contents, so archiving the same
+# events again after a crash replaces the file rather than adding another.
+
+def archiveDirectory(dbfile=None):
+    """The archive of a database, the current room's by default"""
+    dbfile = db.current_dbfile(dbfile)
+    return os.path.join(os.path.dirname(os.path.abspath(dbfile)), settings.EVENT_ARCHIVE,
+            os.path.splitext(os.path.basename(dbfile))[0])
+
+def archiveFiles(dbfile=None):
+    """The archive files of a database, as (day, path), oldest first"""
+    paths = glob.glob(os.path.join(archiveDirectory(dbfile), "*.jsonl.gz"))
+    return sorted((os.path.basename(path)[:10], path) for path in paths)
+
+def readArchive(path):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            yield tuple(json.loads(line))
+
+def archiveCutoff(now=None):
+    """The time before which events are archived"""
+    now = now or datetime.datetime.now()
+    cutoff = now.date() - datetime.timedelta(days=settings.EVENT_RETENTION_DAYS)
+    return cutoff.strftime('%Y-%m-%d')
+
+def archiveDay(cutoff=None, dbfile=None):
+    """Move the events of the oldest day before cutoff out of a database's
+    Events table, the current room's by default, into the archive.
+    Returns the day archived, or None if there were no events to
+    archive."""
+    cutoff = cutoff or archiveCutoff()
+    dbfile = db.current_dbfile(dbfile)
+    with db.getCur(dbfile) as cur:
+        cur.execute("SELECT Time FROM Events WHERE Time IS NOT NULL AND Time < ?"
+                " ORDER BY rowid LIMIT 1", (cutoff,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        day = row[0][:10]
+        end = (datetime.datetime.strptime(day, '%Y-%m-%d') +
+                datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+        cur.execute("SELECT Type, Time, Data, Count FROM Events"
+                " WHERE Time >= ? AND Time < ? ORDER BY rowid", (day, end))
+        archived = cur.fetchall()
+        encode = json.JSONEncoder(separators=(',', ':')).encode
+        data = "".join(encode(event) + "\n" for event in archived).encode("utf-8")
+        directory = archiveDirectory(dbfile)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "{0}.{1}.jsonl.gz".format(
+            day, hashlib.sha1(data).hexdigest()[:10]))
+        with open(path + ".tmp", "wb") as f:
+            f.write(gzip.compress(data, 6, mtime=0))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        cur.execute("DELETE FROM Events WHERE Time >= ? AND Time < ?", (day, end))
+    log.info("Archived {0} events of {1} to {2}".format(len(archived), day, path))
+    return day
+
+def archive(cutoff=None):
+    """Archive all the current room's events before cutoff.  Returns the
+    days archived."""
+    days = []
+    day = archiveDay(cutoff)
+    while day is not None:
+        days.append(day)
+        day = archiveDay(cutoff)
+    return days
+
+def eventTime(time):
+    if isinstance(time, datetime.datetime):
+        return time.strftime('%Y-%m-%d %H:%M:%S')
+    return time
+
+def query(start=None, end=None, types=None, dbfile=None):
+    """The current room's events from start up to end, of the given types,
+    whether archived or still in the Events table, as (type, time, data,
+    count), oldest first.  Times are datetimes or strings as logged.  Only
+    the archive files of days in range are read, and the Events table is
+    read QUERY_CHUNK events at a time, so this can stream any number of
+    events."""
+    dbfile = db.current_dbfile(dbfile)
+    start = eventTime(start)
+    end = eventTime(end)
+    types = set(types) if types is not None else None
+    def included(eventType, time):
+        return ((types is None or eventType in types) and
+                (start is None or time >= start) and (end is None or time < end))
+    def events():
+        for day, path in archiveFiles(dbfile):
+            if (start is None or day >= start[:10]) and (end is None or day <= end[:10]):
+                for event in readArchive(path):
+                    if included(event[0], event[1]):
+                        yield event
+        conditions = ["Time IS NOT NULL"]
+        parameters = []
+        if start is not None:
+            conditions.append("Time >= ?")
+            parameters.append(start)
+        if end is not None:
+            conditions.append("Time < ?")
+            parameters.append(end)
+        if types is not None:
+            conditions.append("Type IN ({0})".format(", ".join("?" * len(types))))
+            parameters.extend(sorted(types))
+        last = 0
+        while True:
+            with db.getCur(dbfile) as cur:
+                cur.execute("SELECT rowid, Type, Time, Data, Count FROM Events"
+                        " WHERE rowid > ? AND {0} ORDER BY rowid LIMIT ?".format(
+                            " AND ".join(conditions)),
+                        [last] + parameters + [QUERY_CHUNK])
+                rows = cur.fetchall()
+            for row in rows:
+                yield row[1:]
+            if len(rows) < QUERY_CHUNK:
+                return
+            last = rows[-1][0]
+    return events()
+
+def close():
+    """Write any buffered events, close the database connections so their
+    files are complete on disk, and stop the log writer thread"""
+    flush()
+    db.close()
+    logListener.stop()
+
+atexit.register(close)
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""Export a room's event log, people and seating history for analysis, as
+JSON lines or CSV.
+
+    python export.py <dataset> [options] > file
+"""
+
+import argparse
+import collections
+import csv
+import datetime
+import io
+import json
+import os
+import sys
+import zlib
+
+import tornado.ioloop
+import tornado.web
+
+import db
+import events
+import rooms
+
+# Rows formatted and sent at a time
+CHUNK = 500
+
+# Events recording people moving between the queue and tables
+SEATING_EVENTS = ['groupqueueadd', 'playerqueueadd', 'playerqueuemove',
+        'playermovetotable', 'playerdelete', 'tablefill', 'tablestart', 'tableclear']
+
+def eventRows(start, end, types, dbfile):
+    for eventType, time, data, count in events.query(start, end, types, dbfile):
+        yield eventType, time, json.loads(data) if data else None, count
+
+def seatingRows(start, end, types, dbfile):
+    """The seating events as time, type, table, table type, the people
+    moved and how many people the event stands for"""
+    types = SEATING_EVENTS if types is None else [t for t in types if t in SEATING_EVENTS]
+    for eventType, time, data, count in eventRows(start, end, types, dbfile):
+        table = tableType = None
+        people = []
+        if eventType == 'groupqueueadd':
+            people, names, tableType = data
+        elif eventType == 'playerqueueadd':
+            people, tableType = [data[0]], data[2]
+        elif eventType == 'playerqueuemove':
+            people, tableType = [data[0]], data[1]
+        elif eventType == 'playermovetotable':
+            people, table = [data[0]], data[1]
+        elif eventType == 'playerdelete':
+            people = [data]
+        elif eventType == 'tablefill':
+            table = data[0]
+        else:
+            table = data
+        yield time, eventType, table, tableType, people, count
+
+def peopleRows(start, end, types, dbfile):
+    """Everyone in the room now, with where they are, by the time they
+    were added and, if types are given, only those queued for or seated at
+    tables of those types"""
+    conditions = []
+    parameters = []
+    if start is not None:
+        conditions.append("People.Added >= ?")
+        parameters.append(start)
+    if end is not None:
+        conditions.append("People.Added < ?")
+        parameters.append(end)
+    if types is not None:
+        conditions.append("COALESCE(Tables.Type, Queue.Type) IN ({0})".format(
+            ", ".join("?" * len(types))))
+        parameters.extend(types)
+    last = 0
+    while True:
+        with db.getCur(dbfile) as cur:
+            cur.execute("SELECT People.Id, People.Name, People.Phone IS NOT NULL,"
+                    " People.Notified, People.Added, Players.TableId,"
+                    " COALESCE(Tables.Type, Queue.Type) FROM People"
+                    " LEFT JOIN Players ON Players.PersonId = People.Id"
+                    " LEFT JOIN Tables ON Tables.Id = Players.TableId"
+                    " LEFT JOIN Queue ON Queue.Person = People.Id"
+                    " WHERE {0} ORDER BY People.Id LIMIT ?".format(
+                        " AND ".join(["People.Id > ?"] + conditions)),
+                    [last] + parameters + [CHUNK])
+            rows = cur.fetchall()
+        for row in rows:
+            yield row[:2] + (bool(row[2]), bool(row[3])) + row[4:]
+        if len(rows) < CHUNK:
+            return
+        last = rows[-1][0]
+
+# Each dataset's columns and the function giving its rows from start up to
+# end, of the given types, from a database file
+datasets = collections.OrderedDict([
+    ('events', (['Type', 'Time', 'Data', 'Count'], eventRows)),
+    ('seating', (['Time', 'Type', 'Table', 'TableType', 'People', 'Count'], seatingRows)),
+    ('people', (['Id', 'Name', 'HasPhone', 'Notified', 'Added', 'Table', 'TableType'],
+        peopleRows)),
+])
+
+formats = {'ndjson': "application/x-ndjson", 'csv': "text/csv"}
+
+def csvValue(value):
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    return value
+
+def chunks(dataset, format, start=None, end=None, types=None, dbfile=None):
+    """A dataset of a database, the current room's by default, formatted
+    as ndjson or csv, as strings of up to CHUNK rows each.  Rows are read
+    as they are sent, so this takes the same memory however many there
+    are.  It can be read on another thread, as it reads the database file
+    it was made for."""
+    columns, rows = datasets[dataset]
+    rows = rows(start, end, types, db.current_dbfile(dbfile))
+    def formatted():
+        batch = []
+        if format == 'csv':
+            out = io.StringIO()
+            writer = csv.writer(out, lineterminator="\n")
+            writer.writerow(columns)
+            yield out.getvalue()
+        for row in rows:
+            batch.append(row)
+            if len(batch) == CHUNK:
+                yield formatRows(format, columns, batch)
+                batch = []
+        if len(batch) > 0:
+            yield formatRows(format, columns, batch)
+    return formatted()
+
+def formatRows(format, columns, rows):
+    if format == 'ndjson':
+        return "".join(json.dumps(dict(zip(columns, row))) + "\n" for row in rows)
+    out = io.StringIO()
+    csv.writer(out, lineterminator="\n").writerows(
+            [csvValue(value) for value in row] for row in rows)
+    return out.getvalue()
+
+def parseTime(value):
+    """A time from a date or date and time, as the event log stores it, or
+    None if not given"""
+    if value is None or value == "":
+        return None
+    for format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, format).strftime('%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            pass
+    raise ValueError("Times must be given as YYYY-MM-DD or YYYY-MM-DD HH:MM:SS")
+
+class ExportHandler(tornado.web.RequestHandler):
+    """Streams a dataset with chunked encoding, reading each chunk on the
+    room's worker thread and waiting for it to be sent before reading the
+    next.  Arguments are format (ndjson or csv), start and end times, any
+    number of type arguments, and gzip=1 to compress it as it is sent."""
+    async def get(self, dataset):
+        format = self.get_argument("format", "ndjson")
+        if dataset not in datasets:
+            raise tornado.web.HTTPError(404)
+        if format not in formats:
+            raise tornado.web.HTTPError(400, "Unknown format")
+        try:
+            start = parseTime(self.get_argument("start", None))
+            end = parseTime(self.get_argument("end", None))
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+        types = self.get_arguments("type") or None
+        filename = "{0}.{1}".format(dataset, format)
+        compressor = None
+        if self.get_argument("gzip", "0") == "1":
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self.set_header("Content-Type", "application/gzip")
+            filename += ".gz"
+        else:
+            self.set_header("Content-Type", formats[format] + "; charset=UTF-8")
+        self.set_header("Content-Disposition", 'attachment; filename="{0}"'.format(filename))
+        events.flush()
+        room = rooms.get()
+        formatted = chunks(dataset, format, start, end, types, room.dbfile)
+        while True:
+            chunk = await tornado.ioloop.IOLoop.current().run_in_executor(
+                    room.executor(), next, formatted, None)
+            if chunk is None:
+                break
+            data = chunk.encode("utf-8")
+            if compressor is not None:
+                data = compressor.compress(data)
+            if len(data) > 0:
+                self.write(data)
+                await self.flush()
+        if compressor is not None:
+            self.write(compressor.flush())
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("dataset", choices=list(datasets))
+    parser.add_argument("--format", choices=sorted(formats), default="ndjson")
+    parser.add_argument("--start", help="Earliest time, YYYY-MM-DD [HH:MM:SS]")
+    parser.add_argument("--end", help="Time to stop before, YYYY-MM-DD [HH:MM:SS]")
+    parser.add_argument("--type", action="append", dest="types",
+            help="Only this type of event or table; may be repeated")
+    parser.add_argument("--room", default="", help="Name of the room to export")
+    parser.add_argument("--gzip", action="store_true", help="Gzip the output")
+    parser.add_argument("--output", help="File to write instead of standard output")
+    args = parser.parse_args()
+    try:
+        start = parseTime(args.start)
+        end = parseTime(args.end)
+    except ValueError as e:
+        parser.error(str(e))
+    configured = rooms.configured()
+    if args.room != "":
+        if args.room not in configured:
+            parser.error("Unknown room {0}".format(args.room))
+        rooms.add(args.room, configured[args.room])
+    # The schema is not brought up to date here, as that may ask questions
+    # on standard output, which may be the export
+    dbfile = rooms.rooms[args.room].dbfile
+    if not os.path.exists(dbfile):
+        parser.error("No database {0}".format(dbfile))
+    if not db.schema_current(dbfile):
+        parser.error("The schema of {0} is out of date; start the server once to "
+                "update it".format(dbfile))
+    output = open(args.output, "wb") if args.output else sys.stdout.buffer
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if args.gzip else None
+    def export():
+        for chunk in chunks(args.dataset, args.format, start, end, args.types, dbfile):
+            data = chunk.encode("utf-8")
+            output.write(compressor.compress(data) if compressor else data)
+        if compressor is not None:
+            output.write(compressor.flush())
+    try:
+        export()
+    finally:
+        if args.output:
+            output.close()
+
+if __name__ == "__main__":
+    main()
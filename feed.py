@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+import datetime
+import json
+import time
+
+import tornado.iostream
+import tornado.queues
+import tornado.util
+import tornado.web
+import tornado.websocket
+
+import db
+import rooms
+import util
+
+# Things clients can subscribe to.  'room' covers tables, players and the
+# queue.
+topics = ['room', 'tabletypes', 'announcement', 'teachingsessions', 'preferences']
+
+# Version of the compact format of the read APIs that support it, asked
+# for with ?compact=<version>
+COMPACT_VERSION = 1
+
+# Seconds between keepalive comments on event streams
+STREAM_KEEPALIVE = 15
+
+class Feed():
+    """A room's feed version and connected clients"""
+    def __init__(self):
+        # Start from the clock so clients reconnecting after a restart
+        # never see a version they already have
+        self.version = int(time.time())
+        # Values worked out from the room as of this version
+        self.cached = {}
+        self.pending = set()
+        self.sockets = set()
+        self.streams = set()
+
+    def message(self, changed):
+        return json.dumps({'version': self.version, 'topics': sorted(changed)})
+
+    def cache(self, key, compute):
+        """compute(), kept under key until the version changes"""
+        if self.cached.get('version') != self.version:
+            self.cached = {'version': self.version}
+        if key not in self.cached:
+            self.cached[key] = compute()
+        return self.cached[key]
+
+    def publish(self, *changed):
+        self.pending.update(changed)
+        if db.inTransaction() or len(self.pending) == 0:
+            return
+        self.version += 1
+        msg = self.message(self.pending)
+        self.pending.clear()
+        for socket in list(self.sockets):
+            try:
+                socket.write_message(msg)
+            except tornado.websocket.WebSocketClosedError:
+                self.sockets.discard(socket)
+        for stream in self.streams:
+            stream.put_nowait(msg)
+
+def current():
+    """The current room's feed"""
+    return rooms.get().local('feed', Feed)
+
+def publish(*changed):
+    """Record that the given topics changed and, unless a database
+    transaction is still open, bump the current room's feed version and
+    push the pending changes to every client connected to it"""
+    current().publish(*changed)
+
+class VersionedHandler(tornado.web.RequestHandler):
+    """Base for read APIs whose response only changes when the feed
+    version does.  GETs carry the version as their ETag and are answered
+    with 304 Not Modified, without running get(), when the client already
+    has it.  Handlers whose output also counts minutes to or from times
+    set timed, so the tag also changes as those counts tick over, and give
+    the seconds past the minute they tick over at from tickSeconds(); by
+    default they tick over at the start of each minute.
+
+    Responses may be gzipped, so the tag is weak and names the encoding
+    the client accepts, and responses vary on Accept-Encoding."""
+    timed = False
+    def tickSeconds(self):
+        return ()
+    def versionTag(self):
+        feed = current()
+        tag = str(feed.version)
+        if self.timed:
+            seconds = feed.cache(type(self), self.tickSeconds)
+            tag += "-{0}".format(util.epoch(util.lastTick(seconds, datetime.datetime.now())))
+        # The compact and full formats of a version are different bodies
+        compact = self.get_argument("compact", None)
+        if compact is not None:
+            tag += "-c{0}".format(compact)
+        if "gzip" in self.request.headers.get("Accept-Encoding", ""):
+            tag += "-gzip"
+        return 'W/"{0}"'.format(tag)
+    def compute_etag(self):
+        return self.versionTag()
+    def compact(self):
+        """Whether the compact format was asked for"""
+        version = self.get_argument("compact", None)
+        if version is None:
+            return False
+        if version != str(COMPACT_VERSION):
+            raise tornado.web.HTTPError(400, "Unsupported compact format version")
+        return True
+    def prepare(self):
+        # Tornado adds Vary itself when it compresses responses
+        if not self.settings.get("compress_response"):
+            self.set_header("Vary", "Accept-Encoding")
+        if self.request.method in ("GET", "HEAD"):
+            self.set_etag_header()
+            if self.check_etag_header():
+                self.set_status(304)
+                self.finish()
+
+class FeedSocketHandler(tornado.websocket.WebSocketHandler):
+    def open(self):
+        self.feed = current()
+        self.feed.sockets.add(self)
+        self.write_message(self.feed.message(topics))
+    def on_close(self):
+        self.feed.sockets.discard(self)
+
+class FeedStreamHandler(tornado.web.RequestHandler):
+    """Server-sent events fallback for clients without WebSockets"""
+    async def get(self):
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        feed = current()
+        stream = tornado.queues.Queue()
+        stream.put_nowait(feed.message(topics))
+        feed.streams.add(stream)
+        try:
+            while True:
+                try:
+                    msg = await stream.get(
+                            timeout = datetime.timedelta(seconds = STREAM_KEEPALIVE))
+                    self.write("data: {0}\n\n".format(msg))
+                except tornado.util.TimeoutError:
+                    self.write(": keepalive\n\n")
+                await self.flush()
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            feed.streams.discard(stream)
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+import bisect
+import collections
+import contextvars
+import functools
+import json
+import logging
+import time
+
+import tornado.httputil
+import tornado.ioloop
+import tornado.web
+
+import settings
+
+log = logging.getLogger("mahjong")
+
+# Upper bounds of histogram buckets, in seconds for durations
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# Seconds between IOLoop lag checks
+LAG_INTERVAL = 0.1
+
+class Histogram():
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def cumulative(self):
+        """(upper bound, observations at or below it) for each bucket, the
+        last bound being infinity"""
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield bound, total
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile, or the largest
+        observation if that is in the last bucket"""
+        for bound, total in self.cumulative():
+            if total >= q * self.count:
+                return min(bound, self.max)
+        return self.max
+
+    def mean(self):
+        return self.sum / self.count if self.count > 0 else 0
+
+def newStats():
+    return {'statements': 0, 'transactions': 0, 'seconds': 0.0}
+
+# Request duration and database use by route, for all requests
+requests = collections.defaultdict(Histogram)
+statements = collections.defaultdict(lambda: Histogram(STATEMENT_BUCKETS))
+database = collections.defaultdict(newStats)
+responses = collections.Counter()
+
+# Duration of callbacks run by the IOLoop outside requests, by name
+callbacks = collections.defaultdict(Histogram)
+
+# How late the IOLoop ran a timer, and how often it was blocked for
+# longer than settings.METRICS_BLOCKED_MS
+loopLag = Histogram()
+loopBlocked = 0
+
+# The database use of the request or callback being run, if any
+current = contextvars.ContextVar('metrics', default=None)
+background = newStats()
+
+def statement(sql):
+    """sqlite3 trace callback counting statements"""
+    (current.get() or background)['statements'] += 1
+
+def transaction(seconds):
+    """Record the time spent in an outermost db.getCur block"""
+    stats = current.get() or background
+    stats['transactions'] += 1
+    stats['seconds'] += seconds
+
+class MeasuredDelegate(tornado.httputil.HTTPMessageDelegate):
+    """Wraps the delegate that runs a request handler so the database use
+    of the request is counted separately from everything else"""
+    def __init__(self, delegate, request):
+        self.delegate = delegate
+        self.request = request
+        self.request.metrics = newStats()
+    def headers_received(self, start_line, headers):
+        return self.delegate.headers_received(start_line, headers)
+    def data_received(self, chunk):
+        return self.delegate.data_received(chunk)
+    def finish(self):
+        token = current.set(self.request.metrics)
+        try:
+            return self.delegate.finish()
+        finally:
+            current.reset(token)
+    def on_connection_close(self):
+        return self.delegate.on_connection_close()
+
+def requestFinished(route, handler):
+    requests[route].observe(handler.request.request_time())
+    responses[route, handler.get_status()] += 1
+    stats = getattr(handler.request, 'metrics', None)
+    if stats is not None:
+        statements[route].observe(stats['statements'])
+        for key in stats:
+            database[route][key] += stats[key]
+
+def timed(name):
+    """Decorator recording how long each call of a function takes, and its
+    database use when not called while handling a request"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            token = None
+            if current.get() is None:
+                token = current.set(database[name])
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                callbacks[name].observe(time.perf_counter() - start)
+                if token is not None:
+                    current.reset(token)
+        return wrapper
+    return decorator
+
+def watchLoop():
+    """Start checking how late the IOLoop runs a timer due every
+    LAG_INTERVAL seconds"""
+    loop = tornado.ioloop.IOLoop.current()
+    def check(due):
+        global loopBlocked
+        lag = max(0, loop.time() - due)
+        loopLag.observe(lag)
+        if lag * 1000 > settings.METRICS_BLOCKED_MS:
+            loopBlocked += 1
+            log.warning("IOLoop blocked for {0:.0f} ms".format(lag * 1000))
+        due = loop.time() + LAG_INTERVAL
+        loop.call_at(due, check, due)
+    due = loop.time() + LAG_INTERVAL
+    loop.call_at(due, check, due)
+
+def labels(**values):
+    return "{" + ",".join('{0}="{1}"'.format(key, str(value).replace('\\', '\\\\')
+        .replace('"', '\\"')) for key, value in values.items()) + "}"
+
+def histogram(lines, name, help, histograms, label):
+    lines += ["# HELP {0} {1}".format(name, help), "# TYPE {0} histogram".format(name)]
+    for key, values in sorted(histograms.items()):
+        for bound, total in values.cumulative():
+            lines.append("{0}_bucket{1} {2}".format(name,
+                labels(**{label: key, 'le': "+Inf" if bound == float("inf") else bound}),
+                total))
+        lines.append("{0}_sum{1} {2}".format(name, labels(**{label: key}), values.sum))
+        lines.append("{0}_count{1} {2}".format(name, labels(**{label: key}), values.count))
+
+def prometheus():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    histogram(lines, "seater_request_duration_seconds",
+            "Time to handle requests by route", requests, 'route')
+    lines += ["# HELP seater_responses_total Responses by route and status",
+            "# TYPE seater_responses_total counter"]
+    for (route, code), count in sorted(responses.items()):
+        lines.append("seater_responses_total{0} {1}".format(
+            labels(route = route, code = code), count))
+    histogram(lines, "seater_request_statements",
+            "SQL statements run per request by route", statements, 'route')
+    for key, help in (('statements', "SQL statements run"),
+            ('transactions', "Database transactions"),
+            ('seconds', "Seconds spent in database transactions")):
+        name = "seater_database_{0}_total".format(key)
+        lines += ["# HELP {0} {1} by route or callback".format(name, help),
+                "# TYPE {0} counter".format(name)]
+        for route, stats in sorted(database.items()):
+            lines.append("{0}{1} {2}".format(name, labels(route = route), stats[key]))
+        lines.append("{0}{1} {2}".format(name, labels(route = "(background)"), background[key]))
+    histogram(lines, "seater_callback_duration_seconds",
+            "Time to run IOLoop callbacks by name", callbacks, 'callback')
+    lines += ["# HELP seater_ioloop_lag_seconds How late the IOLoop ran timers",
+            "# TYPE seater_ioloop_lag_seconds histogram"]
+    for bound, total in loopLag.cumulative():
+        lines.append("seater_ioloop_lag_seconds_bucket{0} {1}".format(
+            labels(le = "+Inf" if bound == float("inf") else bound), total))
+    lines += ["seater_ioloop_lag_seconds_sum {0}".format(loopLag.sum),
+            "seater_ioloop_lag_seconds_count {0}".format(loopLag.count),
+            "# HELP seater_ioloop_blocked_total Times the IOLoop was blocked",
+            "# TYPE seater_ioloop_blocked_total counter",
+            "seater_ioloop_blocked_total {0}".format(loopBlocked)]
+    return "\n".join(lines) + "\n"
+
+def summary():
+    """A compact summary of the metrics, with times in milliseconds"""
+    ms = lambda seconds: round(seconds * 1000, 2)
+    routes = {}
+    for route, values in sorted(requests.items()):
+        stats = database[route]
+        routes[route] = {'requests': values.count,
+                'mean': ms(values.mean()),
+                'p95': ms(values.quantile(0.95)),
+                'max': ms(values.max),
+                'statements': round(stats['statements'] / values.count, 1),
+                'database': ms(stats['seconds'] / values.count)}
+    return {'routes': routes,
+            'callbacks': dict((name, {'runs': values.count,
+                    'mean': ms(values.mean()),
+                    'max': ms(values.max)})
+                for name, values in sorted(callbacks.items())),
+            'loop': {'p99lag': ms(loopLag.quantile(0.99)),
+                'maxlag': ms(loopLag.max),
+                'blocked': loopBlocked}}
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        if self.get_argument("format", None) == "json":
+            self.write(json.dumps(summary()))
+        else:
+            self.set_header("Content-Type", "text/plain; version=0.0.4")
+            self.write(prometheus())
@@ -25,3 +25,69 @@
 
 #TEXT_FMT="Your table is opening up {}"
 #NOTIFY_MINUTES=10
+
+# SMS_TRANSPORT is "twilio" to text through Twilio when the settings above are
+# filled in, or "fake" to use a local stand-in gateway for testing.  Texts are
+# sent by SMS_WORKERS background workers from a queue of at most SMS_QUEUE
+# messages, at most SMS_RATE per second.  A failed text is retried SMS_RETRIES
+# times, waiting SMS_BACKOFF seconds and doubling the wait each time.
+#SMS_TRANSPORT = "twilio"
+#SMS_WORKERS = 4
+#SMS_QUEUE = 500
+#SMS_RATE = 1
+#SMS_RETRIES = 3
+#SMS_BACKOFF = 2
+
+# DBPOOL keeps one long-lived connection per thread, in WAL journal mode,
+# instead of opening a new connection for every query.  DBSYNCHRONOUS is the
+# sqlite synchronous level used for pooled connections and DBSTATEMENTCACHE
+# is the number of prepared statements cached per connection.
+#DBPOOL = True
+#DBSYNCHRONOUS = "NORMAL"
+#DBSTATEMENTCACHE = 128
+
+# STATECHECK compares the in-memory room state with the database after every
+# change and logs any differences.  It is slow; use it only for debugging.
+#STATECHECK = False
+
+# Events are buffered in memory and written to the database in one
+# transaction every EVENT_FLUSH_MS milliseconds.  At most EVENT_BUFFER events
+# are held; further events are dropped until the next write.
+#EVENT_FLUSH_MS = 1000
+#EVENT_BUFFER = 10000
+
+# Events older than EVENT_RETENTION_DAYS days are moved out of the database
+# into one gzipped file per day in the EVENT_ARCHIVE directory next to the
+# database file.  The admin page statistics still count them.  0 keeps
+# every event in the database.
+#EVENT_RETENTION_DAYS = 7
+#EVENT_ARCHIVE = "eventarchive"
+
+# People who are neither seated nor queued are deleted as soon as that
+# happens.  As a safety net, every ORPHAN_SWEEP_SECONDS seconds the next
+# ORPHAN_SWEEP_BATCH people are checked for any that were missed.
+#ORPHAN_SWEEP_SECONDS = 60
+#ORPHAN_SWEEP_BATCH = 1000
+
+# Request timings, database use and IOLoop lag are collected for
+# /api/metrics when METRICS is on.  A warning is logged whenever the
+# IOLoop is blocked for more than METRICS_BLOCKED_MS milliseconds.
+#METRICS = True
+#METRICS_BLOCKED_MS = 100
+
+# Other rooms hosted by this server as name: database file.  Each room's
+# pages and APIs are under /rooms/<name>/; the room using DBFILE is at /.
+# Rooms added while running are saved to ROOMSFILE.
+#ROOMS = {}
+#ROOMSFILE = "rooms.json"
+
+# Most operations /api/batch runs in one request
+#BATCH_MAX_OPERATIONS = 200
+
+# Serve the scripts and stylesheets bundled, minified and precompressed
+# from static/build/, which is rebuilt at startup when they change.  Turn
+# off to serve the separate source files while working on them.
+#BUNDLE_ASSETS = True
+
+# Gzip responses for clients that accept it
+#COMPRESS_RESPONSES = True
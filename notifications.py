@@ -1,90 +1,136 @@
 #!/usr/bin/env python3
 
-from twilio.rest import Client
 import tornado.web
+import collections
+import datetime
 import json
-
-import sys
+import logging
 
 import settings
 import events
-import db
+import util
+import state
+import rooms
+import scheduler
+import sms
+import metrics
+
+log = logging.getLogger("mahjong")
+
+def makeDispatcher():
+    room = rooms.get()
+    if settings.SMS_TRANSPORT == "fake":
+        transport = sms.FakeTransport()
+    elif settings.TWILIO_SID != "" and settings.TWILIO_AUTH != "" and settings.TWILIO_NUMBER != "":
+        transport = sms.TwilioTransport(settings.TWILIO_SID, settings.TWILIO_AUTH, settings.TWILIO_NUMBER)
+    else:
+        return None
+    return sms.Dispatcher(transport,
+            workers = settings.SMS_WORKERS,
+            maxqueue = settings.SMS_QUEUE,
+            retries = settings.SMS_RETRIES,
+            backoff = settings.SMS_BACKOFF,
+            rate = settings.SMS_RATE,
+            onstatus = lambda status, message: room.run(deliveryStatus, status, message))
+
+def dispatcher():
+    """The current room's text dispatcher, or None if texting isn't
+    configured"""
+    return rooms.get().local('dispatcher', makeDispatcher)
+
+def deliveryStatus(status, message):
+    if status == 'sent':
+        events.logEvent("textsent", message['person'])
+        if message.get('notify'):
+            state.get().markNotified([message['person']])
+    elif status == 'retried':
+        events.logEvent("textretry", (message['person'], message['attempts'], message['error']))
+    elif status == 'failed':
+        log.warning("Error sending text message: {0}".format(message['error']))
+        events.logEvent("textfailed", message['person'])
+    elif status == 'dropped':
+        events.logEvent("textdropped", message['person'])
 
+def deadlines():
+    """Deadlines of the current room's tables that will be about to open
+    up, keyed by table id"""
+    return rooms.get().local('deadlines', scheduler.Scheduler)
+
+def tableDeadline(table, tabletype):
+    """When the people waiting for a table should be told it's opening up,
+    or None if it isn't going to"""
+    notify = datetime.timedelta(minutes = settings.NOTIFY_MINUTES)
+    if table['ScheduledStart'] is not None:
+        return util.parseTime(table['ScheduledStart']) - notify
+    if not table['Playing']:
+        return datetime.datetime.min
+    if table['Started'] is None or tabletype['Duration'] is None:
+        return None
+    return (util.parseTime(table['Started']) +
+            datetime.timedelta(minutes = tabletype['Duration']) - notify)
+
+@metrics.timed("sendNotifications")
 def sendNotifications():
-    with db.getCur() as cur:
-        # message players to be seated soon
-        cur.execute(
-            "SELECT Tables.Type, TableTypes.Players, COUNT(*) FROM Tables "
-            " INNER JOIN TableTypes ON Tables.Type = TableTypes.Type "
-            " WHERE "
-            " (ScheduledStart IS NULL AND (NOT Playing OR"
-            "   strftime('%s', datetime('now', 'localtime')) - strftime('%s', Started) > 60 * (TableTypes.Duration - ?))) "
-            " OR (ScheduledStart IS NOT NULL AND strftime('%s', ScheduledStart) - strftime('%s', datetime('now', 'localtime')) < ?) "
-            " GROUP BY Tables.Type ",
-            (settings.NOTIFY_MINUTES, settings.NOTIFY_MINUTES)
-        )
-        tablecounts = cur.fetchall()
-        playersToNotify = []
-        for tabletype, count, playercount in tablecounts:
-            cols = ['Id', 'Phone', 'Notified']
-            cur.execute(
-                "SELECT {cols} FROM Queue "
-                " INNER JOIN People ON Queue.Person = People.Id "
-                " WHERE Queue.Type = ? "
-                " ORDER BY Added LIMIT ?".format(cols=",".join(cols)),
-                (tabletype, count * playercount)
-            )
-            playersToNotify += [dict(zip(cols, row)) for row in cur.fetchall()]
-    playersToNotify = [row for row in playersToNotify if not row['Notified'] and row['Phone'] and row['Phone'] != ""]
-    if settings.TWILIO_SID != "" and settings.TWILIO_AUTH != "" and settings.TWILIO_NUMBER != "":
-        try:
-            client = Client(settings.TWILIO_SID, settings.TWILIO_AUTH)
-            texted = []
-            for player in playersToNotify:
-                try:
-                    message=settings.TEXT_FMT.format("in about {} minutes!".format(settings.NOTIFY_MINUTES))
-                    client.messages.create(
-                        to=player['Phone'],
-                        from_=settings.TWILIO_NUMBER,
-                        body=message
-                    )
-                    events.logEvent("textsent", player['Id'])
-                    texted += [(player['Id'],)]
-                except:
-                    print("Error sending Twilio message: ", sys.exc_info()[0])
-                    events.logEvent("textfailed", player['Id'])
-            if len(texted) > 0:
-                with db.getCur() as cur:
-                    cur.executemany("UPDATE People SET Notified = 1 WHERE Id = ?", texted)
-        except:
-            print("Error sending Twilio message: ", sys.exc_info()[0])
-            events.logEvent("twiliofailed")
+    """Text the people who will be seated at tables opening up in the next
+    NOTIFY_MINUTES, and arm a deadline for each table that will open up
+    later.  Runs after every change to the room and when a deadline
+    passes."""
+    texter = dispatcher()
+    if texter is None:
+        return
+    room = state.get()
+    tabledeadlines = deadlines()
+    now = datetime.datetime.now()
+    opening = collections.Counter()
+    later = set()
+    for table in room.tables.values():
+        tabletype = room.types.get(table['Type'])
+        if tabletype is None:
+            continue
+        deadline = tableDeadline(table, tabletype)
+        if deadline is None:
+            continue
+        if deadline <= now:
+            opening[table['Type']] += 1
+        else:
+            tabledeadlines.schedule(table['Id'], deadline.timestamp(), sendNotifications)
+            later.add(table['Id'])
+    for table in list(tabledeadlines.deadlines):
+        if table not in later:
+            tabledeadlines.cancel(table)
+
+    message = settings.TEXT_FMT.format("in about {} minutes!".format(settings.NOTIFY_MINUTES))
+    for tabletype, count in opening.items():
+        playercount = count * (room.types[tabletype]['Players'] or 0)
+        for player in room.queued(tabletype)[:playercount]:
+            if not player['Notified'] and player['Phone']:
+                texter.send(player['Phone'], message, key = player['Id'],
+                        person = player['Id'], notify = True)
+
+def start():
+    """Send notifications whenever the room changes"""
+    if sendNotifications not in state.listeners:
+        state.listeners.append(sendNotifications)
+    sendNotifications()
 
 class NotifyPlayerHandler(tornado.web.RequestHandler):
     def post(self):
         result = { 'status': "error",
                     'message': "Unknown error occurred"}
         player = self.get_argument("player", None)
+        phone = None
         if player is not None:
-            with db.getCur() as cur:
-                cur.execute("SELECT Phone FROM People WHERE Id = ?", (player,))
-                row = cur.fetchone()
-                phone = row[0]
-        if phone is not None:
-            client = Client(settings.TWILIO_SID, settings.TWILIO_AUTH)
-
-            try:
-                message = settings.TEXT_FMT.format("soon!")
-                client.messages.create(
-                    to=phone,
-                    from_=settings.TWILIO_NUMBER,
-                    body=message,
-                )
+            person = state.get().people.get(int(player))
+            if person is not None:
+                phone = person['Phone']
+        texter = dispatcher()
+        if texter is None:
+            result["message"] = "Texting is not configured"
+        elif phone is not None:
+            if texter.send(phone, settings.TEXT_FMT.format("soon!"), person = player):
                 result["status"] = "success"
-                result["message"] = "Notified player"
-                events.logEvent("textsent", player)
-            except:
-                events.logEvent("textfailed", player)
+                result["message"] = "Notifying player"
+            else:
                 result["message"] = "Failed to notify player"
         self.write(json.dumps(result))
 
@@ -93,22 +139,19 @@ class NotifyTableHandler(tornado.web.RequestHandler):
         result = { 'status': "error",
                     'message': "Unknown error occurred"}
         table = self.get_argument("table", None)
-        if table is not None:
-            with db.getCur() as cur:
-                cur.execute("SELECT Phone FROM People INNER JOIN Players ON PersonId = People.Id WHERE TableId = ?", (table,))
-                client = Client(settings.TWILIO_SID, settings.TWILIO_AUTH)
-                phones = 0
-                for phone in cur.fetchall():
-                    phone = phone[0]
-                    if phone is not None and phone != "":
-                        message = settings.TEXT_FMT.format("soon!")
-                        client.messages.create(
-                            to=phone,
-                            from_=settings.TWILIO_NUMBER,
-                            body=message,
-                        )
+        texter = dispatcher()
+        if texter is None:
+            result["message"] = "Texting is not configured"
+        elif table is not None:
+            room = state.get()
+            phones = 0
+            for person in room.seating().get(int(table), []):
+                phone = person['Phone']
+                if phone is not None and phone != "":
+                    message = settings.TEXT_FMT.format("soon!")
+                    if texter.send(phone, message, person = person['Id']):
                         phones += 1
             result["status"] = "success"
-            result["message"] = "Notified " + str(phones) + " players"
+            result["message"] = "Notifying " + str(phones) + " players"
             events.logEvent('tablenotify', (table, phones))
         self.write(json.dumps(result))
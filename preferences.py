@@ -4,8 +4,9 @@ import tornado.web
 import json
 
 import db
+import feed
 
-class PreferencesHandler(tornado.web.RequestHandler):
+class PreferencesHandler(feed.VersionedHandler):
     def get(self):
         result = { 'status': "error",
                     'data': {}}
@@ -43,9 +44,10 @@ class PreferencesHandler(tornado.web.RequestHandler):
                     cur.execute(query, args)
                 result = { 'status': "success",
                             'message': "Preferences updated"}
+                feed.publish('preferences')
         self.write(json.dumps(result))
 
-class PreferenceHandler(tornado.web.RequestHandler):
+class PreferenceHandler(feed.VersionedHandler):
     def get(self, q):
         result = { 'status': "success",
                     'value': getPreference(q)}
@@ -3,155 +3,195 @@
 import tornado.web
 import json
 import datetime
+import gzip
 
-import db
 import util
 import events
+import feed
+import state
+import rooms
+import eta
+import announcement
 
-import sys
+def remainingString(when, now):
+    if when is None:
+        return "NEVER"
+    remaining = (when - now).total_seconds()
+    if remaining > 0:
+        return util.timeString(remaining)
+    return "NOW"
 
-def getTypeQueue(tableType):
-    with db.getCur() as cur:
-        cur.execute("SELECT Duration, Players FROM TableTypes WHERE Type = ?", (tableType,))
-        typeData = cur.fetchone()
-        duration = typeData[0]
-        playercount = typeData[1]
+def getQueues(now=None):
+    """The queue for every table type, from the room state"""
+    room = state.get()
+    now = now or datetime.datetime.now()
+    return [getTypeQueue(room, tableType, now) for tableType in sorted(room.types)]
 
-        cur.execute(
-                "SELECT People.Id, Name, Phone, Added FROM People "
-                " INNER JOIN Queue ON Queue.Person = People.Id "
-                " WHERE Queue.Type = ? ORDER BY People.Added", (tableType,))
-        people = cur.fetchall()
+def getTypeQueue(room, tableType, now):
+    estimates = rooms.get().local('estimates', eta.Estimates)
+    return estimates.derived(room, tableType, now, 'queue',
+            lambda people, etas, now: formatQueue(tableType, people, etas, now))
 
-        cols = ['Started','Playing','ScheduledStart']
-        cur.execute(
-                "SELECT {cols} FROM Tables "
-                " WHERE Type = ? AND ScheduledStart IS NULL"
-                " ORDER BY Playing ASC, Started ASC".format(cols=",".join(cols)),
-                (tableType,)
-        )
-        tables = [dict(zip(cols,row)) for row in cur.fetchall()]
+def formatQueue(tableType, people, etas, now):
+    """The queue for a table type as the queue API sends it.  Its times
+    are only shown to the minute, so it is kept with the type's ETAs."""
+    # People seated at the same table share an ETA, so format each once
+    labels = {}
+    queue = []
+    for person, when in zip(people, etas):
+        if when not in labels:
+            labels[when] = (str(when), remainingString(when, now))
+        added = util.parseTime(person['Added'])
+        queue += [{'Id': person['Id'],
+                    'Name': person['Name'],
+                    'HasPhone': person['Phone'] is not None,
+                    'Elapsed': util.timeString((now - added).total_seconds()),
+                    'Added': str(added),
+                    'ETA': labels[when][0],
+                    'Remaining': labels[when][1]}]
+    return {
+        'Type': tableType,
+        'Queue': queue,
+        'ETA': str(etas[-1]),
+        'Remaining': remainingString(etas[-1], now)
+    }
 
-        cur.execute(
-                "SELECT {cols} FROM Tables "
-                " WHERE Type = ? AND ScheduledStart IS NOT NULL"
-                " ORDER BY Playing ASC, Started ASC".format(cols=",".join(cols)),
-                (tableType,)
-        )
-        scheduledtables = [dict(zip(cols,row)) for row in cur.fetchall()]
+def compactQueues(now=None):
+    """The queues as columns of values, with times as epoch seconds and
+    none of the display strings, which clients work out themselves.  The
+    queued people are in columns too, each with the index of their queue,
+    oldest first."""
+    room = state.get()
+    now = now or datetime.datetime.now()
+    estimates = rooms.get().local('estimates', eta.Estimates)
+    queues = {'Type': [], 'ETA': []}
+    people = dict((column, []) for column in ['Id', 'Name', 'HasPhone', 'Added', 'ETA', 'Queue'])
+    for index, tableType in enumerate(sorted(room.types)):
+        queued, etas = estimates.get(room, tableType, now)
+        etas = [util.epoch(when) for when in etas]
+        queues['Type'].append(tableType)
+        queues['ETA'].append(etas[-1])
+        for person, when in zip(queued, etas):
+            people['Id'].append(person['Id'])
+            people['Name'].append(person['Name'])
+            people['HasPhone'].append(int(person['Phone'] is not None))
+            people['Added'].append(util.epoch(person['Added']))
+            people['ETA'].append(when)
+            people['Queue'].append(index)
+    return {'version': feed.COMPACT_VERSION, 'queues': queues, 'people': people}
 
-        ReadTime = lambda t: datetime.datetime.strptime(t, '%Y-%m-%d %H:%M:%S')
+def queueSeconds():
+    """The seconds past the minute at which the times shown for the queues
+    tick over"""
+    room = state.get()
+    estimates = rooms.get().local('estimates', eta.Estimates)
+    return set().union(*(estimates.seconds(room, tableType) for tableType in room.types))
 
-        now = datetime.datetime.now()
-        queue = []
-        position = 0
-        for person in people:
-            id, name, phone, added = person
-            added = ReadTime(added)
-
-            eta = now
-            table = int(position / playercount)
-            if len(tables) > 0:
-                if tables[table % len(tables)]['Started'] is not None:
-                    eta = ReadTime(tables[table % len(tables)]['Started'])
-                    eta += datetime.timedelta(minutes = duration)
-                eta += datetime.timedelta(minutes = int(table / len(tables)) * duration)
-            elif len(scheduledtables) > 0:
-                scheduledtable = scheduledtables[table % len(scheduledtables)]
-                #TODO: Figure out what to set ETA to in this case
-                if scheduledtable['ScheduledStart'] is None or (
-                        "Taken" in scheduledtable and scheduledtable["Taken"] == playercount):
-                    eta = None
-                else:
-                    if not "Taken" in scheduledtable:
-                        scheduledtable["Taken"] = 0
-                    scheduledtable["Taken"] += 1
-                    eta = ReadTime(scheduledtable['ScheduledStart'])
-            else:
-                eta = None
-            if eta is not None:
-                remaining = (eta - now).total_seconds()
-                if remaining > 0:
-                    remaining = util.timeString(remaining)
-                else:
-                    remaining = "NOW"
-            else:
-                remaining = "NEVER"
-
-            elapsed = (now - added).total_seconds()
-            elapsed = util.timeString(elapsed)
-
-            queue += [{'Id': id,
-                        'Name': name,
-                        'HasPhone': phone is not None,
-                        'Elapsed': elapsed,
-                        'Added': str(added),
-                        'ETA': str(eta),
-                        'Remaining': remaining}]
-            position += 1
-        table = int(position / playercount)
-        neweta = None
-        if len(tables) > 0:
-            if tables[table % len(tables)]['Playing']:
-                neweta = datetime.datetime.strptime(tables[table % len(tables)]['Started'], '%Y-%m-%d %H:%M:%S')
-                neweta += datetime.timedelta(minutes = duration)
-            else:
-                neweta = now
-            neweta += datetime.timedelta(minutes = int(table / len(tables)) * duration)
-        elif len(scheduledtables) > 0 and scheduledtables[0]['ScheduledStart'] is not None and table > 1:
-            neweta = datetime.datetime.strptime(scheduledtables[0]['ScheduledStart'], '%Y-%m-%d %H:%M:%S')
-        if neweta is not None:
-            newRemaining = (neweta - now).total_seconds()
-            if newRemaining > 0:
-                newRemaining = util.timeString(newRemaining)
-            else:
-                newRemaining = "NOW"
-        else:
-            newRemaining = "NEVER"
-        return {
-            'Type': tableType,
-            'Queue': queue,
-            'ETA': str(neweta),
-            'Remaining': newRemaining
-        }
-
-class QueueHandler(tornado.web.RequestHandler):
+class QueueHandler(feed.VersionedHandler):
+    timed = True
+    def tickSeconds(self):
+        return queueSeconds()
     def get(self):
-        with db.getCur() as cur:
-            cur.execute("SELECT Type FROM TableTypes")
-            rows = cur.fetchall()
-        queues = []
-        for row in rows:
-            queues += [getTypeQueue(row[0])]
-        self.write(json.dumps({'Queues':queues}))
+        if self.compact():
+            self.write(json.dumps(compactQueues(), separators=(',', ':')))
+        else:
+            self.write(json.dumps({'Queues':getQueues()}))
     def post(self):
         result = { 'status': "error",
                     'message': "Unknown error occurred"}
-        name = self.get_argument("name", None)
-        phone = self.get_argument("phone", None)
-        tableType = self.get_argument("type", False)
-        numplayers = int(self.get_argument("numplayers", "1"))
-        if name is None or name == "":
-            result["message"] = "Please enter a name"
+        groups = self.get_argument("groups", None)
+        try:
+            if groups is None:
+                groups = [readGroup({'name': self.get_argument("name", None),
+                        'phone': self.get_argument("phone", None),
+                        'type': self.get_argument("type", None),
+                        'numplayers': self.get_argument("numplayers", "1")})]
+            else:
+                try:
+                    groups = json.loads(groups)
+                except ValueError:
+                    groups = None
+                if not isinstance(groups, list) or len(groups) == 0:
+                    raise ValueError("Please give a list of groups")
+                groups = [readGroup(group) for group in groups]
+        except ValueError as e:
+            result["message"] = str(e)
         else:
-            if phone == "":
-                phone = None
-            players = []
-            with db.getCur() as cur:
-                for i in range(numplayers):
-                    n = name
-                    if i > 0:
-                        n += " (" + str(i) + ")"
-                        phone = None
-                    cur.execute("INSERT INTO People(Name, Phone, Added) VALUES(?, ?, datetime('now', 'localtime'))", (n, phone))
-                    cur.execute("INSERT INTO Queue(Person, Type) VALUES(?, ?)", (cur.lastrowid, tableType))
-                    players += [(cur.lastrowid, n)]
-            for player in players:
-                events.logEvent('playerqueueadd', (player[0], player[1], tableType, numplayers))
+            added = state.get().addGroups(groups)
+            for (names, phone, tableType), people in zip(groups, added):
+                events.logEvent('groupqueueadd', [people, names, tableType], len(people))
+            count = sum(len(people) for people in added)
             result["status"] = "success"
-            result["message"] = "Added " + str(numplayers) + "players"
+            if len(groups) == 1:
+                result["message"] = "Added {0} players".format(count)
+            else:
+                result["message"] = "Added {0} players in {1} groups".format(count, len(groups))
+            result["people"] = added
         self.write(json.dumps(result))
 
+def readGroup(group):
+    """Check a signup and return it as (names, phone, table type).  A
+    group gives either the names of everyone in it, or one name and
+    numplayers, in which case the others are numbered after the first."""
+    if not isinstance(group, dict):
+        raise ValueError("Please give each group as an object")
+    name = group.get('name')
+    names = group.get('names')
+    if names is None:
+        if name is None or name == "":
+            raise ValueError("Please enter a name")
+        try:
+            numplayers = int(group.get('numplayers', 1))
+        except (TypeError, ValueError):
+            raise ValueError("Please enter a number of players")
+        names = [name + (" (" + str(i) + ")" if i > 0 else "") for i in range(numplayers)]
+    elif (not isinstance(names, list) or len(names) == 0 or
+            not all(isinstance(name, str) and name != "" for name in names)):
+        raise ValueError("Please enter a name for everyone in the group")
+    if len(names) == 0:
+        raise ValueError("Please enter a number of players")
+    tableType = group.get('type')
+    if tableType not in state.get().types:
+        raise ValueError("Please choose a table type")
+    phone = group.get('phone')
+    if phone == "":
+        phone = None
+    return names, phone, tableType
+
+def projectorSnapshot(handler):
+    """The projector view of the current room, rendered by handler once
+    per feed version and minute and shared by every projector, as (HTML,
+    gzipped HTML)"""
+    room = rooms.get()
+    now = datetime.datetime.now()
+    key = (feed.current().version, util.lastTick(projectorSeconds(), now))
+    cached = room.data.get('projector')
+    if cached is None or cached[0] != key:
+        html = handler.render_string("projectorsnapshot.html",
+                queues = getQueues(now),
+                session = announcement.nextSession(now))
+        cached = room.data['projector'] = (key, html, gzip.compress(html, 6))
+    return cached[1:]
+
+def projectorSeconds():
+    """The seconds past the minute at which the times shown on the
+    projector tick over"""
+    return feed.current().cache('projector', lambda:
+            queueSeconds() | set(session.second for session in announcement.sessionTimes()))
+
+class ProjectorSnapshotHandler(feed.VersionedHandler):
+    timed = True
+    def tickSeconds(self):
+        return projectorSeconds()
+    def get(self):
+        html, gzipped = projectorSnapshot(self)
+        self.set_header("Content-Type", "text/html; charset=UTF-8")
+        if "gzip" in self.request.headers.get("Accept-Encoding", ""):
+            self.set_header("Content-Encoding", "gzip")
+            self.write(gzipped)
+        else:
+            self.write(html)
+
 class QueuePlayerHandler(tornado.web.RequestHandler):
     def post(self):
         result = { 'status': "error",
@@ -159,10 +199,7 @@ class QueuePlayerHandler(tornado.web.RequestHandler):
         player = self.get_argument("player", None)
         tableType = self.get_argument("type", None)
         if player is not None:
-            with db.getCur() as cur:
-                cur.execute("DELETE FROM Queue WHERE Person = ?", (player,))
-                cur.execute("DELETE FROM Players WHERE PersonId = ?", (player,))
-                cur.execute("INSERT INTO Queue(Person, Type) VALUES(?, ?)", (player, tableType))
+            state.get().queuePerson(player, tableType)
             events.logEvent('playerqueuemove', (player, tableType))
             result["status"] = "success"
             result["message"] = "Moved player"
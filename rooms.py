@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+import collections
+import concurrent.futures
+import contextvars
+import json
+import os
+import re
+
+import tornado.httputil
+
+import settings
+
+# Room names as they appear in URLs, /rooms/<name>/...
+name_pattern = re.compile(r'^[A-Za-z0-9_-]+$')
+path_pattern = re.compile(r'^/rooms/([^/]+)(/.*)?$')
+
+class Room():
+    """One gaming room hosted by this process.  Each room has its own
+    database file, and every module keeps its in-process state for the
+    room (room state, feed, text dispatcher, deadlines...) in `data`, so
+    rooms share nothing but the IOLoop.
+
+    Code runs for a room inside room.run(), or in a request under the
+    room's URL prefix.  Timers and callbacks scheduled from there keep
+    running for that room, as the IOLoop copies context variables into
+    them."""
+    def __init__(self, name, dbfile=None):
+        self.name = name
+        self._dbfile = dbfile
+        self.data = {}
+
+    @property
+    def dbfile(self):
+        """The room's database file.  The default room follows
+        settings.DBFILE."""
+        return self._dbfile or settings.DBFILE
+
+    @property
+    def root(self):
+        """URL prefix of the room's pages and APIs"""
+        return "/rooms/{0}".format(self.name) if self.name else ""
+
+    def local(self, key, factory):
+        """This room's instance of a per-room object, made by calling
+        factory() on first use"""
+        if key not in self.data:
+            self.data[key] = factory()
+        return self.data[key]
+
+    def executor(self):
+        """The room's own worker thread, for long jobs such as archiving
+        and exports that would otherwise hold up every room's requests.
+        Code run there is outside the room's context, so it must be given
+        the room's database file, and it must not touch the room state."""
+        return self.local('executor', lambda: concurrent.futures.ThreadPoolExecutor(
+            1, thread_name_prefix = "room-{0}".format(self.name or "default")))
+
+    def run(self, func, *args, **kwargs):
+        token = current.set(self)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            current.reset(token)
+
+default = Room("")
+rooms = collections.OrderedDict([("", default)])
+current = contextvars.ContextVar('room', default=None)
+
+def get():
+    """The room being served, the default room outside any other"""
+    return current.get() or default
+
+def configured():
+    """Rooms from settings.ROOMS and the rooms file, as name: database file"""
+    configured = collections.OrderedDict(settings.ROOMS)
+    if os.path.exists(settings.ROOMSFILE):
+        with open(settings.ROOMSFILE) as f:
+            configured.update(json.load(f))
+    return configured
+
+def make(name, dbfile=None):
+    """A room that could be added, by default with its database named
+    after it next to settings.DBFILE, or ValueError if the name can't be
+    used"""
+    if not name_pattern.match(name):
+        raise ValueError("Room names may only contain letters, digits, - and _")
+    if name in rooms:
+        raise ValueError("Room {0} already exists".format(name))
+    if dbfile is None:
+        dbfile = os.path.join(os.path.dirname(settings.DBFILE), name + ".db")
+    return Room(name, dbfile)
+
+def add(name, dbfile=None, save=False):
+    """Add a room, as made by make().  With save, it is also written to
+    settings.ROOMSFILE so it comes back after a restart."""
+    room = make(name, dbfile)
+    dbfile = room.dbfile
+    rooms[name] = room
+    if save:
+        saved = {}
+        if os.path.exists(settings.ROOMSFILE):
+            with open(settings.ROOMSFILE) as f:
+                saved = json.load(f)
+        saved[name] = dbfile
+        with open(settings.ROOMSFILE, "w") as f:
+            json.dump(saved, f, indent=2)
+    return room
+
+def route(request):
+    """Find the room a request is for, stripping the room's prefix from
+    the request path.  Returns None for an unknown room."""
+    match = path_pattern.match(request.path)
+    if match is None:
+        return default
+    room = rooms.get(match.group(1))
+    if room is not None:
+        request.path = match.group(2) or ""
+        request.uri = request.path + ("?" + request.query if request.query else "")
+    return room
+
+class RoomDelegate(tornado.httputil.HTTPMessageDelegate):
+    """Wraps the delegate that runs a request handler so the handler runs
+    for the request's room"""
+    def __init__(self, delegate, room):
+        self.delegate = delegate
+        self.room = room
+    def headers_received(self, start_line, headers):
+        return self.room.run(self.delegate.headers_received, start_line, headers)
+    def data_received(self, chunk):
+        return self.room.run(self.delegate.data_received, chunk)
+    def finish(self):
+        return self.room.run(self.delegate.finish)
+    def on_connection_close(self):
+        return self.room.run(self.delegate.on_connection_close)
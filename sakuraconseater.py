@@ -18,16 +18,27 @@ import util
 import settings
 import db
 import events
+import feed
+import state
 import notifications
+import metrics
+import rooms
+import assets
 
 import tables
 import queuehandlers
 import announcement
 import preferences
+import batch
+import export
 
 # import and define tornado-y things
 from tornado.options import define, options
 define("port", default=5000, type=int)
+define("rebuild_rollups", default=False, type=bool,
+        help="Recount the admin page statistics from the event log and exit")
+define("archive_events", default=False, type=bool,
+        help="Archive all events older than EVENT_RETENTION_DAYS days, compact the database and exit")
 cookie_secret = util.randString(32)
 
 class TablePlayerHandler(tornado.web.RequestHandler):
@@ -37,10 +48,7 @@ class TablePlayerHandler(tornado.web.RequestHandler):
         player = self.get_argument("player", None)
         table = self.get_argument("table", None)
         if player is not None and table is not None:
-            with db.getCur() as cur:
-                cur.execute("DELETE FROM Queue WHERE Person = ?", (player,))
-                cur.execute("DELETE FROM Players WHERE PersonId = ?", (player,))
-                cur.execute("INSERT INTO Players(TableId, PersonId) VALUES(?, ?)", (table, player))
+            state.get().seatPerson(player, table)
             result["status"] = "success"
             result["message"] = "Moved player"
             events.logEvent("playermovetotable", (player, table))
@@ -52,8 +60,7 @@ class DeletePlayerHandler(tornado.web.RequestHandler):
                     'message': "Unknown error occurred"}
         player = self.get_argument("player", None)
         if player is not None:
-            with db.getCur() as cur:
-                cur.execute("DELETE FROM People WHERE Id = ?", (player,))
+            state.get().deletePeople([player])
             result["status"] = "success"
             result["message"] = "Deleted player"
             events.logEvent("playerdelete", player)
@@ -66,8 +73,7 @@ class EditPlayerHandler(tornado.web.RequestHandler):
         player  = self.get_argument("player", None)
         newname = self.get_argument("newname", None)
         if player is not None and newname is not None:
-            with db.getCur() as cur:
-                cur.execute("UPDATE People SET Name = ? WHERE Id = ?", (newname, player))
+            state.get().renamePerson(player, newname)
             result["status"] = "success"
             result["message"] = "Updated player"
             events.logEvent("playerrename", (player,newname))
@@ -75,11 +81,15 @@ class EditPlayerHandler(tornado.web.RequestHandler):
 
 class MainHandler(tornado.web.RequestHandler):
     def get(self):
-        self.render("index.html")
+        self.render("index.html", rooms = list(rooms.rooms.values()))
 
 class ProjectorHandler(tornado.web.RequestHandler):
     def get(self):
-        self.render("projector.html")
+        if self.get_argument("lite", None) is not None:
+            self.render("projectorlite.html",
+                    snapshot = queuehandlers.projectorSnapshot(self)[0])
+        else:
+            self.render("projector.html")
 
 class ManageHandler(tornado.web.RequestHandler):
     def get(self):
@@ -91,45 +101,99 @@ class AnnouncementHandler(tornado.web.RequestHandler):
 
 class AdminHandler(tornado.web.RequestHandler):
     def get(self):
+        types = [{'Type': row['Type'], 'Duration': row['Duration'], 'Players': row['Players']}
+                    for row in state.get().types.values()]
+        events.flush()
         with db.getCur() as cur:
-            cur.execute("SELECT Type, Duration, Players FROM TableTypes")
-            rows = cur.fetchall()
-            types = []
-            for row in rows:
-                types += [{'Type': row[0], 'Duration': row[1], 'Players': row[2]}]
-
             eventTypes = {
                     'playerqueueadd': 'NewPlayers',
+                    'groupqueueadd': 'NewPlayers',
                     'textsent': 'TextsSent',
                     'tablestart': 'TablesStarted',
                     'tableclear': 'TablesCleared'
                 }
 
-            grouping = "strftime('%H', Time)"
-
-            stats = {}
+            stats = dict((stat, 0) for stat in eventTypes.values())
             timedstats = {}
-            for event, stat in eventTypes.items():
-                cur.execute("SELECT COUNT(*) FROM Events WHERE Type = ?", (event,))
-                stats[stat] = cur.fetchone()[0]
-
-                cur.execute("SELECT {grouping}, COUNT(*) FROM Events WHERE Type = ? GROUP BY {grouping};".format(grouping = grouping), (event,))
-                counts = cur.fetchall()
-                for count in counts:
-                    if count[0] not in timedstats:
-                        timedstats[count[0]] = {}
-                    timedstats[count[0]][stat] = count[1]
+            cur.execute(
+                    "SELECT Hour, Type, SUM(Count) FROM EventRollups"
+                    " WHERE Type IN ({0}) GROUP BY Hour, Type ORDER BY Hour".format(
+                        ",".join("?" * len(eventTypes))),
+                    list(eventTypes.keys()))
+            for hour, event, count in cur.fetchall():
+                stat = eventTypes[event]
+                stats[stat] += count
+                if hour not in timedstats:
+                    timedstats[hour] = {}
+                timedstats[hour][stat] = timedstats[hour].get(stat, 0) + count
 
             self.render("admin.html",
                     tabletypes = types,
                     stats = stats,
-                    timedstats = timedstats
+                    timedstats = timedstats,
+                    eventstats = events.stats,
+                    metrics = settings.METRICS
                 )
 
-class Application(tornado.web.Application):
-    def __init__(self):
+class RoomsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write(json.dumps([{'Name': room.name, 'Root': room.root + "/"}
+            for room in rooms.rooms.values()]))
+    def post(self):
+        result = { 'status': "error",
+                    'message': "Unknown error occurred"}
+        name = self.get_argument("name", None)
+        if name is None or name == "":
+            result["message"] = "Please enter a room name"
+        else:
+            try:
+                room = rooms.make(name)
+                # Updating the schema may ask questions on the console,
+                # which would hold up every room
+                if db.needs_migration(room.dbfile):
+                    self.set_status(409)
+                    result["message"] = ("The schema of {0} is out of date; add the room "
+                            "to settings.ROOMS and restart the server to update it".format(
+                                room.dbfile))
+                else:
+                    room = rooms.add(name, room.dbfile, save = True)
+                    openRoom(room)
+                    result["status"] = "success"
+                    result["message"] = "Added room " + name
+            except ValueError as e:
+                result["message"] = str(e)
+        self.write(json.dumps(result))
+
+def openRoom(room):
+    """Set up a room's database and in-process state and start its
+    periodic tasks"""
+    def setup():
         db.init()
+        state.load()
+        events.checkRollups()
         events.logEvent('start')
+        notifications.start()
+        if 'sweeper' in room.data:
+            room.data['sweeper'].stop()
+        room.data['sweeper'] = tornado.ioloop.PeriodicCallback(
+                lambda: room.run(sweepOrphans), settings.ORPHAN_SWEEP_SECONDS * 1000)
+        room.data['sweeper'].start()
+        if 'archiver' in room.data:
+            room.data['archiver'].stop()
+        if settings.EVENT_RETENTION_DAYS > 0:
+            room.data['archiver'] = tornado.ioloop.PeriodicCallback(
+                    lambda: archiveEvents(room), events.ARCHIVE_CHECK_SECONDS * 1000)
+            room.data['archiver'].start()
+            tornado.ioloop.IOLoop.current().add_callback(archiveEvents, room)
+    room.run(setup)
+
+class Application(tornado.web.Application):
+    def __init__(self):
+        for name, dbfile in rooms.configured().items():
+            if name not in rooms.rooms:
+                rooms.add(name, dbfile)
+        for room in rooms.rooms.values():
+            openRoom(room)
 
         if getattr(sys, 'frozen', False):
             curdirname = os.path.dirname(sys.executable)
@@ -147,6 +211,7 @@ class Application(tornado.web.Application):
                 (r"/api/tables", tables.TablesHandler),
                 (r"/api/starttable", tables.StartTableHandler),
                 (r"/api/filltable", tables.FillTableHandler),
+                (r"/api/filltables", tables.FillTablesHandler),
                 (r"/api/notifytable", notifications.NotifyTableHandler),
                 (r"/api/notifyplayer", notifications.NotifyPlayerHandler),
                 (r"/api/cleartable", tables.ClearTableHandler),
@@ -158,26 +223,82 @@ class Application(tornado.web.Application):
                 (r"/api/edittable", tables.EditTableHandler),
                 (r"/api/tableposition", tables.TablePositionHandler),
                 (r"/api/queue", queuehandlers.QueueHandler),
+                (r"/api/projector", queuehandlers.ProjectorSnapshotHandler),
                 (r"/api/queueplayer", queuehandlers.QueuePlayerHandler),
                 (r"/api/tableplayer", TablePlayerHandler),
                 (r"/api/deleteplayer", DeletePlayerHandler),
                 (r"/api/editplayer", EditPlayerHandler),
+                (r"/api/batch", batch.BatchHandler),
                 (r"/api/announcement", announcement.CurrentAnnouncementHandler),
                 (r"/api/teachingsessions", announcement.TeachingSessionsHandler),
                 (r"/api/deleteteachingsession", announcement.DeleteTeachingSessionHandler),
+                (r"/api/feed", feed.FeedSocketHandler),
+                (r"/api/feedstream", feed.FeedStreamHandler),
+                (r"/api/metrics", metrics.MetricsHandler),
+                (r"/api/export/(.*)", export.ExportHandler),
+                (r"/api/rooms", RoomsHandler),
         ]
-        settings = dict(
+        self.routes = dict((handler, route) for route, handler in handlers)
+        static_path = os.path.join(curdirname, "static")
+        assets.build(static_path)
+        appsettings = dict(
                 template_path = os.path.join(curdirname, "templates"),
-                static_path = os.path.join(curdirname, "static"),
-                cookie_secret = cookie_secret
+                static_path = static_path,
+                static_handler_class = assets.StaticHandler,
+                ui_methods = {'bundle': assets.bundle},
+                cookie_secret = cookie_secret,
+                compress_response = settings.COMPRESS_RESPONSES,
+                websocket_ping_interval = 30
         )
-        tornado.web.Application.__init__(self, handlers, **settings)
+        tornado.web.Application.__init__(self, handlers, **appsettings)
+
+    def find_handler(self, request, **kwargs):
+        room = rooms.route(request)
+        if room is None:
+            return self.get_handler_delegate(request, tornado.web.ErrorHandler,
+                    {'status_code': 404})
+        if request.path == "":
+            return self.get_handler_delegate(request, tornado.web.RedirectHandler,
+                    {'url': room.root + "/"})
+        return rooms.RoomDelegate(
+                tornado.web.Application.find_handler(self, request, **kwargs), room)
+
+    def get_handler_delegate(self, request, target_class, *args, **kwargs):
+        delegate = tornado.web.Application.get_handler_delegate(self, request,
+                target_class, *args, **kwargs)
+        if settings.METRICS:
+            delegate = metrics.MeasuredDelegate(delegate, request)
+        return delegate
+
+    def log_request(self, handler):
+        if settings.METRICS:
+            metrics.requestFinished(
+                    self.routes.get(type(handler), type(handler).__name__), handler)
+        tornado.web.Application.log_request(self, handler)
+
+@metrics.timed("sweepOrphans")
+def sweepOrphans():
+    """Check the current room's next batch of people for orphans, wrapping
+    around at the end of the table"""
+    room = rooms.get()
+    deleted, room.data['orphanSweep'] = state.get().sweepOrphans(
+            room.data.get('orphanSweep', 0), settings.ORPHAN_SWEEP_BATCH)
+    if deleted > 0:
+        events.logEvent('orphansweep', deleted)
+    return deleted
 
-def periodic():
-    with db.getCur() as cur:
-        # cleanup
-        cur.execute("DELETE FROM People WHERE Id NOT IN (SELECT PersonId FROM Players) AND Id NOT IN (SELECT Person FROM Queue);");
-    notifications.sendNotifications()
+async def archiveEvents(room):
+    """Archive a room's events past the retention period, a day at a
+    time, on the room's worker thread"""
+    archiveDay = metrics.timed("archiveEvents")(events.archiveDay)
+    days = []
+    day = True
+    while day is not None:
+        day = await tornado.ioloop.IOLoop.current().run_in_executor(
+                room.executor(), archiveDay, None, room.dbfile)
+        if day is not None:
+            days.append(day)
+    return days
 
 def main():
     if len(sys.argv) > 1:
@@ -189,14 +310,32 @@ def main():
         port = 5000
 
     tornado.options.parse_command_line()
+    if options.rebuild_rollups or options.archive_events:
+        for name, dbfile in rooms.configured().items():
+            rooms.add(name, dbfile)
+        for room in rooms.rooms.values():
+            room.run(db.init)
+            if options.archive_events:
+                days = room.run(events.archive)
+                with db.getCur(room.dbfile) as cur:
+                    cur.execute("VACUUM")
+                print("Archived events of {0} days from {1}".format(len(days), room.dbfile))
+            if options.rebuild_rollups:
+                room.run(events.rebuildRollups)
+                print("Rebuilt event rollups for", room.dbfile)
+        return
     http_server = tornado.httpserver.HTTPServer(Application(), max_buffer_size=24*1024**3)
     http_server.listen(os.environ.get("PORT", port))
 
     signal.signal(signal.SIGINT, sigint_handler)
 
     # start it up
-    tornado.ioloop.PeriodicCallback(periodic, 10 * 1000).start()
+    tornado.ioloop.PeriodicCallback(metrics.timed("events.flush")(events.flush),
+            settings.EVENT_FLUSH_MS).start()
+    if settings.METRICS:
+        metrics.watchLoop()
     tornado.ioloop.IOLoop.instance().start()
+    events.flush()
 
 def sigint_handler(signum, frame):
     tornado.ioloop.IOLoop.instance().stop()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+import heapq
+import itertools
+import logging
+import time
+
+import tornado.ioloop
+
+log = logging.getLogger("mahjong")
+
+class Scheduler():
+    """Calls functions at wall clock deadlines (time.time() seconds) on the
+    IOLoop.  Each deadline is filed under a key, and scheduling a key again
+    replaces its deadline.  Deadlines are kept in a heap with a single
+    IOLoop timeout armed for the earliest; replaced and cancelled entries
+    stay in the heap and are skipped when they reach the top."""
+    def __init__(self):
+        self.heap = []
+        self.deadlines = {}
+        self.counter = itertools.count()
+        self.timeout = None
+        self.armed = None
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def schedule(self, key, when, callback):
+        if self.deadlines.get(key) == (when, callback):
+            return
+        self.deadlines[key] = (when, callback)
+        heapq.heappush(self.heap, (when, next(self.counter), key, callback))
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.heap = [entry for entry in self.heap if self.current(entry)]
+            heapq.heapify(self.heap)
+        self.arm()
+
+    def cancel(self, key):
+        if self.deadlines.pop(key, None) is not None:
+            self.arm()
+
+    def current(self, entry):
+        when, count, key, callback = entry
+        return self.deadlines.get(key) == (when, callback)
+
+    def arm(self):
+        while len(self.heap) > 0 and not self.current(self.heap[0]):
+            heapq.heappop(self.heap)
+        when = self.heap[0][0] if len(self.heap) > 0 else None
+        if when == self.armed:
+            return
+        loop = tornado.ioloop.IOLoop.current()
+        if self.timeout is not None:
+            loop.remove_timeout(self.timeout)
+            self.timeout = None
+        self.armed = when
+        if when is not None:
+            self.timeout = loop.call_later(max(0, when - time.time()), self.run)
+
+    def run(self):
+        self.timeout = None
+        self.armed = None
+        now = time.time()
+        due = []
+        while len(self.heap) > 0 and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            if self.current(entry):
+                del self.deadlines[entry[2]]
+                due.append(entry[3])
+        for callback in due:
+            try:
+                callback()
+            except:
+                log.exception("Error running scheduled callback")
+        self.arm()
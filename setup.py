@@ -2,6 +2,12 @@
 
 from cx_Freeze import setup, Executable
 
+import assets
+
+# Build the static bundles now so they are included with static/ and the
+# installed copy, which may not be writable, doesn't need to build them
+assets.build("static")
+
 setup(name = "SakuraconSeater",
         version = "0.1",
         description = "",
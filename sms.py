@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+import concurrent.futures
+import logging
+import random
+import threading
+import time
+
+import tornado.gen
+import tornado.ioloop
+import tornado.queues
+
+log = logging.getLogger("mahjong")
+
+class SMSError(Exception):
+    pass
+
+class TwilioTransport():
+    """Sends texts through Twilio using one client for every message"""
+    def __init__(self, sid, auth, number):
+        from twilio.rest import Client
+        self.client = Client(sid, auth)
+        self.number = number
+    def send(self, to, body):
+        self.client.messages.create(to=to, from_=self.number, body=body)
+
+class FakeTransport():
+    """Local stand-in for an SMS gateway that takes `latency` seconds per
+    message and fails a `failrate` fraction of them.  Sent messages are
+    kept in `sent` as (time, to, body)."""
+    def __init__(self, latency=0.05, failrate=0):
+        self.latency = latency
+        self.failrate = failrate
+        self.sent = []
+        self.lock = threading.Lock()
+    def send(self, to, body):
+        time.sleep(self.latency)
+        if random.random() < self.failrate:
+            raise SMSError("Fake gateway failure")
+        with self.lock:
+            self.sent.append((time.time(), to, body))
+
+class Dispatcher():
+    """Sends texts in the background so a slow gateway never blocks the
+    IOLoop.  Messages wait in a bounded queue and are sent by `workers`
+    coroutines, each handing the blocking transport call to a thread pool.
+    Sending is limited to `rate` messages per second across all workers
+    (None for unlimited), and a failed send is retried up to `retries`
+    times, waiting `backoff` seconds and doubling the wait each time.
+
+    onstatus(status, message) is called on the IOLoop as each message is
+    'sent', 'retried', finally 'failed' or 'dropped' because the queue
+    was full."""
+    def __init__(self, transport, workers=4, maxqueue=500, retries=3,
+            backoff=2, rate=None, onstatus=None):
+        self.transport = transport
+        self.retries = retries
+        self.backoff = backoff
+        self.rate = rate
+        self.onstatus = onstatus
+        self.queue = tornado.queues.Queue(maxsize=maxqueue)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.nextsend = 0
+        self.pending = set()
+        self.stats = {'queued': 0, 'sent': 0, 'retried': 0, 'failed': 0, 'dropped': 0}
+        for i in range(workers):
+            tornado.ioloop.IOLoop.current().spawn_callback(self.worker)
+
+    def send(self, to, body, key=None, **info):
+        """Queue a text.  Messages with a key are skipped while an earlier
+        message with the same key is still waiting.  Returns whether the
+        message was queued."""
+        if key is not None and key in self.pending:
+            return False
+        message = dict(info, to=to, body=body, key=key, attempts=0,
+                queued=time.time())
+        try:
+            self.queue.put_nowait(message)
+        except tornado.queues.QueueFull:
+            self.status('dropped', message)
+            return False
+        if key is not None:
+            self.pending.add(key)
+        self.stats['queued'] += 1
+        return True
+
+    def status(self, status, message):
+        self.stats[status] += 1
+        if self.onstatus is not None:
+            try:
+                self.onstatus(status, message)
+            except:
+                log.exception("Error handling {0} text".format(status))
+
+    async def throttle(self):
+        if self.rate is None:
+            return
+        now = time.time()
+        wait = self.nextsend - now
+        self.nextsend = max(now, self.nextsend) + 1.0 / self.rate
+        if wait > 0:
+            await tornado.gen.sleep(wait)
+
+    async def worker(self):
+        loop = tornado.ioloop.IOLoop.current()
+        while True:
+            message = await self.queue.get()
+            try:
+                while True:
+                    await self.throttle()
+                    message['attempts'] += 1
+                    try:
+                        await loop.run_in_executor(self.executor,
+                                self.transport.send, message['to'], message['body'])
+                    except Exception as e:
+                        message['error'] = str(e)
+                        if message['attempts'] > self.retries:
+                            self.status('failed', message)
+                            break
+                        self.status('retried', message)
+                        await tornado.gen.sleep(
+                                self.backoff * 2 ** (message['attempts'] - 1))
+                        continue
+                    message['sent'] = time.time()
+                    self.status('sent', message)
+                    break
+            finally:
+                self.pending.discard(message['key'])
+                self.queue.task_done()
+
+    async def join(self):
+        """Wait until every queued message has been sent or has failed"""
+        await self.queue.join()
@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+
+import collections
+import contextlib
+import logging
+import operator
+import sqlite3
+
+import db
+import feed
+import rooms
+import settings
+
+log = logging.getLogger("mahjong")
+
+typecols = ['Type', 'Duration', 'Players']
+tablecols = ['Id', 'Name', 'Playing', 'x', 'y', 'Type', 'Started', 'ScheduledStart']
+peoplecols = ['Id', 'Name', 'Phone', 'Notified', 'Added']
+
+# INSERT ... RETURNING needs SQLite 3.35 or later.  With an older SQLite,
+# such as one bundled into a frozen build, people are inserted one at a
+# time instead.
+RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+def chunks(items, size=500):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def placeholders(items):
+    return ",".join("?" * len(items))
+
+def read(cur):
+    """Read the seating tables from the database into the structures
+    RoomState keeps in memory"""
+    cur.execute("SELECT {0} FROM TableTypes".format(",".join(typecols)))
+    types = dict((row[0], dict(zip(typecols, row))) for row in cur.fetchall())
+    cur.execute("SELECT {0} FROM Tables ORDER BY Id".format(",".join(tablecols)))
+    tables = dict((row[0], dict(zip(tablecols, row))) for row in cur.fetchall())
+    cur.execute("SELECT {0} FROM People ORDER BY Id".format(",".join(peoplecols)))
+    people = dict((row[0], dict(zip(peoplecols, row))) for row in cur.fetchall())
+    cur.execute("SELECT PersonId, TableId FROM Players ORDER BY Id")
+    players = dict(cur.fetchall())
+    cur.execute("SELECT Person, Type FROM Queue ORDER BY Person")
+    queue = dict(cur.fetchall())
+    return types, tables, people, players, queue
+
+# Functions called after each change to the room is committed
+listeners = []
+
+class RoomState():
+    """Authoritative in-memory copy of the TableTypes, Tables, People,
+    Players and Queue tables.  Handlers read from it and change the room
+    only through its methods, each of which writes to SQLite and refreshes
+    the affected rows in the same transaction."""
+    def __init__(self):
+        self.version = 0
+        # Bumped for each table type whenever its tables, their players or
+        # its queue change
+        self.typeVersions = collections.Counter()
+        self.load()
+
+    def load(self):
+        with db.getCur() as cur:
+            (self.types, self.tables, self.people, self.players,
+                    self.queue) = read(cur)
+
+    def diff(self):
+        """Compare memory with the database and return a list of the
+        differences found"""
+        with db.getCur() as cur:
+            actual = read(cur)
+        names = ['TableTypes', 'Tables', 'People', 'Players', 'Queue']
+        memory = [self.types, self.tables, self.people, self.players, self.queue]
+        differences = []
+        for name, mine, theirs in zip(names, memory, actual):
+            for key in sorted(set(mine) | set(theirs), key=str):
+                if mine.get(key) != theirs.get(key):
+                    differences.append("{0} {1}: memory {2}, database {3}".format(
+                        name, key, mine.get(key), theirs.get(key)))
+        return differences
+
+    def check(self):
+        differences = self.diff()
+        for difference in differences:
+            log.warning("Room state mismatch: " + difference)
+        return len(differences) == 0
+
+    @contextlib.contextmanager
+    def mutate(self, *topics):
+        """Run a block of changes in one transaction and publish the given
+        feed topics (default 'room') once it commits.  If it fails, memory
+        is reloaded from the database once the transaction is rolled back."""
+        try:
+            with db.getCur() as cur:
+                yield cur
+        except:
+            if not db.inTransaction():
+                self.load()
+            raise
+        self.version += 1
+        if settings.STATECHECK and not db.inTransaction():
+            self.check()
+        feed.publish(*(topics or ['room']))
+        if not db.inTransaction():
+            for listener in listeners:
+                try:
+                    listener()
+                except:
+                    log.exception("Error handling room change")
+
+    def touch(self, *types):
+        for tabletype in types:
+            if tabletype is not None:
+                self.typeVersions[tabletype] += 1
+
+    def tableType(self, table):
+        return self.tables[table]['Type'] if table in self.tables else None
+
+    def refreshTypes(self, cur, types):
+        self.touch(*types)
+        for chunk in chunks(types):
+            for tabletype in chunk:
+                self.types.pop(tabletype, None)
+            cur.execute("SELECT {0} FROM TableTypes WHERE Type IN ({1})".format(
+                ",".join(typecols), placeholders(chunk)), chunk)
+            for row in cur.fetchall():
+                self.types[row[0]] = dict(zip(typecols, row))
+
+    def refreshTables(self, cur, tables):
+        for chunk in chunks(tables):
+            for table in chunk:
+                self.touch(self.tableType(table))
+                self.tables.pop(table, None)
+            cur.execute("SELECT {0} FROM Tables WHERE Id IN ({1})".format(
+                ",".join(tablecols), placeholders(chunk)), chunk)
+            for row in cur.fetchall():
+                self.tables[row[0]] = dict(zip(tablecols, row))
+                self.touch(self.tables[row[0]]['Type'])
+        self.tables = dict(sorted(self.tables.items()))
+
+    def refreshPeople(self, cur, people):
+        """Reload people along with their Players and Queue rows"""
+        people = list(people)
+        last = next(reversed(self.people), 0)
+        for chunk in chunks(people):
+            for person in chunk:
+                self.touch(self.queue.get(person), self.tableType(self.players.get(person)))
+                self.people.pop(person, None)
+                self.players.pop(person, None)
+                self.queue.pop(person, None)
+            marks = placeholders(chunk)
+            cur.execute("SELECT {0} FROM People WHERE Id IN ({1})".format(
+                ",".join(peoplecols), marks), chunk)
+            for row in cur.fetchall():
+                self.people[row[0]] = dict(zip(peoplecols, row))
+            cur.execute("SELECT PersonId, TableId FROM Players"
+                    " WHERE PersonId IN ({0}) ORDER BY Id".format(marks), chunk)
+            players = cur.fetchall()
+            self.players.update(players)
+            self.touch(*(self.tableType(table) for person, table in players))
+            cur.execute("SELECT Person, Type FROM Queue"
+                    " WHERE Person IN ({0})".format(marks), chunk)
+            queue = cur.fetchall()
+            self.queue.update(queue)
+            self.touch(*(tabletype for person, tabletype in queue))
+        # Keep people in id order, which new people are added in already
+        if any(previous >= person for previous, person in zip([last] + people, people)):
+            self.people = dict(sorted(self.people.items()))
+
+    def dropOrphans(self, cur, people):
+        """Delete those of `people` who are neither seated nor queued any
+        more, then refresh them all.  Returns how many were deleted."""
+        deleted = 0
+        for chunk in chunks(people):
+            cur.execute("DELETE FROM People WHERE Id IN ({0})"
+                    " AND NOT EXISTS (SELECT 1 FROM Players WHERE PersonId = People.Id)"
+                    " AND NOT EXISTS (SELECT 1 FROM Queue WHERE Person = People.Id)".format(
+                        placeholders(chunk)), chunk)
+            deleted += cur.rowcount
+        self.refreshPeople(cur, people)
+        return deleted
+
+    # Reads
+
+    def seating(self):
+        """Map each table id to the people seated there, in the order they
+        were added"""
+        seating = dict((table, []) for table in self.tables)
+        for person, table in self.players.items():
+            seating.setdefault(table, []).append(self.people[person])
+        for people in seating.values():
+            people.sort(key=lambda person: (person['Added'], person['Id']))
+        return seating
+
+    def queued(self, tabletype=None):
+        """Queued people of one type, or of all types, oldest first"""
+        return sorted([self.people[person] for person, queued in
+                self.queue.items() if tabletype is None or queued == tabletype],
+                key=operator.itemgetter('Added', 'Id'))
+
+    # Tables
+
+    def addTable(self, tabletype):
+        with self.mutate() as cur:
+            cur.execute(
+                    "INSERT INTO Tables(Playing, Started, Name, Type) VALUES(?, NULL, ?, ?)",
+                    (0, "Untitled", tabletype)
+            )
+            table = cur.lastrowid
+            self.refreshTables(cur, [table])
+        return table
+
+    def startTable(self, table):
+        table = int(table)
+        with self.mutate() as cur:
+            cur.execute("UPDATE Tables SET Playing = 1, Started = datetime('now', 'localtime') WHERE Id = ?", (table,))
+            self.refreshTables(cur, [table])
+
+    def fillTable(self, table):
+        """Seat the longest waiting people of the table's type until it
+        is full and return how many were seated"""
+        table = int(table)
+        tabletype = self.types[self.tables[table]['Type']]
+        seated = sum(1 for seat in self.players.values() if seat == table)
+        playercount = max(0, tabletype['Players'] - seated)
+        people = [person['Id'] for person in self.queued(tabletype['Type'])[:playercount]]
+        with self.mutate() as cur:
+            self.seat(cur, {table: people})
+        return playercount
+
+    def fillTables(self, tables=None):
+        """Seat the longest waiting people of each type at the given tables,
+        or at every table, that aren't playing, in one transaction.  Tables
+        without a scheduled start are filled first, then the soonest
+        scheduled.  Returns the seating plan as a dict mapping each table
+        that got people to their ids, in the order they were seated."""
+        if tables is None:
+            tables = list(self.tables)
+        tables = [self.tables[int(table)] for table in tables]
+        seated = collections.Counter(self.players.values())
+        waiting = collections.defaultdict(collections.deque)
+        for person in self.queued():
+            waiting[self.queue[person['Id']]].append(person['Id'])
+        plan = collections.OrderedDict()
+        for table in sorted(tables, key=lambda table: (table['ScheduledStart'] is not None,
+                table['ScheduledStart'] or "", table['Id'])):
+            if table['Playing'] or table['Type'] not in self.types:
+                continue
+            queue = waiting[table['Type']]
+            free = self.types[table['Type']]['Players'] - seated[table['Id']]
+            people = [queue.popleft() for i in range(max(0, min(free, len(queue))))]
+            if len(people) > 0:
+                plan[table['Id']] = people
+        if len(plan) > 0:
+            with self.mutate() as cur:
+                self.seat(cur, plan)
+        return plan
+
+    def seat(self, cur, plan):
+        """Seat queued people at tables, given a dict mapping each table to
+        the people to seat there, and take them off the queue"""
+        people = [person for table in plan for person in plan[table]]
+        cur.executemany("INSERT INTO Players(TableId, PersonId) VALUES(?, ?)",
+                [(table, person) for table in plan for person in plan[table]])
+        for chunk in chunks(people):
+            cur.execute("DELETE FROM Queue WHERE Person IN ({0})".format(
+                placeholders(chunk)), chunk)
+        self.refreshPeople(cur, people)
+
+    def clearTable(self, table):
+        table = int(table)
+        people = [person for person, seat in self.players.items() if seat == table]
+        with self.mutate() as cur:
+            cur.execute("DELETE FROM Players WHERE TableId = ?", (table,))
+            cur.execute("UPDATE Tables SET Playing = 0, Started = NULL WHERE Id = ?", (table,))
+            self.refreshTables(cur, [table])
+            self.dropOrphans(cur, people)
+
+    def deleteTable(self, table):
+        table = int(table)
+        people = [person for person, seat in self.players.items() if seat == table]
+        with self.mutate() as cur:
+            cur.execute("DELETE FROM Tables WHERE Id = ?", (table,))
+            self.refreshTables(cur, [table])
+            self.dropOrphans(cur, people)
+
+    def updateTable(self, table, **fields):
+        """Set columns of a table, e.g. updateTable(1, Name="East")"""
+        table = int(table)
+        with self.mutate() as cur:
+            cur.execute("UPDATE Tables SET {0} WHERE Id = ?".format(
+                ", ".join("{0} = ?".format(field) for field in fields)),
+                list(fields.values()) + [table])
+            self.refreshTables(cur, [table])
+
+    # Table types
+
+    def addTableType(self, tabletype, duration, players):
+        with self.mutate('room', 'tabletypes') as cur:
+            cur.execute("INSERT INTO TableTypes(Type, Duration, Players) VALUES(?, ?, ?)", (tabletype, duration, players))
+            self.refreshTypes(cur, [tabletype])
+
+    def deleteTableType(self, tabletype):
+        tables = [table for table in self.tables
+                if self.tables[table]['Type'] == tabletype]
+        people = [person for person, seat in self.players.items() if seat in tables]
+        people += [person for person, queued in self.queue.items() if queued == tabletype]
+        with self.mutate('room', 'tabletypes') as cur:
+            cur.execute("DELETE FROM TableTypes WHERE Type = ?", (tabletype,))
+            self.refreshTypes(cur, [tabletype])
+            self.refreshTables(cur, tables)
+            self.dropOrphans(cur, people)
+
+    # People
+
+    def addPeople(self, names, phone, tabletype):
+        """Add people to the queue for a table type.  Only the first person
+        gets the phone number.  Returns the new people's ids."""
+        return self.addGroups([(names, phone, tabletype)])[0]
+
+    def addGroups(self, groups):
+        """Add groups of people to the queue, each group given as (names,
+        phone, table type), with one multi-row insert per table for all of
+        them.  Only each group's first person gets the phone number.
+        Returns each group's new ids."""
+        rows = [(name, phone if i == 0 else None)
+                for names, phone, tabletype in groups for i, name in enumerate(names)]
+        people = []
+        with self.mutate() as cur:
+            if RETURNING:
+                for chunk in chunks(rows, 400):
+                    cur.execute("INSERT INTO People(Name, Phone, Added) VALUES {0} RETURNING Id".format(
+                        ",".join(["(?, ?, datetime('now', 'localtime'))"] * len(chunk))),
+                        [value for row in chunk for value in row])
+                    # Ids are assigned in the order the rows are given
+                    people += sorted(row[0] for row in cur.fetchall())
+            else:
+                for row in rows:
+                    cur.execute("INSERT INTO People(Name, Phone, Added)"
+                            " VALUES (?, ?, datetime('now', 'localtime'))", row)
+                    people.append(cur.lastrowid)
+            queue = list(zip(people, [tabletype
+                for names, phone, tabletype in groups for name in names]))
+            for chunk in chunks(queue, 400):
+                cur.execute("INSERT INTO Queue(Person, Type) VALUES {0}".format(
+                    ",".join(["(?, ?)"] * len(chunk))),
+                    [value for row in chunk for value in row])
+            self.refreshPeople(cur, people)
+        added = []
+        for names, phone, tabletype in groups:
+            added.append(people[:len(names)])
+            people = people[len(names):]
+        return added
+
+    def queuePerson(self, person, tabletype):
+        with self.mutate() as cur:
+            cur.execute("DELETE FROM Queue WHERE Person = ?", (person,))
+            cur.execute("DELETE FROM Players WHERE PersonId = ?", (person,))
+            cur.execute("INSERT INTO Queue(Person, Type) VALUES(?, ?)", (person, tabletype))
+            self.refreshPeople(cur, [int(person)])
+
+    def seatPerson(self, person, table):
+        with self.mutate() as cur:
+            cur.execute("DELETE FROM Queue WHERE Person = ?", (person,))
+            cur.execute("DELETE FROM Players WHERE PersonId = ?", (person,))
+            cur.execute("INSERT INTO Players(TableId, PersonId) VALUES(?, ?)", (table, person))
+            self.refreshPeople(cur, [int(person)])
+
+    def renamePerson(self, person, name):
+        with self.mutate() as cur:
+            cur.execute("UPDATE People SET Name = ? WHERE Id = ?", (name, person))
+            self.refreshPeople(cur, [int(person)])
+
+    def deletePeople(self, people):
+        people = [int(person) for person in people]
+        with self.mutate() as cur:
+            for chunk in chunks(people):
+                cur.execute("DELETE FROM People WHERE Id IN ({0})".format(
+                    placeholders(chunk)), chunk)
+            self.refreshPeople(cur, people)
+
+    def sweepOrphans(self, after=0, limit=1000):
+        """Delete orphaned people among the `limit` people with the lowest
+        ids above `after`.  Orphans are normally deleted by the change that
+        orphans them, so this only reconciles what slipped through.  Returns
+        how many were deleted and the id to continue after next time, 0
+        once the end of the table is reached."""
+        with db.getCur() as cur:
+            cur.execute("SELECT Id FROM People WHERE Id > ? ORDER BY Id LIMIT ?",
+                    (after, limit))
+            people = [row[0] for row in cur.fetchall()]
+            if len(people) == 0:
+                return 0, 0
+            cur.execute("SELECT Id FROM People WHERE Id BETWEEN ? AND ?"
+                    " AND NOT EXISTS (SELECT 1 FROM Players WHERE PersonId = People.Id)"
+                    " AND NOT EXISTS (SELECT 1 FROM Queue WHERE Person = People.Id)",
+                    (people[0], people[-1]))
+            orphans = [row[0] for row in cur.fetchall()]
+        deleted = 0
+        if len(orphans) > 0:
+            with self.mutate() as cur:
+                deleted = self.dropOrphans(cur, orphans)
+        return deleted, people[-1] if len(people) == limit else 0
+
+    def markNotified(self, people):
+        with self.mutate() as cur:
+            cur.executemany("UPDATE People SET Notified = 1 WHERE Id = ?",
+                    [(person,) for person in people])
+            self.refreshPeople(cur, people)
+
+def get():
+    """The current room's state, loaded from the database on first use"""
+    return rooms.get().local('state', RoomState)
+
+def load():
+    """(Re)load the current room's state from the database"""
+    roomstate = rooms.get().data['state'] = RoomState()
+    return roomstate
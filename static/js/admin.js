@@ -1,10 +1,10 @@
 $(function() {
 	var tableTypesTemplate, teachingSessionsTemplate;
-	$.get("/static/mustache/tabletypes.mst", function(data) {
+	getTemplate("tabletypes", function(data) {
 		tableTypesTemplate = data;
 		Mustache.parse(data);
 	});
-	$.get("/static/mustache/teachingsessions.mst", function(data) {
+	getTemplate("teachingsessions", function(data) {
 		teachingSessionsTemplate = data;
 		Mustache.parse(data);
 	});
@@ -15,12 +15,12 @@ $(function() {
 		getAnnouncement();
 	}
 	function getAnnouncement() {
-		$.getJSON("/api/announcement", function(data) {
+		getVersionedJSON("api/announcement", function(data) {
 			$("#announcement").val(data.message);
 		});
 	}
 	function getTableTypes() {
-		$.getJSON("/api/tabletype", function(data) {
+		getVersionedJSON("api/tabletype", function(data) {
 				if(!tableTypesTemplate) {
 					window.setTimeout(getTableTypes, 500);
 					return;
@@ -30,7 +30,7 @@ $(function() {
 		});
 	}
 	function getTeachingSessions() {
-		$.getJSON("/api/teachingsessions", function(data) {
+		getVersionedJSON("api/teachingsessions", function(data) {
 			if(!teachingSessionsTemplate) {
 				window.setTimeout(getTeachingSessions, 500);
 				return;
@@ -51,7 +51,7 @@ $(function() {
 			$("#announcement").notify("Please enter some announcement text");
 			return;
 		}
-		$.post("/api/announcement", {'announcement':text}, function(data) {
+		$.post("api/announcement", {'announcement':text}, function(data) {
 			$.notify(data.message, data.status);
 			if(data.status === "success")
 				getAnnouncement();
@@ -70,7 +70,7 @@ $(function() {
 			$("#session").notify("Please enter some a time");
 			return;
 		}
-		$.post("/api/teachingsessions", {'time':text}, function(data) {
+		$.post("api/teachingsessions", {'time':text}, function(data) {
 			$.notify(data.message, data.status);
 			if(data.status === "success")
 				getTeachingSessions();
@@ -97,4 +97,21 @@ $(function() {
 		window.api("deletetabletype", true, data);
 	}
 	$("#addgametype").click(addTableType);
+
+	function getMetrics() {
+		$.getJSON("api/metrics", {"format": "json"}, function(data) {
+			var lines = [];
+			$.each(data.routes, function(route, stats) {
+				lines.push(route + " " + JSON.stringify(stats));
+			});
+			$.each(data.callbacks, function(callback, stats) {
+				lines.push(callback + " " + JSON.stringify(stats));
+			});
+			lines.push("ioloop " + JSON.stringify(data.loop));
+			$("#metrics").text(lines.join("\n"));
+		});
+	}
+	if($("#metrics").length)
+		getMetrics();
+	$("#refreshmetrics").click(getMetrics);
 });
@@ -1,8 +1,9 @@
 $(function() {
 	function getAnnouncement() {
-		$.getJSON('/api/announcement', function(data) {
+		getVersionedJSON('api/announcement', function(data) {
 			$("#announcement").text(data.message);
 		}).fail(window.xhrError);
 	}
-	window.setInterval(getAnnouncement, 1000);
+	getAnnouncement();
+	subscribe(["announcement"], getAnnouncement);
 });
@@ -10,6 +10,7 @@
 		var signupTemplate;
 		var tableTypes;
 		var editMode = false;
+		var selectedPlayers = {};
 
 
 		///////////////////
@@ -18,11 +19,12 @@
 
 		function getTables() {
 			getTableTypes(function () {
-				$.getJSON('/api/tables', function(data) {
+				getVersionedJSON('api/tables?compact=1', function(data) {
 					if(!tableTemplate) {
 						window.setTimeout(getTables, 500);
 						return;
 					}
+					data = expandTables(data);
 					data["tabletypes"] = jQuery.extend(true, [], window.tableTypes);
 					$("#tables").html(Mustache.render(tableTemplate, data));
 					$(".table").each(function (i, table) {
@@ -59,7 +61,7 @@
 							snap:true,
 							snapMode:"both",
 							stop:function(event, ui) {
-								$.post("/api/tableposition",
+								$.post("api/tableposition",
 											 {'x':ui.position.left,
 												 'y':ui.position.top,
 												 'table':ui.helper.data("id")},
@@ -68,8 +70,9 @@
 								}, 'json');
 							}
 						});
-						$("#tables .table").find(".elapsed,.players,.startbutton,.fillbutton,.notifybutton,.clearschedulebutton,.scheduledstart").hide();
+						$("#tables .table").find(".elapsed,.players,.startbutton,.fillbutton,.fillstartbutton,.notifybutton,.clearschedulebutton,.scheduledstart").hide();
 						$("#addtable").css("display", "inline-block");
+						$("#fillall").hide();
 						$("#editmode").text("Stop Editing");
 					}
 					else {
@@ -81,9 +84,17 @@
 						update:function(event, ui) {
 							// if we're moving a queue player back to a table
 							if(this === ui.item.parent()[0] && ui.sender !== null) {
-								$.post("/api/tableplayer",
-											 {'player':ui.item.data("id"),
-												 'table':ui.item.parents(".table").data("id")},
+								// selected queued players move along with the dragged one
+								var table = ui.item.parents(".table").data("id");
+								var players = [ui.item.data("id")];
+								for(var player in selectedPlayers)
+									if(players.indexOf(selectedPlayers[player]) < 0)
+										players.push(selectedPlayers[player]);
+								selectedPlayers = {};
+								var ops = players.map(function(player) {
+									return {'op':"tableplayer", 'player':player, 'table':table};
+								});
+								$.post("api/batch", {'ops':JSON.stringify(ops)},
 											 function(data) {
 												 notify(data.message, data.status);
 												 if(data.status === "error") {
@@ -91,7 +102,8 @@
 													 ui.sender.sortable("cancel");
 													 return;
 												 }
-												 refresh();
+												 if(!window.feedConnected)
+													 refresh();
 								}.bind(this), 'json');
 							}
 							else
@@ -103,24 +115,40 @@
 		}
 		function getQueue() {
 			getTableTypes(function() {
-				$.getJSON('/api/queue', function(data) {
+				getVersionedJSON('api/queue?compact=1', function(data) {
 					if(!queueTemplate) {
 						window.setTimeout(getQueue, 500);
 						return;
 					}
+					data = expandQueues(data);
 					data.LoggedIn = true;
 					$("#queue").html(Mustache.render(queueTemplate, data));
 					updateTimes();
+					// ctrl or shift click selects queued players to seat together
+					$(".playerqueue .player").each(function(i, player) {
+						if($(player).data("id") in selectedPlayers)
+							$(player).addClass("selected");
+					}).click(function(e) {
+						if(!e.ctrlKey && !e.metaKey && !e.shiftKey)
+							return;
+						var id = $(this).data("id");
+						if(id in selectedPlayers)
+							delete selectedPlayers[id];
+						else
+							selectedPlayers[id] = id;
+						$(this).toggleClass("selected");
+					});
 					$(".playerqueue").sortable({
 						connectWith:".players,.playerqueue",
 						update:function(event, ui) {
 							// if we're moving a table player back to the queue
 							if(this === ui.item.parent()[0] && ui.sender !== null) {
-								$.post("/api/queueplayer",
+								$.post("api/queueplayer",
 											 {'player':ui.item.data("id"), type:$(this).data("type")},
 											 function(data) {
 												 notify(data.message, data.status);
-												 refresh();
+												 if(!window.feedConnected || data.status === "error")
+													 refresh();
 
 												 if(data.status === "error") {
 													 $(this).sortable("cancel");
@@ -150,15 +178,15 @@
 		//     SETUP     //
 		///////////////////
 
-		$.get("/static/mustache/table.mst", function(data) {
+		getTemplate("table", function(data) {
 			tableTemplate = data;
 			Mustache.parse(data);
 		});
-		$.get("/static/mustache/queue.mst", function(data) {
+		getTemplate("queue", function(data) {
 			queueTemplate = data;
 			Mustache.parse(data);
 		});
-		$.get("/static/mustache/signup.mst", function(data) {
+		getTemplate("signup", function(data) {
 			signupTemplate = data;
 			Mustache.parse(data);
 		});
@@ -168,6 +196,11 @@
 			getQueue();
 		}
 		refresh();
+		subscribe(["room", "tabletypes"], function(change) {
+			if(change.topics.indexOf("tabletypes") >= 0)
+				window.tableTypes = undefined;
+			refresh();
+		});
 		function updateTimes() {
 			var now = new Date();
 			$(".table.playing").each(function(i, table) {
@@ -248,6 +281,13 @@
 		window.fillTable = function(table) {
 			window.api("filltable", true, {'table': table});
 		};
+		window.fillAllTables = function() {
+			window.api("filltables", true);
+		};
+		window.fillStartTable = function(table) {
+			window.batch([{'op':"filltable", 'table':table},
+				{'op':"starttable", 'table':table}]);
+		};
 		window.notifyTable = function(table) {
 			window.api("notifytable", false, {'table': table})
 		};
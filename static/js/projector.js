@@ -3,11 +3,12 @@ $(function() {
 	var sessions;
 	var days = ["Sunday", "Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday"];
 	function getQueue() {
-		$.getJSON('/api/queue', function(data) {
+		getVersionedJSON('api/queue?compact=1', function(data) {
 			if(queueTemplate === undefined) {
 				window.setTimeout(getQueue, 500);
 				return;
 			}
+			data = expandQueues(data);
 			data.LoggedIn = false;
 			$("#queue").html(Mustache.render(queueTemplate, data));
 		}).fail(window.xhrError);
@@ -15,7 +16,7 @@ $(function() {
 	var updateSession;
 	updateSession = function() {
 		if(sessions === undefined) {
-			$.getJSON("/api/teachingsessions", function(data) {
+			getVersionedJSON("api/teachingsessions", function(data) {
 				times = data['times'];
 				sessions = [];
 				for(var i = 0; i < times.length; ++i) {
@@ -53,10 +54,31 @@ $(function() {
 		getQueue();
 		updateSession();
 	}
-	$.get("/static/mustache/queue.mst", function(data) {
+	function updateTimes() {
+		var now = new Date();
+		$(".queueeta, .player.queued").each(function(i, element) {
+			var eta = new Date($(element).data("eta"));
+			if(isNaN(eta.getTime()))
+				return;
+			var remaining = Math.floor(eta - now);
+			if(remaining > 0)
+				$(element).children(".remaining").text(timeString(remaining));
+			else
+				$(element).children(".remaining").text("NOW");
+		});
+	}
+	getTemplate("queue", function(data) {
 		queueTemplate = data;
 		Mustache.parse(data);
 	});
 	refresh();
-	window.setInterval(refresh, 1000 * 5);
+	subscribe(["room", "teachingsessions"], function(change) {
+		if(change.topics.indexOf("teachingsessions") >= 0)
+			sessions = undefined;
+		refresh();
+	});
+	window.setInterval(function() {
+		updateSession();
+		updateTimes();
+	}, 1000 * 10);
 });
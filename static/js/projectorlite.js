@@ -0,0 +1,48 @@
+// Lightweight projector: the server renders the queue and teaching session
+// for all projectors, so this only swaps in its snapshot when the room
+// changes and once a minute as the ETAs count down.  No libraries needed.
+(function() {
+	var base = window.location.pathname.replace(/[^\/]*$/, "");
+	var last;
+	var version;
+	var delay = 1000;
+
+	function refresh() {
+		var request = new XMLHttpRequest();
+		request.open("GET", base + "api/projector");
+		request.onload = function() {
+			if(request.status === 200 && request.responseText !== last) {
+				last = request.responseText;
+				document.getElementById("snapshot").innerHTML = last;
+			}
+		};
+		request.send();
+	}
+
+	function connect() {
+		var protocol = window.location.protocol === "https:" ? "wss://" : "ws://";
+		var socket = new WebSocket(protocol + window.location.host + base + "api/feed");
+		socket.onopen = function() {
+			delay = 1000;
+		};
+		socket.onmessage = function(e) {
+			var change = JSON.parse(e.data);
+			if(version !== undefined && change.version !== version &&
+					(change.topics.indexOf("room") >= 0 ||
+					 change.topics.indexOf("teachingsessions") >= 0))
+				refresh();
+			version = change.version;
+		};
+		socket.onclose = function() {
+			window.setTimeout(connect, delay);
+			delay = Math.min(delay * 2, 30000);
+		};
+	}
+
+	if(window.WebSocket) {
+		connect();
+		window.setInterval(refresh, 1000 * 60);
+	}
+	else
+		window.setInterval(refresh, 1000 * 10);
+})();
@@ -17,10 +17,11 @@ function notify(message, status) {
 }
 
 window.api = function(name, toRefresh, data, callback) {
-	$.post("/api/" + name, data, function(data) {
+	$.post("api/" + name, data, function(data) {
 		$.notify(data.message, data.status);
 		if(data.status === "success") {
-			if(toRefresh)
+			// with a live feed the change notification does the refresh
+			if(toRefresh && !window.feedConnected)
 				window.refresh();
 			if(typeof callback === 'function')
 				callback(data);
@@ -28,9 +29,122 @@ window.api = function(name, toRefresh, data, callback) {
 	}, "json");
 }
 
+// Run several API operations in one transaction, all or nothing, e.g.
+// batch([{'op':"filltable", 'table':1}, {'op':"starttable", 'table':1}])
+window.batch = function(ops, callback) {
+	window.api("batch", true, {'ops':JSON.stringify(ops)}, callback);
+}
+
+// Mustache templates are inlined into the script bundle; when the scripts
+// are served unbundled they are fetched
+function getTemplate(name, callback) {
+	if(window.mustacheTemplates !== undefined && name in window.mustacheTemplates)
+		callback(window.mustacheTemplates[name]);
+	else
+		$.get("/static/mustache/" + name + ".mst", callback);
+}
+
+// Like $.getJSON, but sends the last ETag for the url so the server can
+// answer 304 Not Modified, in which case the previous response is reused
+var versionedResponses = {};
+function getVersionedJSON(url, callback) {
+	return $.ajax({
+		'url': url,
+		'dataType': "json",
+		'ifModified': true,
+		'success': function(data, status, xhr) {
+			if(status === "notmodified")
+				data = JSON.parse(versionedResponses[url]);
+			else
+				versionedResponses[url] = xhr.responseText;
+			callback(data);
+		}
+	});
+}
+
+// The compact responses of the read APIs (?compact=1) give columns of
+// values with times as epoch seconds; these expand them back into the
+// objects the templates expect
+function rows(columns) {
+	var names = Object.keys(columns);
+	var result = [];
+	for(var i = 0; i < columns[names[0]].length; ++i) {
+		var row = {};
+		for(var j = 0; j < names.length; ++j)
+			row[names[j]] = columns[names[j]][i];
+		result.push(row);
+	}
+	return result;
+}
+
+function pad(number) {
+	return ("0" + number).slice(-2);
+}
+
+// Seconds since the epoch as the server formats times, in local time
+function formatTime(epoch) {
+	if(epoch === null)
+		return "None";
+	var date = new Date(epoch * 1000);
+	return date.getFullYear() + "-" + pad(date.getMonth() + 1) + "-" + pad(date.getDate()) +
+		" " + pad(date.getHours()) + ":" + pad(date.getMinutes()) + ":" + pad(date.getSeconds());
+}
+
+function remainingString(eta, now) {
+	if(eta === null)
+		return "NEVER";
+	if(eta * 1000 > now)
+		return timeString(eta * 1000 - now);
+	return "NOW";
+}
+
+function expandTables(data) {
+	var now = Date.now();
+	var tables = rows(data.tables);
+	for(var i = 0; i < tables.length; ++i) {
+		var table = tables[i];
+		table.Players = [];
+		if(table.Started !== null) {
+			var elapsed = now - table.Started * 1000;
+			table.Elapsed = timeString(elapsed);
+			if(elapsed > table.Duration * 60 * 1000)
+				table.Overtime = true;
+		}
+		table.Started = table.Started === null ? null : formatTime(table.Started);
+		table.ScheduledStart = table.ScheduledStart === null ? null : formatTime(table.ScheduledStart);
+	}
+	var players = rows(data.players);
+	for(var i = 0; i < players.length; ++i) {
+		var player = players[i];
+		player.Added = formatTime(player.Added);
+		tables[player.Table].Players.push(player);
+	}
+	return {'tables': tables};
+}
+
+function expandQueues(data) {
+	var now = Date.now();
+	var queues = rows(data.queues);
+	for(var i = 0; i < queues.length; ++i) {
+		queues[i].Queue = [];
+		queues[i].Remaining = remainingString(queues[i].ETA, now);
+		queues[i].ETA = formatTime(queues[i].ETA);
+	}
+	var people = rows(data.people);
+	for(var i = 0; i < people.length; ++i) {
+		var person = people[i];
+		person.Elapsed = timeString(now - person.Added * 1000);
+		person.Added = formatTime(person.Added);
+		person.Remaining = remainingString(person.ETA, now);
+		person.ETA = formatTime(person.ETA);
+		queues[person.Queue].Queue.push(person);
+	}
+	return {'Queues': queues};
+}
+
 function getTableTypes(callback) {
 	if(window.tableTypes === undefined)
-		$.getJSON("/api/tabletype", function(data) {
+		getVersionedJSON("api/tabletype", function(data) {
 			window.tableTypes = data;
 			if(typeof callback === "function")
 				callback(window.tableTypes);
@@ -38,3 +152,68 @@ function getTableTypes(callback) {
 	else if(typeof callback === "function")
 		callback(window.tableTypes);
 }
+
+// Call callback whenever the server reports a change to one of topics.
+// Uses a WebSocket, falling back to server-sent events, and only polls if
+// the browser supports neither.
+window.feedConnected = false;
+window.subscribe = function(topics, callback) {
+	var version;
+	var delay = 1000;
+	function receive(data) {
+		var change = JSON.parse(data);
+		if(version !== undefined && change.version !== version) {
+			for(var i = 0; i < change.topics.length; ++i) {
+				if(topics.indexOf(change.topics[i]) >= 0) {
+					callback(change);
+					break;
+				}
+			}
+		}
+		version = change.version;
+	}
+	function stream() {
+		var source = new EventSource("api/feedstream");
+		source.onopen = function() {
+			window.feedConnected = true;
+		};
+		source.onerror = function() {
+			window.feedConnected = false;
+		};
+		source.onmessage = function(e) {
+			receive(e.data);
+		};
+	}
+	function connect() {
+		var opened = false;
+		var protocol = window.location.protocol === "https:" ? "wss://" : "ws://";
+		// API paths are relative so pages under a room's prefix use that room
+		var base = window.location.pathname.replace(/[^\/]*$/, "");
+		var socket = new WebSocket(protocol + window.location.host + base + "api/feed");
+		socket.onopen = function() {
+			opened = true;
+			delay = 1000;
+			window.feedConnected = true;
+		};
+		socket.onmessage = function(e) {
+			receive(e.data);
+		};
+		socket.onclose = function() {
+			window.feedConnected = false;
+			if(!opened && window.EventSource)
+				stream();
+			else {
+				window.setTimeout(connect, delay);
+				delay = Math.min(delay * 2, 30000);
+			}
+		};
+	}
+	if(window.WebSocket)
+		connect();
+	else if(window.EventSource)
+		stream();
+	else
+		window.setInterval(function() {
+			callback({'topics': topics});
+		}, 1000 * 5);
+};
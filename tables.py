@@ -4,61 +4,89 @@ import json
 import logging
 import preferences
 import datetime
-from twilio.rest import Client
 
 import util
+import eta
 import db
 import settings
 import events
-
-class TablesHandler(tornado.web.RequestHandler):
+import feed
+import state
+
+def getTables(room, now):
+    seating = room.seating()
+    tables = []
+    for row in room.tables.values():
+        if row['Type'] not in room.types:
+            continue
+        table = {'Id': row['Id'],
+                    'Playing': row['Playing'],
+                    'Started': row['Started'],
+                    'x': row['x'],
+                    'y': row['y'],
+                    'Name': row['Name'],
+                    'Type': row['Type'],
+                    'Duration': room.types[row['Type']]['Duration'],
+                    'ScheduledStart': row['ScheduledStart']}
+        table["Players"] = [{'Id': player['Id'],
+                                'Name': player['Name'],
+                                'HasPhone': player['Phone'] is not None,
+                                'Added': str(player['Added'])}
+                            for player in seating[row['Id']]]
+        if table['Started'] is not None:
+            elapsed = (now - util.parseTime(table['Started'])).total_seconds()
+            table['Elapsed'] = util.timeString(elapsed)
+            if elapsed > table['Duration'] * 60:
+                table['Overtime'] = True
+        tables += [table]
+    return tables
+
+def compactTables(room):
+    """The tables as columns of values, with times as epoch seconds and
+    none of the display strings, which clients work out themselves.  The
+    players are in columns too, each with the index of their table."""
+    seating = room.seating()
+    tables = dict((column, []) for column in
+            ['Id', 'Name', 'Playing', 'x', 'y', 'Type', 'Duration', 'Started', 'ScheduledStart'])
+    players = dict((column, []) for column in ['Id', 'Name', 'HasPhone', 'Added', 'Table'])
+    for row in room.tables.values():
+        if row['Type'] not in room.types:
+            continue
+        for column in ['Id', 'Name', 'Playing', 'x', 'y', 'Type']:
+            tables[column].append(row[column])
+        tables['Duration'].append(room.types[row['Type']]['Duration'])
+        tables['Started'].append(util.epoch(row['Started']))
+        tables['ScheduledStart'].append(util.epoch(row['ScheduledStart']))
+        for player in seating[row['Id']]:
+            players['Id'].append(player['Id'])
+            players['Name'].append(player['Name'])
+            players['HasPhone'].append(int(player['Phone'] is not None))
+            players['Added'].append(util.epoch(player['Added']))
+            players['Table'].append(len(tables['Id']) - 1)
+    return {'version': feed.COMPACT_VERSION, 'tables': tables, 'players': players}
+
+class TablesHandler(feed.VersionedHandler):
+    timed = True
+    def tickSeconds(self):
+        return eta.tickSeconds(table['Started'] for table in state.get().tables.values())
     def get(self):
-        with db.getCur() as cur:
-            cols     = ['Id', 'Playing', 'Started', 'x', 'y', 'Name', 'Tables.Type', 'TableTypes.Duration', 'ScheduledStart']
-            colnames = ['Id', 'Playing', 'Started', 'x', 'y', 'Name', 'Type',        'Duration', 'ScheduledStart']
-            cur.execute(
-                    "SELECT {cols} FROM Tables "
-                    " JOIN TableTypes ON TableTypes.Type = Tables.Type".format(cols=",".join(cols))
-            )
-            tables = [dict(zip(colnames, row)) for row in cur.fetchall()]
-            for table in tables:
-                table["Players"] = []
-                if table ['Started'] is not None:
-                    elapsed = (datetime.datetime.now() - datetime.datetime.strptime(table['Started'], '%Y-%m-%d %H:%M:%S')).total_seconds()
-                    table['Elapsed'] = util.timeString(elapsed)
-                    if elapsed > table['Duration'] * 60:
-                        table['Overtime'] = True
-                cur.execute(
-                        "SELECT People.Id, Name, Phone, Added FROM People "
-                        " INNER JOIN Players ON Players.PersonId = People.Id "
-                        " WHERE Players.TableId = ? ORDER BY People.Added",
-                        (table['Id'],)
-                )
-
-                for player in cur.fetchall():
-                    table["Players"] += [{'Id': player[0],
-                                            'Name': player[1],
-                                            'HasPhone': player[2] is not None,
-                                            'Added': str(player[3])}]
-            self.write(json.dumps({'tables': tables}))
+        if self.compact():
+            self.write(json.dumps(compactTables(state.get()), separators=(',', ':')))
+        else:
+            self.write(json.dumps({'tables': getTables(state.get(), datetime.datetime.now())}))
     def post(self):
         result = { 'status': "error",
                     'message': "Unknown error occurred"}
-        with db.getCur() as cur:
-            cur.execute("SELECT Type FROM TableTypes")
-            types = cur.fetchone()
-            if len(types) == 0:
-                result["message"] = "Please add some table types in admin panel"
-            else:
-                cur.execute(
-                        "INSERT INTO Tables(Playing, Started, Name, Type) VALUES(?, NULL, ?, ?)",
-                        (0, "Untitled", types[0])
-                )
-                result["status"] = "success"
-                result["message"] = "Added table"
+        room = state.get()
+        if len(room.types) == 0:
+            result["message"] = "Please add some table types in admin panel"
+        else:
+            table = room.addTable(min(room.types))
+            result["status"] = "success"
+            result["message"] = "Added table"
 
         if result["status"] == "success":
-            events.logEvent('tablecreate', cur.lastrowid)
+            events.logEvent('tablecreate', table)
         self.write(json.dumps(result))
 
 class StartTableHandler(tornado.web.RequestHandler):
@@ -67,8 +95,7 @@ class StartTableHandler(tornado.web.RequestHandler):
                     'message': "Unknown error occurred"}
         table = self.get_argument("table", None)
         if table is not None:
-            with db.getCur() as cur:
-                cur.execute("UPDATE Tables SET Playing = 1, Started = datetime('now', 'localtime') WHERE Id = ?", (table,))
+            state.get().startTable(table)
             result["status"] = "success"
             result["message"] = "Started table"
             events.logEvent('tablestart', table)
@@ -80,32 +107,37 @@ class FillTableHandler(tornado.web.RequestHandler):
                     'message': "Unknown error occurred"}
         table = self.get_argument("table", None)
         if table is not None:
-            with db.getCur() as cur:
-                cur.execute("SELECT TableTypes.Type, Players FROM TableTypes INNER JOIN Tables ON Tables.Type = TableTypes.Type WHERE Id = ?", (table,))
-                tableType = cur.fetchone()
-                cur.execute("SELECT COUNT(*) FROM Players WHERE TableId = ?", (table,))
-                playercount = tableType[1] - cur.fetchone()[0]
-
-                cur.execute("INSERT INTO Players(TableId, PersonId)"
-                        " SELECT ?, Queue.Person FROM Queue "
-                        " INNER JOIN People ON People.Id = Queue.Person"
-                        " WHERE Queue.Type = ? ORDER BY People.Added LIMIT ?", (table, tableType[0], playercount))
-
-                cur.execute("DELETE FROM Queue WHERE Person IN (SELECT PersonId FROM Players)")
+            playercount = state.get().fillTable(table)
             result["status"] = "success"
             result["message"] = "Filled table"
             events.logEvent('tablefill', (table, playercount))
         self.write(json.dumps(result))
 
+class FillTablesHandler(tornado.web.RequestHandler):
+    def post(self):
+        result = { 'status': "error",
+                    'message': "Unknown error occurred"}
+        room = state.get()
+        plan = room.fillTables()
+        result["plan"] = [{'Id': table,
+                            'Name': room.tables[table]['Name'],
+                            'Players': [{'Id': person, 'Name': room.people[person]['Name']}
+                                for person in people]}
+                        for table, people in plan.items()]
+        result["status"] = "success"
+        result["message"] = "Seated {0} players at {1} tables".format(
+                sum(len(people) for people in plan.values()), len(plan))
+        for table, people in plan.items():
+            events.logEvent('tablefill', (table, len(people)))
+        self.write(json.dumps(result))
+
 class ClearTableHandler(tornado.web.RequestHandler):
     def post(self):
         result = { 'status': "error",
                     'message': "Unknown error occurred"}
         table = self.get_argument("table", None)
         if table is not None:
-            with db.getCur() as cur:
-                cur.execute("DELETE FROM Players WHERE TableId = ?", (table,))
-                cur.execute("UPDATE Tables SET Playing = 0, Started = NULL WHERE Id = ?", (table,))
+            state.get().clearTable(table)
             result["status"] = "success"
             result["message"] = "Cleared table"
             events.logEvent('tableclear', table)
@@ -117,8 +149,7 @@ class DeleteTableHandler(tornado.web.RequestHandler):
                     'message': "Unknown error occurred"}
         table = self.get_argument("table", None)
         if table is not None:
-            with db.getCur() as cur:
-                cur.execute("DELETE FROM Tables WHERE Id = ?", (table,))
+            state.get().deleteTable(table)
             result["status"] = "success"
             result["message"] = "Deleted table"
             events.logEvent('tabledelete', table)
@@ -132,10 +163,9 @@ class TablePositionHandler(tornado.web.RequestHandler):
         x = self.get_argument("x", None)
         y = self.get_argument("y", None)
         if table is not None and x is not None and y is not None:
-            with db.getCur() as cur:
-                cur.execute("UPDATE Tables SET x = ?, y = ? WHERE Id = ?", (x, y, table))
-                result["status"] = "success"
-                result["message"] = "Moved table"
+            state.get().updateTable(table, x = x, y = y)
+            result["status"] = "success"
+            result["message"] = "Moved table"
         self.write(json.dumps(result))
 
 class EditTableHandler(tornado.web.RequestHandler):
@@ -145,8 +175,7 @@ class EditTableHandler(tornado.web.RequestHandler):
         table = self.get_argument("table", None)
         newname = self.get_argument("newname", None)
         if table is not None and newname is not None:
-            with db.getCur() as cur:
-                cur.execute("UPDATE Tables SET Name = ? WHERE Id = ?", (newname, table))
+            state.get().updateTable(table, Name = newname)
             result["status"] = "success"
             result["message"] = "Updated table"
             events.logEvent('tablerename', (table, newname))
@@ -162,11 +191,9 @@ class ScheduleTableHandler(tornado.web.RequestHandler):
             try:
                 if time != "":
                     eta = datetime.datetime.strptime(time, '%Y-%m-%d %H:%M:%S')
-                    with db.getCur() as cur:
-                        cur.execute("UPDATE Tables SET ScheduledStart = ? WHERE Id = ?", (time, table))
+                    state.get().updateTable(table, ScheduledStart = time)
                 else:
-                    with db.getCur() as cur:
-                        cur.execute("UPDATE Tables SET ScheduledStart = NULL WHERE Id = ?", (table,))
+                    state.get().updateTable(table, ScheduledStart = None)
                 result["status"] = "success"
                 result["message"] = "Scheduled time updated"
                 events.logEvent('tableschedule', (table, time))
@@ -174,23 +201,18 @@ class ScheduleTableHandler(tornado.web.RequestHandler):
                 result["message"] = "Failed to parse time"
         self.write(json.dumps(result))
 
-class TableTypeHandler(tornado.web.RequestHandler):
+class TableTypeHandler(feed.VersionedHandler):
     def get(self):
-        with db.getCur() as cur:
-            cur.execute("SELECT Type, Duration, Players FROM TableTypes")
-            rows = cur.fetchall()
-            types = []
-            for row in rows:
-                types += [{'Type': row[0], 'Duration': row[1], 'Players': row[2]}]
-            self.write(json.dumps(types))
+        types = [{'Type': row['Type'], 'Duration': row['Duration'], 'Players': row['Players']}
+                    for row in state.get().types.values()]
+        self.write(json.dumps(types))
     def post(self):
         result = { 'status': "error",
                     'message': "Unknown error occurred"}
         table = self.get_argument("table", None)
         tabletype = self.get_argument("type", None)
         if table is not None:
-            with db.getCur() as cur:
-                cur.execute("UPDATE Tables SET Type = ? WHERE Id = ?", (tabletype, table))
+            state.get().updateTable(table, Type = tabletype)
             result["status"] = "success"
             result["message"] = "TableType updated"
             events.logEvent('tableretype', (table, tabletype))
@@ -203,10 +225,9 @@ class AddTableTypeHandler(tornado.web.RequestHandler):
         tabletype = self.get_argument("type", None)
         gameduration = self.get_argument("gameduration", None)
         numplayers = self.get_argument("numplayers", None)
-        with db.getCur() as cur:
-            cur.execute("INSERT INTO TableTypes(Type, Duration, Players) VALUES(?, ?, ?)", (tabletype, gameduration, numplayers))
-            result['status'] = "Success"
-            result['message'] = "Added game type"
+        state.get().addTableType(tabletype, gameduration, numplayers)
+        result['status'] = "Success"
+        result['message'] = "Added game type"
         self.write(json.dumps(result))
 
 class DeleteTableTypeHandler(tornado.web.RequestHandler):
@@ -215,8 +236,7 @@ class DeleteTableTypeHandler(tornado.web.RequestHandler):
         result = { 'status': "error",
                     'message': "Unknown error occurred"}
         if tabletype is not None:
-            with db.getCur() as cur:
-                cur.execute("DELETE FROM TableTypes WHERE Type = ?", (tabletype,))
-                result['status'] = "success"
-                result['message'] = "Deleted table type"
+            state.get().deleteTableType(tabletype)
+            result['status'] = "success"
+            result['message'] = "Deleted table type"
         self.write(json.dumps(result))
@@ -0,0 +1,88 @@
+"""Conditional GETs of the read APIs are answered with 304 Not Modified
+without running any SQL, until the room changes or the times they show
+tick over.  Run with pytest."""
+
+import datetime
+import json
+
+import pytest
+import tornado.ioloop
+
+import benchmark
+import db
+import feed
+import settings
+import state
+
+paths = ['/api/tables', '/api/queue', '/api/announcement', '/api/tabletype',
+        '/api/teachingsessions']
+
+@pytest.fixture
+def server():
+    import sakuraconseater
+
+    settings.DBPOOL = True
+    dbfile = benchmark.tempdb()
+    benchmark.seed(tables=4, playing=2, queued=10)
+    with benchmark.Server(sakuraconseater.Application()) as server:
+        yield server
+    benchmark.removedb(dbfile)
+
+def run(coroutine):
+    return tornado.ioloop.IOLoop.current().run_sync(coroutine)
+
+async def tags(server):
+    tags = {}
+    for path in paths:
+        response = await server.fetch(path)
+        assert response.code == 200, path
+        tags[path] = response.headers['Etag']
+    return tags
+
+def test_304_without_sql(server):
+    async def check():
+        tagged = await tags(server)
+        for path in paths:
+            with benchmark.countStatements() as statements:
+                response = await server.fetch(path, headers = {'If-None-Match': tagged[path]})
+            assert response.code == 304, path
+            assert statements.count == 0, path
+    run(check)
+
+def test_200_after_change(server):
+    async def check():
+        tagged = await tags(server)
+        await server.fetch('/api/announcement', {'announcement': "Changed"})
+        for path in paths:
+            response = await server.fetch(path, headers = {'If-None-Match': tagged[path]})
+            assert response.code == 200, path
+    run(check)
+
+def test_timed_tag_follows_start_time(server, monkeypatch):
+    """The tables' tag changes when their elapsed times tick over, at the
+    seconds past the minute they started at, not at the top of the
+    minute"""
+    with db.getCur() as cur:
+        cur.execute("UPDATE Tables SET Started = '2030-01-01 10:00:30' WHERE Playing")
+    state.get().load()
+    feed.publish('room')
+    clock = [None]
+    class Clock(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return clock[0]
+    monkeypatch.setattr(datetime, 'datetime', Clock)
+    async def check():
+        shown = []
+        tag = None
+        for second in (29, 30, 59):
+            clock[0] = Clock(2030, 1, 1, 10, 5, second, 500000)
+            headers = {'If-None-Match': tag} if tag else {}
+            response = await server.fetch('/api/tables', headers = headers)
+            if response.code == 200:
+                tag = response.headers['Etag']
+                shown.append(json.loads(response.body)['tables'][0]['Elapsed'])
+            else:
+                shown.append(response.code)
+        assert shown == ["00:04", "00:05", 304]
+    run(check)
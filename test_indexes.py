@@ -0,0 +1,53 @@
+"""The hot queries use their indexes, by EXPLAIN QUERY PLAN, and db.init
+reconciles the declared indexes.  Run with pytest."""
+
+import pytest
+
+import benchmark
+import db
+
+queries = [
+    ("SELECT People.Id, Name, Phone, Added FROM People "
+     " INNER JOIN Queue ON Queue.Person = People.Id "
+     " WHERE Queue.Type = ? ORDER BY People.Added", ("Type 0",), 'Queue_Type'),
+    ("SELECT Started, Playing, ScheduledStart FROM Tables "
+     " WHERE Type = ? AND ScheduledStart IS NULL"
+     " ORDER BY Playing ASC, Started ASC", ("Type 0",), 'Tables_Type'),
+    ("SELECT Started, Playing, ScheduledStart FROM Tables "
+     " WHERE Type = ? AND ScheduledStart IS NOT NULL", ("Type 0",), 'Tables_Scheduled'),
+    ("DELETE FROM Players WHERE TableId = ?", (1,), 'Players_TableId'),
+    ("SELECT PersonId, TableId FROM Players WHERE PersonId IN (?, ?)", (1, 2),
+     'Players_PersonId'),
+    ("SELECT COUNT(*) FROM Events WHERE Type = ?", ('tablestart',), 'Events_Type_Time'),
+    ("SELECT strftime('%H', Time), COUNT(*) FROM Events WHERE Type = ?"
+     " GROUP BY strftime('%H', Time)", ('tablestart',), 'Events_Type_Time'),
+    ("SELECT Id FROM People ORDER BY Added LIMIT 10", (), 'People_Added'),
+]
+
+@pytest.fixture
+def seeded():
+    dbfile = benchmark.tempdb()
+    benchmark.seed(types=2, tables=20, playing=10, queued=40)
+    yield
+    benchmark.removedb(dbfile)
+
+@pytest.mark.parametrize("sql, params, index", queries)
+def test_query_uses_index(seeded, sql, params, index):
+    with db.getCur() as cur:
+        cur.execute("EXPLAIN QUERY PLAN " + sql, params)
+        plan = " / ".join(row[3] for row in cur.fetchall())
+    assert "INDEX " + index in plan, "{0} does not use {1}".format(sql, index)
+
+def test_indexes_reconciled(seeded, monkeypatch):
+    """Altered, undeclared and missing indexes are all reconciled"""
+    with db.getCur() as cur:
+        cur.execute("DROP INDEX Queue_Type")
+        cur.execute("CREATE INDEX Stale ON Queue(Type)")
+    monkeypatch.setitem(db.indexes['People'], 'People_Added', '(Added, Name)')
+    db.check_table_schema('Queue', force=True)
+    db.check_table_schema('People', force=True)
+    with db.getCur() as cur:
+        cur.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index'")
+        actual = dict(cur.fetchall())
+    assert 'Queue_Type' in actual and 'Stale' not in actual
+    assert actual['People_Added'].endswith('(Added, Name)')
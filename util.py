@@ -2,6 +2,8 @@
 
 import random
 import string
+import datetime
+import functools
 
 # convert timedelta object to # of seconds
 def get_total_seconds(td):
@@ -15,6 +17,32 @@ def timeString(time):
     hours = int(time / 60)
     return ("0" + str(hours))[-2:] + ":" + ("0" + str(minutes))[-2:]
 
+def lastTick(seconds, now):
+    """The last whole second up to now, a datetime, that is one of the
+    given seconds past the minute, or the start of the minute if none are
+    given.  Counts of whole minutes since or until times with those
+    seconds, as timeString shows, only change at these ticks."""
+    now = now.replace(microsecond = 0)
+    if len(seconds) == 0:
+        return now.replace(second = 0)
+    return now - datetime.timedelta(
+            seconds = min((now.second - second) % 60 for second in seconds))
+
+# parse a timestamp as stored by sqlite's datetime().  The same few
+# timestamps are parsed on every poll, so results are cached.
+@functools.lru_cache(maxsize=4096)
+def parseTime(time):
+    return datetime.datetime.fromisoformat(time)
+
+def epoch(time):
+    """Seconds since the epoch of a datetime or a timestamp as stored by
+    sqlite's datetime(), or None"""
+    if time is None:
+        return None
+    if isinstance(time, str):
+        time = parseTime(time)
+    return int(time.timestamp())
+
 def randString(length):
 	return ''.join(random.SystemRandom().choice(string.ascii_letters + string.digits) for x in range(length))
 